@@ -0,0 +1,152 @@
+"""Benchmark of the threaded and the asyncio engine of the runner
+
+    An in-process paramiko ssh server answers every check command after --delay
+    milliseconds with a sacct line per job id in state RUNNING. The database holds
+    --jobs running tasks. Each engine performs one iteration of the runner, which
+    checks all jobs in chunks of --chunk job ids. The benchmark reports the time of
+    the iteration, the number of threads of the process afterwards and the CPU time used.
+    The ssh server runs in the same process and adds to the CPU time and the threads.
+
+    Usage:
+        python benchmarks/bench_aio_engine.py [--jobs 2000] [--chunk 1] [--delay 100]
+"""
+import argparse
+import heapq
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import paramiko
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+#pylint: disable=wrong-import-position
+from papi.db import SlurmJob
+from papi.db.viwa_db import ViwaDb
+from papi.ssh import Ssh
+from papi.async_runner import AsyncRunner
+from papi.async_runner.aio import AioRunner
+
+PAYLOAD = {'seeding_date': 'sub15days', 'irrigation': True,
+           'nutrition_factor': 0.25, 'phenology_factor': 1.0}
+
+class Server(paramiko.ServerInterface):
+    """Accepts every login and answers exec requests by a delayed sacct output"""
+    def __init__(self, timers: 'Timers', delay: float):
+        self.timers = timers
+        self.delay = delay
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        job_ids = command.decode().split(' ')[-1].split(',')
+        output = 'User|JobID|State|Elapsed\n' + ''.join(f"u|{job_id}|RUNNING|00:00:01\n"
+                                                         for job_id in job_ids)
+        self.timers.add(self.delay, channel, output.encode())
+        return True
+
+class Timers:
+    """Single thread answering the commands once their delay passed"""
+    def __init__(self):
+        self.heap: list = []
+        self.condition = threading.Condition()
+        self.counter = 0
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def add(self, delay: float, channel, output: bytes):
+        """Answers the command on channel after delay seconds"""
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.heap, (time.monotonic() + delay, self.counter, channel, output))
+            self.condition.notify()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap
+                                        else None)
+                _, _, channel, output = heapq.heappop(self.heap)
+            try:
+                channel.sendall(output)
+                channel.send_exit_status(0)
+                channel.close()
+            except Exception: #pylint: disable=broad-except
+                pass
+
+def start_server(delay: float) -> int:
+    """Starts the ssh server on localhost and returns its port"""
+    host_key = paramiko.RSAKey.generate(2048)
+    timers = Timers()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(100)
+
+    def accept():
+        while True:
+            client, _ = listener.accept()
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.start_server(server=Server(timers, delay))
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+def bench(engine: str, args, port: int, tmp_dir: str) -> dict:
+    """Performs one iteration of the runner and returns its time and resource usage"""
+    database = ViwaDb({'BASE_DIR': '',
+                       'FILENAME': os.path.join(tmp_dir, f'{engine}.sqlite3')[1:]})
+    _, tasks = database.add_tasks([dict(PAYLOAD) for _ in range(args.jobs)])
+    for task in tasks:
+        database.add_slurm_job(SlurmJob(job_id=task.id, cluster='mpp2', job_type='main',
+                                        ssh_rc=0, task_id=task.id))
+        database.set_task_state(task.id, 'running')
+    ssh = Ssh({'HOSTNAME': '127.0.0.1', 'PORT': port, 'USERNAME': 'bench',
+               'PASSWORD': 'bench', 'KEY_FILENAME': '', 'CHECK_COMMAND': 'check',
+               'POOL': {'MAX_TRANSPORTS': 8, 'MAX_CHANNELS': 256, 'KEEPALIVE': 0}}, database)
+    runner_config = {'CHECK_CHUNK_SIZE': args.chunk, 'CHECK_TIMEOUT': 60,
+                     'CHECK_WORKERS': args.workers if engine == 'thread-wide' else 8}
+    if engine == 'asyncio':
+        runner = AioRunner(ssh, database, 10, runner_config,
+                           {'MAX_CHECKS': args.workers, 'SSH_WORKERS': args.ssh_workers})
+    else:
+        runner = AsyncRunner(ssh, database, 10, runner_config)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    runner.work()
+    elapsed = time.perf_counter() - start
+    return {'engine': engine,
+            'seconds': elapsed,
+            'cpu': time.process_time() - cpu,
+            'threads': threading.active_count(),
+            'checked': len(runner.scheduler.intervals)}
+
+def main():
+    """Runs the benchmark of every engine"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--chunk', type=int, default=1)
+    parser.add_argument('--delay', type=float, default=100, help="milliseconds")
+    parser.add_argument('--workers', type=int, default=256,
+                        help="concurrent checks of thread-wide and asyncio")
+    parser.add_argument('--ssh-workers', type=int, default=8,
+                        help="threads opening channels of asyncio")
+    args = parser.parse_args()
+    port = start_server(args.delay / 1000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"{args.jobs} jobs, {args.chunk} per check, {args.delay:.0f} ms per check")
+        for engine in ['thread', 'thread-wide', 'asyncio']:
+            res = bench(engine, args, port, tmp_dir)
+            print(f"{res['engine']:12s} {res['seconds']:8.2f} s  cpu {res['cpu']:6.2f} s  "
+                  f"{res['threads']:4d} threads  {res['checked']} jobs checked")
+
+if __name__ == '__main__':
+    main()
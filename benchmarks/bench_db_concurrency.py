@@ -0,0 +1,93 @@
+"""Benchmark of concurrent status reads and runner writes on the sqlite database
+
+    Reader threads fetch random tasks like the /status handler while writer threads
+    change task states like the runner and the ssh callbacks. The benchmark compares
+    the default storage mode (rollback journal, one connection per session) with the
+    WAL mode and a pooled engine as configured in config.py.
+
+    Usage:
+        python benchmarks/bench_db_concurrency.py [--tasks 10000] [--readers 8] [--writers 2]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+#pylint: disable=wrong-import-position
+from papi.db.viwa_db import ViwaDb
+
+PAYLOAD = {'seeding_date': 'sub15days', 'irrigation': True,
+           'nutrition_factor': 0.25, 'phenology_factor': 1.0}
+
+MODES = {
+    'default': {'JOURNAL_MODE': None, 'SYNCHRONOUS': None, 'BUSY_TIMEOUT': 5,
+                'MMAP_SIZE': 0, 'POOL_SIZE': 0},
+    'wal': {'JOURNAL_MODE': 'WAL', 'SYNCHRONOUS': 'NORMAL', 'BUSY_TIMEOUT': 30,
+            'MMAP_SIZE': 268435456, 'POOL_SIZE': 8, 'MAX_OVERFLOW': 16},
+}
+
+def worker(operation, duration: float, results: list):
+    """Executes operation until duration passed and appends (ops, errors, max latency)"""
+    ops = errors = 0
+    max_latency = 0.0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            operation()
+            ops += 1
+        except Exception: #pylint: disable=broad-except
+            errors += 1
+        max_latency = max(max_latency, time.perf_counter() - start)
+    results.append((ops, errors, max_latency))
+
+def run(mode: str, args) -> dict:
+    """Runs readers and writers against a fresh database in the given mode"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = dict(MODES[mode], BASE_DIR='',
+                      FILENAME=os.path.join(tmp_dir, 'db.sqlite3')[1:])
+        database = ViwaDb(config)
+        _, tasks = database.add_tasks([dict(PAYLOAD) for _ in range(args.tasks)])
+        task_ids = [task.id for task in tasks]
+
+        def read():
+            database.get_task(random.choice(task_ids))
+
+        def write():
+            database.set_task_state(random.choice(task_ids), random.choice(['running',
+                                                                             'aggregating']))
+
+        readers, writers = [], []
+        threads = [threading.Thread(target=worker, args=(read, args.duration, readers))
+                   for _ in range(args.readers)]
+        threads += [threading.Thread(target=worker, args=(write, args.duration, writers))
+                    for _ in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {'reads/s': sum(r[0] for r in readers) / args.duration,
+                'writes/s': sum(w[0] for w in writers) / args.duration,
+                'errors': sum(r[1] for r in readers + writers),
+                'max read [ms]': max(r[2] for r in readers) * 1000,
+                'max write [ms]': max(w[2] for w in writers) * 1000}
+
+def main():
+    """Runs the benchmark for all storage modes"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        result = run(mode, args)
+        print(f"{mode:>8}: " + ', '.join(f"{key} {value:.1f}" for key, value in result.items()))
+
+if __name__ == '__main__':
+    main()
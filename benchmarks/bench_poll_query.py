@@ -0,0 +1,95 @@
+"""Benchmark of the poll query of the asynchronous runner
+
+    Fills a database with a long task history (finished tasks with three slurm jobs
+    each) and a fixed number of active tasks, then measures the queries used by the
+    runner in every iteration. 'states' is the join of tasks with all their jobs, also
+    measured without the secondary indexes, 'poll' the projected query of the current
+    phase. The latter looks up the latest job per task by ix_slurm_jobs_task_id_job_type
+    and is not measured without indexes.
+
+    Usage:
+        python benchmarks/bench_poll_query.py [--sizes 10000 100000 1000000] [--active 1000]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+#pylint: disable=wrong-import-position
+from papi.db import SlurmJob
+from papi.db.viwa_db import ViwaDb
+from papi.async_runner.runner import PHASE_TRANSITIONS, PHASE_JOB_TYPES
+
+INDEXES = ['ix_tasks_state', 'ix_tasks_group_id', 'ix_slurm_jobs_task_id_job_type',
+           'ix_slurm_jobs_cluster_job_id']
+JOB_TYPES = ['main', 'aggregation', 'archive']
+
+def fill(filename: str, size: int, active: int):
+    """Inserts size tasks of which active are in a poll state"""
+    connection = sqlite3.connect(filename)
+    phases = list(PHASE_TRANSITIONS)
+    tasks = []
+    jobs = []
+    for task_id in range(1, size + 1):
+        state = phases[task_id % len(phases)] if task_id <= active else 'finished'
+        tasks.append((task_id, state, 0, 'sub15days', 1, 0.5, 1.0))
+        for job_type in JOB_TYPES:
+            jobs.append((len(jobs) + 1, len(jobs) + 1000, 'mpp2', job_type, 0, task_id))
+    connection.executemany("INSERT INTO tasks (id, state, debug, seeding_date, irrigation, "
+                           "nutrition_factor, phenology_factor) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           tasks)
+    connection.executemany("INSERT INTO slurm_jobs (id, job_id, cluster, job_type, ssh_rc, "
+                           "task_id) VALUES (?, ?, ?, ?, ?, ?)", jobs)
+    connection.commit()
+    connection.execute("ANALYZE")
+    connection.close()
+
+def measure(query, repeat: int) -> float:
+    """Returns the mean time of a query in milliseconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        query()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def query_states(database: ViwaDb, states: list) -> list:
+    """Returns the tasks in any of states joined with all their submitted jobs"""
+    task_model = database.task_model
+    session = database.session()
+    rows = session.query(task_model, SlurmJob).\
+            filter(task_model.id == SlurmJob.task_id).\
+            filter(task_model.state.in_(states)).\
+            filter(SlurmJob.job_id != -1).all()
+    database.session.remove()
+    return rows
+
+def measure_states(database: ViwaDb, repeat: int) -> float:
+    """Returns the mean time of the query of tasks joined with all their jobs"""
+    return measure(lambda: query_states(database, list(PHASE_TRANSITIONS)), repeat)
+
+def main():
+    """Runs the benchmark for all sizes"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--active', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'tasks':>10} {'states [ms]':>12} {'poll [ms]':>12} {'states no index':>16}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'db.sqlite3')
+            database = ViwaDb({'BASE_DIR': '', 'FILENAME': filename.lstrip('/')})
+            fill(filename, size, args.active)
+            states = measure_states(database, args.repeat)
+            poll = measure(lambda: database.get_poll_jobs(PHASE_JOB_TYPES), args.repeat)
+            connection = sqlite3.connect(filename)
+            for index in INDEXES:
+                connection.execute(f"DROP INDEX {index}")
+            connection.close()
+            plain = measure_states(database, args.repeat)
+            print(f"{size:>10} {states:>12.1f} {poll:>12.1f} {plain:>16.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ CONFIG = {
         'LEVEL':    logging.INFO,
     },
     'SSH': {
-        'HOSTNAME':         '',
+        'HOSTNAME':         '',     #Login host or list of equivalent login hosts
         'PORT':             22,
         'USERNAME':         '',
         'PASSWORD':         None,
@@ -27,22 +27,112 @@ CONFIG = {
         'STATUS_COMMAND':   "status",
         'CHECK_COMMAND':    "check",
         'SUBMIT_COMMAND':   "submit",
+        'SUBMIT_ARRAY_COMMAND': "submit_array", #Reads one parameter line per array index on stdin
         'COLLECT_COMMAND':  "collect",
         'ARCHIVE_COMMAND':  "archive",
+        'POOL': {
+            'MAX_TRANSPORTS':   2,      #Authenticated transports kept open per host
+            'MAX_CHANNELS':     8,      #Concurrent channels (commands) per transport
+            'IDLE_TIMEOUT':     300,    #Seconds until an unused transport is closed
+            'KEEPALIVE':        30,     #Seconds between keepalive packets, 0 disables
+            'WAIT_TIMEOUT':     60,     #Seconds to wait for a free channel slot
+        },
+        'ROUTER': {
+            'POLICY':           'least_outstanding', #Or 'latency', host choice with several hosts
+            'MAX_FAILURES':     3,      #Failures or timeouts in a row until a host is ejected
+            'EJECT_TIME':       30,     #Seconds until an ejected host is probed
+            'MAX_EJECT_TIME':   300,    #Upper limit of the eject time doubled per failed probe
+            'PROBE_COMMAND':    'true', #Command which has to succeed to readmit a host
+            'PROBE_TIMEOUT':    10,     #Seconds to wait for the probe command
+            'LATENCY_DECAY':    0.3,    #Weight of a new sample in the latency average
+        },
+        'READER': {
+            'QUEUE_SIZE':       1024,   #Commands waiting to be picked up by the reader
+            'QUEUE_TIMEOUT':    10,     #Seconds to wait for a free queue slot
+            'CALLBACK_WORKERS': 4,      #Threads executing the command callbacks
+            'MAX_OUTPUT':       65536,  #Bytes of stdout/stderr kept in memory per command
+            'LOG_DIR':          'logs/',#Directory with the full output per task, None disables
+            'LOG_RETENTION':    604800, #Seconds until old log files are removed, None keeps
+        },
     },
     'DB': {
         'TYPE':     'sqlite3',
         'FILENAME': 'db/db.sqlite3',
+        'JOURNAL_MODE': 'WAL',      #Readers run concurrently with a writer, None keeps the default
+        'SYNCHRONOUS':  'NORMAL',   #Sync on WAL checkpoints only, None keeps the default
+        'BUSY_TIMEOUT': 30,         #Seconds a connection waits for a lock
+        'MMAP_SIZE':    268435456,  #Bytes of the database file read by memory mapping
+        'POOL_SIZE':    8,          #Connections kept open, 0 opens one per session
+        'MAX_OVERFLOW': 16,         #Additional connections opened under load
+        'POOL_TIMEOUT': 30,         #Seconds to wait for a free connection
     },
     'PAPI': {
         'BASE_DIR': '',
         'JWT_REQUIRED': True,
         'SLEEP_TIMER': 10,
+        'PIPELINED': False,     #Queue all phases at submit time chained by slurm dependencies
+        'MAX_BATCH_SIZE': 1000, #Max. number of tasks in a single batch submit
+        'MAX_SWEEP_SIZE': 100000,   #Max. number of grid points of a parameter sweep
+        'SWEEP_CHUNK_SIZE': 1000,   #Grid points stored and submitted as one job array
+        'MAX_STATUS_TASKS': 1000,   #Max. number of task ids in a single status request
+        'MAX_CHANGES': 1000,        #Max. number of journal entries in a single response
+        'CACHE': {
+            'ENABLED':  False,      #Reuse tasks with identical parameters on submit
+            'TTL':      2592000,    #Seconds a finished result is reused, None for forever
+        },
+        'STATUS_CACHE': {
+            'MAX_SIZE': 10000,      #Status responses kept in memory, 0 disables the cache
+            'TTL':      5,          #Seconds a response of a non terminal task is reused
+        },
+        'EVENTS': {
+            'BUFFER_SIZE':      1000,   #Events buffered per subscriber, more are dropped
+            'MAX_SUBSCRIBERS':  1000,   #Max. number of concurrent event streams
+            'KEEPALIVE':        15,     #Seconds between keepalive comments of a stream
+            'MAX_WAIT':         60,     #Max. seconds a long poll request waits
+            'JOURNAL_INTERVAL': 1,      #Seconds between reads of changes of other processes
+        },
+        'ENGINE': 'thread',         #Engine of runner and ssh commands, 'thread' or 'asyncio'
+        'AIO': {
+            'SSH_WORKERS':      8,      #Threads opening channels and executing commands
+            'DB_WORKERS':       2,      #Threads reading and writing the database
+            'MAX_CHECKS':       256,    #Max. concurrent check commands of an iteration
+            'MAX_OUTPUT':       1048576,#Bytes of output kept per check command
+            'MAX_IN_FLIGHT':    10000,  #Max. ssh commands watched by the event loop
+            'COMMAND_TIMEOUT':  None,   #Seconds until a command is cancelled, None for never
+        },
+        'DISPATCHER': {
+            'ENABLED':          True,   #Submit stored tasks in the background
+            'WORKERS':          4,      #Threads handing submissions to ssh
+            'QUEUE_SIZE':       1000,   #Max. pending submissions, further requests get 429
+            'RESERVE_TIMEOUT':  0,      #Seconds a request waits for a free slot
+            'SCAN_INTERVAL':    5,      #Seconds between scans for unsubmitted tasks
+            'CLAIM_TIMEOUT':    600,    #Seconds until claims of other processes are requeued
+        },
+        'ELECTION': {
+            'ENABLED':          True,   #Run runner and dispatcher in one process only
+            'LEASE':            30,     #Seconds until the lease of a dead leader expires
+            'RENEW_INTERVAL':   10,     #Seconds between renewals of the lease
+        },
+        'RUNNER': {
+            'CHECK_WORKERS':    8,      #Parallel slurm checks over all clusters
+            'CHECK_CHUNK_SIZE': 200,    #Max. job ids per check command
+            'CHECK_TIMEOUT':    10,     #Seconds until a single check times out
+            'RESEED_INTERVAL':  300,    #Seconds between full reads of the active jobs
+            'JOURNAL_LIMIT':    1000,   #Journal entries read per query of an iteration
+            'SCHEDULER': {
+                'MIN_INTERVAL':     2,      #Min. seconds between two checks of a job
+                'MAX_INTERVAL':     600,    #Max. seconds between two checks of a job
+                'BACKOFF':          2.0,    #Interval factor while a job is PENDING/RUNNING
+                'LEARNING_RATE':    0.3,    #Weight of new Elapsed values in the expectation
+                'MAX_QUERY_RATE':   0,      #Max. check commands per second, 0 disables
+            },
+        },
         'HTTP': {
             'HOSTNAME':             '0.0.0.0',
             'PORT':                 5000,
             'OK_RESP_CODE':         200,
             'CLIENT_ERR_RESP_CODE': 400,
+            'TOO_MANY_REQUESTS_RESP_CODE': 429,
             'JWT_ALGORITHM':        'ES256',
             'JWT_SECRET_KEY':       'keys/public.pem',
             'JWT_AUTH_PREFIX':      'Bearer',
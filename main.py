@@ -1,11 +1,17 @@
 """Main executable for a papi instance"""
 from test_config import CONFIG
 from papi.papi import Papi
-from papi.handler import Status, Submit
+from papi.handler import Status, StatusBatch, Submit, SubmitBatch, Sweep, Logs, Events, Changes
 
 PAPI = Papi(CONFIG)
-PAPI.add_resource(Status, '/status/<int:task_id>')
-PAPI.add_resource(Submit, '/submit/')
+PAPI.add_resource(Status, '/status/<int:task_id>', status_cache=PAPI.status_cache)
+PAPI.add_resource(StatusBatch, '/status/')
+PAPI.add_resource(Submit, '/submit/', dispatcher=PAPI.dispatcher)
+PAPI.add_resource(SubmitBatch, '/submit/batch/', dispatcher=PAPI.dispatcher)
+PAPI.add_resource(Sweep, '/sweep/', '/sweep/<int:sweep_id>', dispatcher=PAPI.dispatcher)
+PAPI.add_resource(Logs, '/logs/<int:task_id>')
+PAPI.add_resource(Events, '/events/', event_hub=PAPI.event_hub)
+PAPI.add_resource(Changes, '/changes/')
 if __name__ == '__main__':
     PAPI.app.run(use_reloader=False,
                  host=CONFIG['PAPI']['HTTP']['HOSTNAME'],
@@ -7,3 +7,4 @@
     a slurm job which is not finished yet
 """
 from .runner import AsyncRunner
+from .leader import LeaderElection
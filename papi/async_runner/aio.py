@@ -0,0 +1,307 @@
+"""asyncio engine of the runner and the ssh commands
+
+    The threaded engine checks slurm from a pool of CHECK_WORKERS threads, each blocked
+    in one ssh command, and watches the other commands with the selector thread of the
+    SshReader. With CONFIG['PAPI']['ENGINE'] = 'asyncio' all commands in flight, slurm
+    checks and database writes of the runner are coroutines on a single event loop:
+
+        EventLoopThread: the event loop, running in a daemon thread
+        AioReader: SshReader watching the channels of commands on the event loop
+        AioRunner: AsyncRunner checking slurm by coroutines on the event loop
+
+    Paramiko and SQLAlchemy calls which block, like opening a channel or executing a
+    command, run on bounded executors of SSH_WORKERS and DB_WORKERS threads.
+"""
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Mapping, Optional, Tuple, Dict
+from papi.util import chunk_list
+from papi.ssh import Ssh
+from papi.ssh.ssh_reader import SshReader, SshConnection, OutputCapture
+from papi.db import DB
+from .runner import AsyncRunner
+
+# Seconds between checks for the exit status of a channel which reached eof
+EXIT_STATUS_POLL = 0.05
+
+class EventLoopThread:
+    """Event loop running in a daemon thread, started with the first coroutine"""
+    def __init__(self, name: str = 'papi-aio'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.__run, daemon=True, name=name)
+        self.lock = threading.Lock()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine) -> Future:
+        """Schedules a coroutine on the loop from any thread and returns its future"""
+        with self.lock:
+            if self.thread.ident is None:
+                self.thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+LOOP_THREAD: Optional[EventLoopThread] = None
+
+def get_loop_thread() -> EventLoopThread:
+    """Returns the event loop shared by the engine of a process"""
+    global LOOP_THREAD #pylint: disable=global-statement
+    if LOOP_THREAD is None:
+        LOOP_THREAD = EventLoopThread()
+    return LOOP_THREAD
+
+async def wait_done(ssh_connection: SshConnection):
+    """Drains the channel of a command until all output and the exit status are read"""
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    channel = ssh_connection.channel
+    fileno = channel.fileno()
+    loop.add_reader(fileno, readable.set)
+    try:
+        while True:
+            ssh_connection.drain()
+            if ssh_connection.is_done():
+                return
+            if ssh_connection.is_eof():
+                # The channel stays readable after eof, wait for the exit status without it
+                loop.remove_reader(fileno)
+                while not channel.exit_status_ready():
+                    await asyncio.sleep(EXIT_STATUS_POLL)
+                ssh_connection.drain()
+                return
+            await readable.wait()
+            readable.clear()
+    finally:
+        loop.remove_reader(fileno)
+
+async def run_blocking(executor: ThreadPoolExecutor, cleanup, function, *args):
+    """Runs a blocking function on executor
+
+        If the awaiting coroutine is cancelled, the function keeps running on the executor
+        and cleanup is called with its result, e. g. to release an opened channel.
+    """
+    future = asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if cleanup is not None:
+            future.add_done_callback(lambda done: done.cancelled() or done.exception()
+                                     or cleanup(done.result()))
+        raise
+
+class AioReader(SshReader):
+    """SshReader watching the channels on the event loop instead of a selector thread
+
+        At most MAX_IN_FLIGHT commands are watched, each by one coroutine. A command
+        running longer than COMMAND_TIMEOUT seconds is cancelled and reported with exit
+        code -1. The callbacks run on the CALLBACK_WORKERS threads like in SshReader.
+
+        Parameters:
+            config: reader config dict (see CONFIG['SSH']['READER'])
+            aio_config: engine config dict (see CONFIG['PAPI']['AIO'])
+            loop_thread: event loop to use, the shared one if None
+            base_dir: Directory a relative LOG_DIR is resolved against
+    """
+    def __init__(self, config: Optional[Mapping] = None, aio_config: Optional[Mapping] = None,
+                 loop_thread: Optional[EventLoopThread] = None, base_dir: str = ''):
+        SshReader.__init__(self, config, base_dir)
+        aio_config = aio_config if aio_config is not None else {}
+        self.loop_thread = loop_thread if loop_thread is not None else get_loop_thread()
+        self.max_in_flight = aio_config.get('MAX_IN_FLIGHT', 10000)
+        self.command_timeout = aio_config.get('COMMAND_TIMEOUT')
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.logger = logging.getLogger('papi.async_runner.AioReader')
+
+    def add_object(self, channel, command, callback, task_id, release, stdin=None,
+                   log_name=None):
+        """Executes command on channel and watches it on the event loop
+
+            Raises queue.Full if MAX_IN_FLIGHT commands are running for QUEUE_TIMEOUT seconds.
+        """
+        #pylint: disable=too-many-arguments
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            self.logger.error("%d ssh commands in flight, rejecting command for task '%s'",\
+                              self.max_in_flight, str(task_id))
+            release(channel)
+            raise queue.Full
+        ssh_connection = self._new_connection(channel, callback, task_id, release, log_name)
+        try:
+            channel.exec_command(command)
+            if stdin is not None:
+                channel.sendall(stdin)
+                channel.shutdown_write()
+        except Exception:
+            ssh_connection.finalize()
+            self.slots.release()
+            raise
+        self.loop_thread.submit(self.__watch(ssh_connection))
+
+    async def __watch(self, ssh_connection: SshConnection):
+        try:
+            await asyncio.wait_for(wait_done(ssh_connection), self.command_timeout)
+            self._finish(ssh_connection)
+        except Exception as exception: #pylint: disable=broad-except
+            if isinstance(exception, asyncio.TimeoutError):
+                message = f"Timeout after {self.command_timeout} seconds"
+            else:
+                message = f"Reading ssh channel failed: '{exception}'"
+            self.logger.error("Command of task '%s': %s", str(ssh_connection.task_id), message)
+            ssh_connection.finalize()
+            self.executor.submit(self._run_callback, ssh_connection, -1,
+                                 ssh_connection.stdout.getvalue(), message)
+        finally:
+            self.slots.release()
+
+class AioRunner(AsyncRunner):
+    """AsyncRunner checking slurm by coroutines on an event loop
+
+        All chunks of an iteration are checked concurrently, at most MAX_CHECKS at a time.
+        Each check command is cancelled after CHECK_TIMEOUT seconds, its output is kept up
+        to MAX_OUTPUT bytes. Waiting for the next iteration, for resume and for the query
+        rate limit does not block a thread, notifies of the scheduler wake up the loop.
+
+        Parameters:
+            ssh: Ssh object used for slurm queries
+            database: Database with the tasks to check
+            sleep_timer: Seconds between two iterations
+            config: runner config dict (see CONFIG['PAPI']['RUNNER'])
+            aio_config: engine config dict (see CONFIG['PAPI']['AIO'])
+            loop_thread: event loop to use, the shared one if None
+    """
+    def __init__(self, ssh: Ssh, database: DB, sleep_timer: int,
+                 config: Optional[Mapping] = None, aio_config: Optional[Mapping] = None,
+                 loop_thread: Optional[EventLoopThread] = None):
+        #pylint: disable=too-many-arguments
+        AsyncRunner.__init__(self, ssh, database, sleep_timer, config)
+        aio_config = aio_config if aio_config is not None else {}
+        self.loop_thread = loop_thread if loop_thread is not None else get_loop_thread()
+        self.max_checks = aio_config.get('MAX_CHECKS', 256)
+        self.max_output = aio_config.get('MAX_OUTPUT', 1048576)
+        self.ssh_executor = ThreadPoolExecutor(max_workers=aio_config.get('SSH_WORKERS', 8),
+                                               thread_name_prefix='AioSsh')
+        self.db_executor = ThreadPoolExecutor(max_workers=aio_config.get('DB_WORKERS', 2),
+                                              thread_name_prefix='AioDb')
+        self.future: Optional[Future] = None
+        self.wakeup = asyncio.Event()
+        self.scheduler.add_listener(self.__notify)
+        self.logger = logging.getLogger('papi.async_runner.AioRunner')
+
+    def __notify(self):
+        """Sets the wakeup event on the event loop, called from any thread"""
+        self.loop_thread.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def __sleep(self, timeout: Optional[float] = None):
+        """Waits until timeout passed or the scheduler was notified"""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def execute(self, command: str) -> Tuple[int, str, str]:
+        """Executes a command via ssh and returns its exit code, stdout and stderr"""
+        pool = self.ssh.pool
+        channel = await run_blocking(self.ssh_executor, pool.release, pool.open_channel,
+                                     self.check_timeout)
+        ssh_connection = SshConnection(0, channel, None, pool.release,
+                                       OutputCapture(self.max_output),
+                                       OutputCapture(self.max_output))
+        try:
+            await run_blocking(self.ssh_executor, None, channel.exec_command, command)
+            await wait_done(ssh_connection)
+            return (channel.recv_exit_status(), ssh_connection.stdout.getvalue(),
+                    ssh_connection.stderr.getvalue())
+        except asyncio.CancelledError:
+            # Cancelled by the timeout of the check, the host did not answer in time
+            pool.report_error(channel, TimeoutError(f"Command cancelled: '{command}'"))
+            raise
+        finally:
+            ssh_connection.finalize()
+
+    async def __query(self, cluster: str, job_ids: list, limit: asyncio.Semaphore) -> Mapping:
+        """Queries slurm for the state of a chunk of job ids on a cluster"""
+        async with limit:
+            delay = self.scheduler.reserve()
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self.scheduler.reserve()
+            command = self.ssh.check_command(','.join(job_ids), cluster)
+            _, stdout, _ = await asyncio.wait_for(self.execute(command), self.check_timeout)
+        return self._parse_check(stdout)
+
+    async def __query_all(self, joblist: Mapping) -> Dict[str, Dict]:
+        """Queries all chunks of all clusters concurrently, see AsyncRunner"""
+        limit = asyncio.Semaphore(self.max_checks)
+        chunks = [(cluster, chunk) for cluster in joblist
+                  for chunk in chunk_list(joblist[cluster], self.chunk_size)]
+        outcomes = await asyncio.gather(*[self.__query(cluster, chunk, limit)
+                                          for cluster, chunk in chunks],
+                                        return_exceptions=True)
+        results: Dict[str, Dict] = {cluster: {} for cluster in joblist}
+        failed = set()
+        for (cluster, _), outcome in zip(chunks, outcomes):
+            if isinstance(outcome, asyncio.TimeoutError):
+                self.logger.error("Timeout in ssh.check_task for cluster '%s'", cluster)
+                failed.add(cluster)
+            elif isinstance(outcome, BaseException):
+                self.logger.error("Error in ssh.check_task for cluster '%s': '%s'",\
+                                  cluster, str(outcome))
+                failed.add(cluster)
+            else:
+                results[cluster].update(outcome)
+        self._count_errors(joblist, failed)
+        return results
+
+    async def __submit(self, submit, task, callback, phase):
+        try:
+            await run_blocking(self.ssh_executor, None, submit, task, callback)
+        except Exception as exception: #pylint: disable=broad-except
+            await asyncio.get_running_loop().run_in_executor(
+                self.db_executor, self._submit_failed, task, phase, exception)
+
+    def work(self):
+        """One iteration of the runner, executed on the event loop"""
+        self.loop_thread.submit(self.work_async()).result()
+
+    async def work_async(self):
+        """One iteration of the runner, see AsyncRunner.work"""
+        loop = asyncio.get_running_loop()
+        # Cleared along with the notify of the scheduler consumed by due
+        self.wakeup.clear()
+        await loop.run_in_executor(self.db_executor, self._refresh_index)
+        joblist = self.scheduler.due(self.index.snapshot())
+        results = await self.__query_all(joblist)
+        transitions = self._evaluate(joblist, results)
+        applied = await loop.run_in_executor(self.db_executor,
+                                             self.database.apply_transitions, transitions)
+        await asyncio.gather(*[self.__submit(*submit)
+                               for submit in self._next_phases(joblist, transitions, applied)])
+
+    async def __main(self):
+        i = 0
+        while True:
+            if not self.active.is_set():
+                # resume notifies the scheduler after activating the runner
+                self.wakeup.clear()
+                if not self.active.is_set():
+                    await self.__sleep()
+                continue
+            try:
+                await self.work_async()
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.exception("Iteration failed: '%s'", str(exception))
+            self.logger.info("Iteration: %d", i)
+            i += 1
+            timeout = self.scheduler.seconds_until_next()
+            if timeout is None or timeout > self.sleep_timer:
+                timeout = self.sleep_timer
+            await self.__sleep(timeout)
+
+    def run(self, active: bool = True):
+        """Starts the runner on the event loop, an inactive runner waits for resume"""
+        if active:
+            self.active.set()
+        self.future = self.loop_thread.submit(self.__main())
@@ -0,0 +1,94 @@
+"""In-memory index of the slurm jobs checked by the asynchronous runner
+
+    The index is seeded from the database and afterwards only the tasks reported by
+    the state listeners of the database are read again. Every state change gets a
+    sequence number, a database read started at sequence number seq is only applied
+    to tasks without a newer change, so a slow read cannot restore an outdated job.
+"""
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from papi.db import PollJob
+from papi.util import slurm_job_key
+
+class ActiveJobIndex:
+    """Active slurm jobs by cluster and job key (see slurm_job_key)
+
+        Parameters:
+            states: task states in which the job of a task is checked
+    """
+    def __init__(self, states: Iterable[str]):
+        self.states = set(states)
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, Dict[str, PollJob]] = {}
+        self.keys: Dict[int, Tuple[str, str]] = {}
+        self.changes: Dict[int, Tuple[int, str]] = {}
+        self.sequence = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.keys)
+
+    def __add(self, job: PollJob):
+        key = slurm_job_key(job.job_id, job.array_index)
+        self.jobs.setdefault(job.cluster, {})[key] = job
+        self.keys[job.task.id] = (job.cluster, key)
+
+    def __remove(self, task_id: int):
+        if task_id not in self.keys:
+            return
+        cluster, key = self.keys.pop(task_id)
+        del self.jobs[cluster][key]
+        if not self.jobs[cluster]:
+            del self.jobs[cluster]
+
+    def state_changed(self, task_id: int, state: str):
+        """Records a state change, tasks leaving the checked states are removed at once"""
+        with self.lock:
+            self.sequence += 1
+            self.changes[task_id] = (self.sequence, state)
+            if state not in self.states:
+                self.__remove(task_id)
+
+    def begin(self) -> int:
+        """Returns the sequence number to pass to apply for a database read started now"""
+        with self.lock:
+            return self.sequence
+
+    def changed_tasks(self) -> List[int]:
+        """Returns the tasks which changed to a checked state since they were read"""
+        with self.lock:
+            return [task_id for task_id, (_, state) in self.changes.items()
+                    if state in self.states]
+
+    def apply(self, jobs: List[PollJob], sequence: int, task_ids: Optional[List[int]] = None):
+        """Replaces the jobs of the given tasks by the result of a database read
+
+            Parameters:
+                jobs: active jobs as read from the database
+                sequence: result of begin before the read
+                task_ids: tasks the read was limited to, None if all tasks were read
+        """
+        with self.lock:
+            newer = {task_id for task_id, (change, _) in self.changes.items()
+                     if change > sequence}
+            if task_ids is None:
+                task_ids = list(self.keys)
+                self.changes = {task_id: self.changes[task_id] for task_id in newer}
+            else:
+                for task_id in task_ids:
+                    if task_id not in newer:
+                        self.changes.pop(task_id, None)
+                self.changes = {task_id: change for task_id, change in self.changes.items()
+                                if change[1] in self.states or task_id in newer}
+            for task_id in task_ids:
+                if task_id not in newer:
+                    self.__remove(task_id)
+            for job in jobs:
+                if job.task.id not in newer:
+                    self.__remove(job.task.id)
+                    self.__add(job)
+
+    def snapshot(self) -> Dict[str, Dict[str, PollJob]]:
+        """Returns a copy of the index as cluster -> job key -> job"""
+        with self.lock:
+            return {cluster: dict(jobs) for cluster, jobs in self.jobs.items()}
@@ -0,0 +1,102 @@
+"""This module contains the leader election of processes sharing one database
+
+    Several WSGI processes serve the same database. Only the process holding the lease
+    in the database runs the runner and submits tasks, the others only serve HTTP.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Mapping, Optional, Callable, List
+from papi.db import DB
+
+class LeaderElection:
+    """Holds a lease of the database as long as the process is alive
+
+        The lease is renewed every RENEW_INTERVAL seconds and expires after LEASE seconds,
+        so another process takes over within one lease period after the leader died.
+        The leader steps down on its own if it could not renew the lease for LEASE seconds,
+        before any other process can acquire it.
+    """
+
+    def __init__(self, database: DB, config: Optional[Mapping] = None):
+        """Constructor of the election
+
+            Parameters:
+                database: Database shared by all processes
+                config: election config dict (see CONFIG['PAPI']['ELECTION'])
+        """
+        config = config if config is not None else {}
+        self.database = database
+        self.name = config.get('NAME', 'poller')
+        self.lease = config.get('LEASE', 30)
+        self.renew_interval = config.get('RENEW_INTERVAL', self.lease / 3)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.logger = logging.getLogger('papi.async_runner.LeaderElection')
+        self.listeners: List[Callable[[bool], None]] = []
+        self.leader = False
+        self.valid_until = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.main_loop, daemon=True)
+
+    @property
+    def is_leader(self) -> bool:
+        """True while this process holds an unexpired lease"""
+        return self.leader and time.monotonic() < self.valid_until
+
+    def add_listener(self, callback: Callable[[bool], None]):
+        """Registers callback(leader) executed whenever the process gains or loses the lease"""
+        self.listeners.append(callback)
+
+    def __set_leader(self, leader: bool):
+        if leader == self.leader:
+            return
+        self.leader = leader
+        self.logger.info("Process '%s' %s the lease '%s'", self.owner,
+                         'acquired' if leader else 'lost', self.name)
+        for callback in self.listeners:
+            try:
+                callback(leader)
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("Leadership listener failed: '%s'", str(exception))
+
+    def try_acquire(self) -> bool:
+        """Acquires or renews the lease once and returns whether this process is the leader"""
+        started = time.monotonic()
+        try:
+            acquired = self.database.acquire_lease(self.name, self.owner, self.lease)
+        except Exception as exception: #pylint: disable=broad-except
+            self.logger.error("Renewing the lease '%s' failed: '%s'", self.name, str(exception))
+            acquired = False
+        if acquired:
+            # The lease counts from the database write, which happened after started
+            self.valid_until = started + self.lease
+        self.__set_leader(time.monotonic() < self.valid_until)
+        return self.leader
+
+    def main_loop(self):
+        """Renews the lease until stopped"""
+        while True:
+            self.try_acquire()
+            timeout = self.renew_interval
+            if self.leader:
+                # Step down at the latest when the lease expires without renewal
+                timeout = max(0.0, min(timeout, self.valid_until - time.monotonic()))
+            if self.stopped.wait(timeout):
+                break
+
+    def start(self):
+        """Starts the election thread"""
+        self.thread.start()
+
+    def stop(self):
+        """Stops the election and releases the lease for a fast takeover"""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.leader:
+            self.valid_until = 0.0
+            self.__set_leader(False)
+            self.database.release_lease(self.name, self.owner)
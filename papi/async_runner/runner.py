@@ -6,33 +6,69 @@
     Unfinished tasks are defined as tasks which have executed
     a slurm job which is not finished yet
 """
-from threading import Thread, Lock
-import time
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import socket
 import logging
-from typing import Mapping, Dict, Any
-from papi.util import parse_sacct_output, parse_slurm_output
+import time
+from typing import Mapping, Dict, Optional, List
+from papi.util import parse_sacct_output, parse_slurm_output, chunk_list, expand_array_job_ids
 from papi.ssh import Ssh
-from papi.db import SlurmJob, DB
+from papi.db import SlurmJob, DB, Transition
+from .scheduler import PollScheduler
+from .index import ActiveJobIndex
 
 mutex = Lock()
 
-def joblist_to_dict(joblist: list):
-    """Converts a list of jobs to a dict"""
-    parsed_list: Dict[str, Any] = {}
-    for job in joblist:
-        cluster_name = job.SlurmJob.cluster
-        if cluster_name not in parsed_list:
-            parsed_list[cluster_name] = {}
-        parsed_list[cluster_name][str(job.SlurmJob.job_id)] = job
-    return parsed_list
+# Task state of each pipeline phase and the state reached once its slurm job completed
+PHASE_TRANSITIONS = {
+    'running':      'executed',
+    'aggregating':  'archiving',
+    'archived':     'finished',
+    'pipelined':    'finished',
+}
+
+# Slurm job checked in each phase. Pipelined tasks queued all jobs with dependencies
+# at submit time, so only the archive job has to be checked for a terminal state.
+PHASE_JOB_TYPES = {
+    'running':      'main',
+    'aggregating':  'aggregation',
+    'archived':     'archive',
+    'pipelined':    'archive',
+}
+
+# Terminal slurm states of jobs which did not complete. Pipelined jobs are queued with
+# --kill-on-invalid-dep=yes, so a broken dependency chain shows up as CANCELLED.
+FAILED_STATES = ['FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'BOOT_FAIL',
+                 'DEADLINE']
 
 class AsyncRunner:
     """The main class for the asynchronous thread."""
-    def __init__(self, ssh: Ssh, database: DB, sleep_timer: int):
+    def __init__(self, ssh: Ssh, database: DB, sleep_timer: int, config: Optional[Mapping] = None):
+        """Constructor of the runner
+
+            Parameters:
+                ssh: Ssh object used for slurm queries
+                database: Database with the tasks to check
+                sleep_timer: Seconds between two iterations
+                config: runner config dict (see CONFIG['PAPI']['RUNNER'])
+        """
+        config = config if config is not None else {}
         self.ssh = ssh
         self.database = database
         self.sleep_timer = sleep_timer
+        self.check_timeout = config.get('CHECK_TIMEOUT', 10)
+        self.chunk_size = config.get('CHECK_CHUNK_SIZE', 200)
+        self.executor = ThreadPoolExecutor(max_workers=config.get('CHECK_WORKERS', 8),
+                                           thread_name_prefix='SlurmCheck')
+        self.check_errors: Dict[str, int] = {}
+        self.scheduler = PollScheduler(config.get('SCHEDULER'))
+        self.index = ActiveJobIndex(PHASE_JOB_TYPES)
+        self.reseed_interval = config.get('RESEED_INTERVAL', 300)
+        self.last_seed: Optional[float] = None
+        self.journal_seq = 0
+        self.journal_limit = config.get('JOURNAL_LIMIT', 1000)
+        self.database.add_state_listener(self.__state_changed)
 
         logging.basicConfig(filename="/var/log/papi/async.log",
                             format='%(asctime)s %(message)s',
@@ -40,45 +76,196 @@ class AsyncRunner:
 
         self.logger = logging.getLogger('papi.async_runner')
         self.thread = Thread(target=self.main_loop)
+        self.active = Event()
+
+    def __state_changed(self, task_id: int, state: str):
+        """State listener registered on the database, wakes the runner for new slurm jobs"""
+        if not self.active.is_set():
+            return
+        self.index.state_changed(task_id, state)
+        if state in PHASE_TRANSITIONS:
+            self.scheduler.notify()
+
+    def __read_journal(self):
+        """Records the journal entries after the last one read as changes in the index
+
+            Picks up tasks changed by other processes. Changes of this process are read
+            again, which only repeats the read of their jobs.
+        """
+        while True:
+            entries = self.database.get_transitions(since=self.journal_seq,
+                                                    limit=self.journal_limit)
+            for entry in entries:
+                self.index.state_changed(entry.task_id, entry.new_state)
+                self.journal_seq = entry.seq
+            if len(entries) < self.journal_limit:
+                return
+
+    def _refresh_index(self):
+        """Reads the jobs of changed tasks, all jobs at start and every reseed_interval seconds
+
+            Changes of other processes are read from the journal first, so they are older
+            than the read of the jobs. The periodic reseed is a fallback only.
+        """
+        now = time.monotonic()
+        if self.last_seed is None or now - self.last_seed >= self.reseed_interval:
+            self.journal_seq = self.database.get_last_transition_seq()
+            sequence = self.index.begin()
+            self.index.apply(self.database.get_poll_jobs(PHASE_JOB_TYPES), sequence)
+            self.last_seed = now
+            self.logger.info("Seeded index with %d active jobs", len(self.index))
+            return
+        self.__read_journal()
+        sequence = self.index.begin()
+        task_ids = self.index.changed_tasks()
+        if task_ids:
+            jobs = self.database.get_poll_jobs(PHASE_JOB_TYPES, task_ids=task_ids)
+            self.index.apply(jobs, sequence, task_ids)
+
+    @staticmethod
+    def _parse_check(output: str) -> Mapping:
+        """Returns the sacct output of a check command by job id"""
+        return expand_array_job_ids(parse_sacct_output(output))
+
+    def __query(self, cluster: str, job_ids: list) -> Mapping:
+        """Queries slurm for the state of a chunk of job ids on a cluster"""
+        self.scheduler.acquire()
+        csl = ','.join(job_ids)
+        return self._parse_check(self.ssh.check_task(csl, cluster, timeout=self.check_timeout))
 
-    def __check_tasklist(self, joblist: Mapping, next_state: str):
+    def __query_all(self, joblist: Mapping) -> Dict[str, Dict]:
+        """Queries all clusters in parallel, split into chunks of at most chunk_size job ids
+
+            A failing chunk only drops the results of this chunk. The number of consecutive
+            failed iterations per cluster is kept in check_errors.
+        """
+        futures = {}
         for cluster in joblist:
-            csl = ','.join(list(joblist[cluster]))
+            for chunk in chunk_list(joblist[cluster], self.chunk_size):
+                futures[self.executor.submit(self.__query, cluster, chunk)] = cluster
+
+        results: Dict[str, Dict] = {cluster: {} for cluster in joblist}
+        failed = set()
+        for future in as_completed(futures):
+            cluster = futures[future]
             try:
-                res = parse_sacct_output(self.ssh.check_task(csl, cluster, timeout=10))
+                results[cluster].update(future.result())
             except socket.timeout:
-                self.logger.error("Timeout in ssh.check_task")
-                return
-            for job in res:
-                task = joblist[cluster][str(job)].Task
-                state = str(res[job]['State'])
+                self.logger.error("Timeout in ssh.check_task for cluster '%s'", cluster)
+                failed.add(cluster)
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("Error in ssh.check_task for cluster '%s': '%s'",\
+                                  cluster, str(exception))
+                failed.add(cluster)
+        self._count_errors(joblist, failed)
+        return results
+
+    def _count_errors(self, joblist: Mapping, failed: set):
+        """Counts the consecutive iterations with failed checks of every cluster"""
+        for cluster in joblist:
+            if cluster in failed:
+                self.check_errors[cluster] = self.check_errors.get(cluster, 0) + 1
+                self.logger.warning("Check of cluster '%s' failed %d times in a row",\
+                                    cluster, self.check_errors[cluster])
+            else:
+                self.check_errors[cluster] = 0
+
+    def __check_tasklist(self, joblist: Mapping):
+        """Queries the state of all due jobs in joblist
+
+            Each job is moved to the next state of the phase its task is in. All state
+            changes of the iteration are stored in one transaction before the next phases
+            of the applied transitions are submitted.
+        """
+        joblist = self.scheduler.due(joblist)
+        results = self.__query_all(joblist)
+        transitions = self._evaluate(joblist, results)
+        applied = self.database.apply_transitions(transitions)
+        for submit, task, callback, phase in self._next_phases(joblist, transitions, applied):
+            try:
+                submit(task, callback)
+            except Exception as exception: #pylint: disable=broad-except
+                self._submit_failed(task, phase, exception)
+
+    def _evaluate(self, joblist: Mapping, results: Mapping) -> List[Transition]:
+        """Returns the transitions of the jobs of joblist by the slurm states in results
+
+            Updates the schedule of every checked job. The transitions only apply if the task
+            is still in the phase of its job.
+        """
+        transitions: List[Transition] = []
+        for cluster in joblist:
+            res = results[cluster]
+            for job in joblist[cluster]:
+                if job not in res:
+                    self.scheduler.retry((cluster, job))
+                    continue
+                poll_job = joblist[cluster][job]
+                task = poll_job.task
+                phase = poll_job.state
+                # sacct reports e.g. 'CANCELLED by 1234'
+                state = str(res[job]['State']).split(' ')[0]
                 task_id = task.id
+                next_state = PHASE_TRANSITIONS[phase]
 
                 self.logger.info("Task '%s' has state '%s'", str(job), str(state))
                 if state == 'COMPLETED':
-                    self.database.set_task_state(task_id, next_state)
-                    if next_state == 'executed':
-                        self.logger.info("Start Collecting")
-                        self.ssh.collect_task(task, self.collect_callback)
-                    elif next_state == 'archiving':
-                        self.logger.info("Start Archviing")
-                        self.ssh.archive_task(task, self.archive_callback)
-                elif state == 'FAILED':
-                    self.database.set_task_state(task_id, 'failed')
+                    self.scheduler.complete((cluster, job), phase, res[job])
+                    transitions.append(Transition(task_id, next_state, job_id=poll_job.job_id,
+                                                  expected_state=phase))
+                elif state in FAILED_STATES:
+                    self.scheduler.complete((cluster, job), phase, res[job])
+                    transitions.append(Transition(task_id, 'failed', job_id=poll_job.job_id,
+                                                  expected_state=phase))
                 elif state in ['RUNNING', 'PENDING']:
-                    pass
+                    self.scheduler.update((cluster, job), phase, res[job])
                 else:
+                    self.scheduler.retry((cluster, job))
                     self.logger.error("Unknown State: '%s' for task '%s'", str(state), str(job))
+        return transitions
+
+    def _next_phases(self, joblist: Mapping, transitions: List[Transition],
+                     applied: List[int]) -> list:
+        """Returns (ssh method, task, callback, phase) of the jobs to submit after transitions
+
+            Only transitions of tasks in applied are considered, a skipped transition was
+            outdated. phase is the state the task returns to if the submission fails.
+        """
+        tasks = {job.task.id: job.task for jobs in joblist.values() for job in jobs.values()}
+        applied_ids = set(applied)
+        submits = []
+        for transition in transitions:
+            if transition.task_id not in applied_ids:
+                continue
+            if transition.state == 'executed':
+                self.logger.info("Start Collecting")
+                submits.append((self.ssh.collect_task, tasks[transition.task_id],
+                                self.collect_callback, 'running'))
+            elif transition.state == 'archiving':
+                self.logger.info("Start Archviing")
+                submits.append((self.ssh.archive_task, tasks[transition.task_id],
+                                self.archive_callback, 'aggregating'))
+        return submits
 
-    def __work(self):
-        joblist = self.database.get_tasks_by_state('running', successful_only=True)
-        self.__check_tasklist(joblist_to_dict(joblist), 'executed')
+    def _submit_failed(self, task, phase: str, exception: Exception):
+        """Returns a task whose next phase could not be submitted to its completed phase
 
-        joblist = self.database.get_tasks_by_state('aggregating', successful_only=True)
-        self.__check_tasklist(joblist_to_dict(joblist), 'archiving')
+            The job of the phase is checked again in the next iteration, which retries the
+            submission once it is found completed.
+        """
+        self.logger.error("Submitting next phase of task '%s' failed, back to '%s': '%s'",\
+                          str(task.id), phase, str(exception))
+        try:
+            self.database.apply_transitions([Transition(
+                task.id, phase, expected_state=PHASE_TRANSITIONS[phase])])
+        except Exception as error: #pylint: disable=broad-except
+            self.logger.error("Returning task '%s' to '%s' failed: '%s'",\
+                              str(task.id), phase, str(error))
 
-        joblist = self.database.get_tasks_by_state('archived', successful_only=True)
-        self.__check_tasklist(joblist_to_dict(joblist), 'finished')
+    def work(self):
+        """One iteration: reads changed jobs and checks the jobs which are due"""
+        self._refresh_index()
+        self.__check_tasklist(self.index.snapshot())
 
     def collect_callback(self, return_value: int, stdout: str, stderr: str, task_id: int):
         """Callback as registered on the sshReader
@@ -103,10 +290,11 @@ class AsyncRunner:
                              "Running on cluster '%s' with id '%d'",\
                              task_id, str(cluster), slurm_job_id)
 
-        self.database.add_slurm_job(SlurmJob(job_id=slurm_job_id, cluster=cluster,\
-                                    job_type='aggregation', ssh_rc=return_value,\
-                                    ssh_stdout=stdout, ssh_stderr=stderr, task_id=task_id))
-        self.database.set_task_state(task_id, 'aggregating')
+        job = SlurmJob(job_id=slurm_job_id, cluster=cluster, job_type='aggregation',
+                       ssh_rc=return_value, ssh_stdout=stdout, ssh_stderr=stderr, task_id=task_id)
+        state = 'failed' if slurm_job_id == -1 else 'aggregating'
+        self.database.apply_transitions([Transition(task_id, state, job,
+                                                    expected_state='executed')])
 
     def archive_callback(self, return_value: int, stdout: str, stderr: str, task_id: int):
         """Callback as registered on the sshReader
@@ -131,25 +319,48 @@ class AsyncRunner:
                              "Running on cluster '%s' with id '%d'",\
                              task_id, str(cluster), slurm_job_id)
 
-        self.database.add_slurm_job(SlurmJob(job_id=slurm_job_id, cluster=cluster,\
-                                    job_type='archive', ssh_rc=return_value,\
-                                    ssh_stdout=stdout, ssh_stderr=stderr, task_id=task_id))
-        self.database.set_task_state(task_id, 'archived')
+        job = SlurmJob(job_id=slurm_job_id, cluster=cluster, job_type='archive',
+                       ssh_rc=return_value, ssh_stdout=stdout, ssh_stderr=stderr, task_id=task_id)
+        state = 'failed' if slurm_job_id == -1 else 'archived'
+        self.database.apply_transitions([Transition(task_id, state, job,
+                                                    expected_state='archiving')])
 
 
     def main_loop(self):
-        """Thread Waitloop"""
+        """Thread Waitloop
+
+            Sleeps until the next job is due, a new job is registered or at most sleep_timer
+            seconds. Jobs registered by other processes are seen after the next reseed.
+        """
         i = 0
         while True:
+            self.active.wait()
             mutex.acquire()
             try:
-                self.__work()
+                self.work()
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.exception("Iteration failed: '%s'", str(exception))
             finally:
                 mutex.release()
             self.logger.info(f"Iteration: {i}")
             i += 1
-            time.sleep(self.sleep_timer)
+            timeout = self.scheduler.seconds_until_next()
+            if timeout is None or timeout > self.sleep_timer:
+                timeout = self.sleep_timer
+            self.scheduler.wait(timeout)
 
-    def run(self):
-        """Starts the thread instance"""
+    def run(self, active: bool = True):
+        """Starts the thread instance, an inactive runner waits for resume"""
+        if active:
+            self.active.set()
         self.thread.start()
+
+    def resume(self):
+        """Starts checking jobs again, the index is seeded from the database first"""
+        self.last_seed = None
+        self.active.set()
+        self.scheduler.notify()
+
+    def pause(self):
+        """Stops checking jobs after the current iteration"""
+        self.active.clear()
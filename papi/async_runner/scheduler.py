@@ -0,0 +1,141 @@
+"""Adaptive poll scheduler for the asynchronous runner
+
+    Every slurm job gets its own next check time. Jobs which stay PENDING or RUNNING
+    are checked less often with every check, jobs close to the finish time expected for
+    their phase are checked sooner. The expected duration of a phase is learned from the
+    Elapsed field of completed jobs.
+"""
+import threading
+import time
+from typing import Mapping, Dict, Tuple, Optional, List, Callable
+from papi.util import parse_slurm_duration
+
+JobKey = Tuple[str, str]
+
+class PollScheduler:
+    """Keeps track of the next check time of every active slurm job
+
+        Parameters:
+            config: scheduler config dict (see CONFIG['PAPI']['SCHEDULER'])
+    """
+    def __init__(self, config: Optional[Mapping] = None):
+        config = config if config is not None else {}
+        self.min_interval = config.get('MIN_INTERVAL', 2)
+        self.max_interval = config.get('MAX_INTERVAL', 600)
+        self.backoff = config.get('BACKOFF', 2.0)
+        self.learning_rate = config.get('LEARNING_RATE', 0.3)
+        self.max_query_rate = config.get('MAX_QUERY_RATE', 0)
+        self.next_check: Dict[JobKey, float] = {}
+        self.intervals: Dict[JobKey, float] = {}
+        self.expected: Dict[str, float] = {}
+        self.wakeup = threading.Event()
+        self.listeners: List[Callable[[], None]] = []
+        self.rate_lock = threading.Lock()
+        self.tokens = float(self.max_query_rate)
+        self.last_refill = time.monotonic()
+
+    def due(self, joblist: Mapping) -> Dict[str, Dict]:
+        """Filters a joblist (cluster -> job id -> job) to the jobs which have to be checked now
+
+            Jobs seen for the first time are due immediately, jobs missing
+            in joblist are no longer tracked. Consumes the pending notify, so a notify
+            arriving from here on wakes up the following wait.
+        """
+        self.wakeup.clear()
+        now = time.monotonic()
+        active = set()
+        due: Dict[str, Dict] = {}
+        for cluster in joblist:
+            for job_id in joblist[cluster]:
+                key = (cluster, job_id)
+                active.add(key)
+                if self.next_check.get(key, now) <= now:
+                    due.setdefault(cluster, {})[job_id] = joblist[cluster][job_id]
+        for key in set(self.next_check) - active:
+            self.forget(key)
+        return due
+
+    def seconds_until_next(self) -> Optional[float]:
+        """Returns the seconds until the next job is due or None if no job is tracked"""
+        if not self.next_check:
+            return None
+        return max(0.0, min(self.next_check.values()) - time.monotonic())
+
+    def __schedule(self, key: JobKey, interval: float):
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self.intervals[key] = interval
+        self.next_check[key] = time.monotonic() + interval
+
+    def retry(self, key: JobKey):
+        """Schedules a job whose check failed or returned no result"""
+        self.__schedule(key, self.intervals.get(key, self.min_interval))
+
+    def update(self, key: JobKey, phase: str, sacct_row: Mapping):
+        """Schedules the next check of a PENDING or RUNNING job
+
+            Parameters:
+                key: (cluster, job id) of the job
+                phase: Task state of the phase the job belongs to
+                sacct_row: Parsed sacct output of the job
+        """
+        interval = self.intervals.get(key, self.min_interval / self.backoff) * self.backoff
+        elapsed = parse_slurm_duration(sacct_row.get('Elapsed', ''))
+        if sacct_row.get('State') == 'RUNNING' and phase in self.expected and elapsed is not None:
+            remaining = self.expected[phase] - elapsed
+            if remaining > 0:
+                interval = min(interval, remaining)
+        self.__schedule(key, interval)
+
+    def complete(self, key: JobKey, phase: str, sacct_row: Mapping):
+        """Stops tracking a job in a terminal state and learns the duration of its phase"""
+        elapsed = parse_slurm_duration(sacct_row.get('Elapsed', ''))
+        if sacct_row.get('State') == 'COMPLETED' and elapsed is not None:
+            if phase in self.expected:
+                self.expected[phase] += self.learning_rate * (elapsed - self.expected[phase])
+            else:
+                self.expected[phase] = elapsed
+        self.forget(key)
+
+    def forget(self, key: JobKey):
+        """Stops tracking a job"""
+        self.next_check.pop(key, None)
+        self.intervals.pop(key, None)
+
+    def add_listener(self, listener: Callable[[], None]):
+        """Registers a function called on every notify, e. g. to wake up an event loop"""
+        self.listeners.append(listener)
+
+    def notify(self):
+        """Wakes up the runner, e. g. after a new job was registered"""
+        self.wakeup.set()
+        for listener in self.listeners:
+            listener()
+
+    def wait(self, timeout: float):
+        """Sleeps until timeout passed or notify was called since the last call of due"""
+        self.wakeup.wait(timeout)
+
+    def reserve(self) -> float:
+        """Takes a query of the global query rate limit
+
+            Returns 0 if the query is allowed, otherwise the seconds until the next try.
+        """
+        if not self.max_query_rate:
+            return 0
+        with self.rate_lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.max_query_rate),
+                              self.tokens + (now - self.last_refill) * self.max_query_rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.max_query_rate
+
+    def acquire(self):
+        """Blocks until a query is allowed by the global query rate limit"""
+        while True:
+            delay = self.reserve()
+            if not delay:
+                return
+            time.sleep(delay)
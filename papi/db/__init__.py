@@ -1,2 +1,3 @@
 """Default imports for papi.db"""
-from .db import DB, SlurmJob
+from .db import (DB, SlurmJob, TaskGroup, TaskCache, PollJob, Transition, TaskTransition,
+                 Lease)
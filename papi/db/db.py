@@ -1,12 +1,42 @@
 """Database interface class and table definition classes"""
 import logging
+from collections import namedtuple
+from typing import List, Callable, Mapping, Tuple, Dict, Any, NamedTuple, Optional
+from datetime import datetime, timedelta
 from werkzeug.datastructures import ImmutableDict
-from sqlalchemy import Column, Integer, String, ForeignKey, create_engine, Boolean
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import (Column, Integer, String, ForeignKey, create_engine, Boolean, DateTime,
+                        Index, func, event, and_, or_, inspect)
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.orm import sessionmaker, aliased
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import scoped_session
-from papi.exceptions import NonExistingTaskEntryError
+from papi.exceptions import NonExistingTaskEntryError, ExpansionConflictError
+from papi.util import chunk_list
 from .db_init import Base
+from .migrations import migrate
+
+class TaskGroup(Base):
+    #pylint: disable=too-few-public-methods
+    """Database table with groups of tasks
+
+    A group holds all tasks submitted by a single batch request. The tasks of a sweep
+    are added later by expanding the grid stored in params, expanded counts the grid
+    points stored so far. complete is set once all of them are stored, error holds the
+    reason the last expansion stopped.
+    """
+    __tablename__ = 'task_groups'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, default='batch')
+    size = Column(Integer, default=0)
+    created = Column(DateTime, default=datetime.utcnow)
+    params = Column(String)
+    expanded = Column(Integer, nullable=False, default=0)
+    complete = Column(Boolean, nullable=False, default=True)
+    error = Column(String)
+
+    def __repr__(self):
+        return f"<TaskGroup(kind='{self.kind}', size='{self.size}')>"
 
 class Task(Base):
     #pylint: disable=too-few-public-methods
@@ -15,9 +45,17 @@ class Task(Base):
     A tasks is a single submit request to the API
     """
     __tablename__ = 'tasks'
+    __table_args__ = (Index('ix_tasks_state', 'state'),
+                      Index('ix_tasks_group_id', 'group_id'))
     id = Column(Integer, primary_key=True)
     state = Column(String, default='queued')
     debug = Column(Boolean, default=False)
+    group_id = Column(Integer, ForeignKey('task_groups.id'), nullable=True)
+    # Incremented on every change of the state or the slurm jobs, used as ETag
+    revision = Column(Integer, nullable=False, default=0, server_default='0')
+    # Dispatcher which moved the task to 'submitting' and when
+    claimed_by = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
 
     def __repr__(self):
         return "<Task(state='%s')>" % (self.state)
@@ -29,6 +67,8 @@ class SlurmJob(Base):
         A slurm job should always be associated with a task
     """
     __tablename__ = 'slurm_jobs'
+    __table_args__ = (Index('ix_slurm_jobs_task_id_job_type', 'task_id', 'job_type'),
+                      Index('ix_slurm_jobs_cluster_job_id', 'cluster', 'job_id'))
     id = Column(Integer, primary_key=True)
     job_id = Column(Integer)
     cluster = Column(String)
@@ -37,27 +77,180 @@ class SlurmJob(Base):
     ssh_stdout = Column(String)
     ssh_stderr = Column(String)
     task_id = Column(Integer, ForeignKey('tasks.id'))
+    array_index = Column(Integer, nullable=True)
 
     def __repr__(self):
         return (f"<SlurmJob(type='{self.job_type}', job_id='{self.job_id}',"
-                f"cluster='{self.cluster}', rc='{self.ssh_rc}')>")
+                f"array_index='{self.array_index}', cluster='{self.cluster}', rc='{self.ssh_rc}')>")
+
+class TaskCache(Base):
+    #pylint: disable=too-few-public-methods
+    """Database table mapping parameter fingerprints to the task computing their result
+
+        Tasks with identical parameters share one entry, so repeated submits attach
+        to the existing task instead of running the simulation again
+    """
+    __tablename__ = 'task_cache'
+    fingerprint = Column(String, primary_key=True)
+    task_id = Column(Integer, ForeignKey('tasks.id'), nullable=False)
+    created = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<TaskCache(fingerprint='{self.fingerprint}', task_id='{self.task_id}')>"
+
+class TaskTransition(Base):
+    #pylint: disable=too-few-public-methods
+    """Database table with the append-only journal of task state changes
+
+        seq is strictly increasing and never reused, so it can be used as cursor
+    """
+    __tablename__ = 'task_transitions'
+    __table_args__ = (Index('ix_task_transitions_task_id', 'task_id'),
+                      {'sqlite_autoincrement': True})
+    seq = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey('tasks.id'), nullable=False)
+    old_state = Column(String, nullable=True)
+    new_state = Column(String, nullable=False)
+    job_id = Column(Integer, nullable=True)
+    created = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return (f"<TaskTransition(seq='{self.seq}', task_id='{self.task_id}', "
+                f"'{self.old_state}' -> '{self.new_state}')>")
+
+class Lease(Base):
+    #pylint: disable=too-few-public-methods
+    """Database table with leases of roles held by a single process at a time
+
+        A lease is held by owner until expires and has to be renewed before
+    """
+    __tablename__ = 'leases'
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<Lease(name='{self.name}', owner='{self.owner}', expires='{self.expires}')>"
+
+class PollJob(NamedTuple):
+    """Slurm job of the current phase of an active task as returned by DB.get_poll_jobs
+
+        task holds the task id and the parameter columns of the task, so it can be
+        passed to get_param_from_task and the ssh commands instead of a Task object.
+    """
+    task: Any
+    state: str
+    job_id: int
+    array_index: Optional[int]
+    cluster: str
+
+class Transition(NamedTuple):
+    """State change of a task applied by DB.apply_transitions
+
+        slurm_job is an optional new slurm job of the task stored in the same transaction,
+        job_id the slurm job causing the transition, which defaults to the id of slurm_job.
+        With expected_state the transition is only applied if the task is still in this state.
+    """
+    task_id: int
+    state: str
+    slurm_job: Optional[SlurmJob] = None
+    job_id: Optional[int] = None
+    expected_state: Optional[str] = None
+
+    @property
+    def cause(self) -> Optional[int]:
+        """The slurm job causing the transition for the journal"""
+        if self.job_id is None and self.slurm_job is not None:
+            return self.slurm_job.job_id
+        return self.job_id
+
+# Max. number of ids bound in a single IN clause, the default sqlite variable limit
+MAX_IN_SIZE = 999
+
+def task_params_type(param_fields: Tuple[str, ...]) -> Any:
+    """Returns the named tuple of the id and the parameter columns of a task"""
+    return namedtuple('TaskParams', ('id',) + param_fields)
 
 class DB:
     """Interface class for database related stuff"""
 
+    # Columns of the tasks table needed by get_param_from_task
+    param_fields: Tuple[str, ...] = ()
+    # Mapped class of the tasks table including the parameter columns of the use case
+    task_model: Any = Task
+
     def __init__(self, config: ImmutableDict):
         self.config = config
         self.logger = logging.getLogger('papi.db')
         self.db_file = self.config['BASE_DIR'] + self.config['FILENAME']
         self.logger.info(f'Opening db File {self.db_file}')
         self.session = self.__session()
+        self.task_params = task_params_type(self.param_fields)
+        self.state_listeners: List[Callable[[int, str], None]] = []
+        self.job_listeners: List[Callable[[int], None]] = []
+
+    def __set_pragmas(self, dbapi_connection, connection_record):
+        """Configures every new sqlite connection of the engine"""
+        #pylint: disable=unused-argument
+        cursor = dbapi_connection.cursor()
+        if self.config.get('JOURNAL_MODE'):
+            cursor.execute(f"PRAGMA journal_mode = {self.config['JOURNAL_MODE']}")
+        if self.config.get('SYNCHRONOUS'):
+            cursor.execute(f"PRAGMA synchronous = {self.config['SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA mmap_size = {int(self.config.get('MMAP_SIZE', 0))}")
+        cursor.close()
+
+    def __create_engine(self):
+        """Creates the engine, connections are kept open in a pool unless POOL_SIZE is 0"""
+        connect_args = {'timeout': self.config.get('BUSY_TIMEOUT', 5)}
+        pool_size = self.config.get('POOL_SIZE', 0)
+        if pool_size:
+            connect_args['check_same_thread'] = False
+            engine = create_engine(f'sqlite:////{self.db_file}', echo=False,
+                                   connect_args=connect_args, poolclass=QueuePool,
+                                   pool_size=pool_size,
+                                   max_overflow=self.config.get('MAX_OVERFLOW', 10),
+                                   pool_timeout=self.config.get('POOL_TIMEOUT', 30))
+        else:
+            engine = create_engine(f'sqlite:////{self.db_file}', echo=False,
+                                   connect_args=connect_args, poolclass=NullPool)
+        event.listen(engine, 'connect', self.__set_pragmas)
+        return engine
 
     def __session(self):
-        engine = create_engine(f'sqlite:////{self.db_file}', echo=False)
+        engine = self.__create_engine()
         Base.metadata.create_all(engine)
+        self.logger.info("Database schema version %d", migrate(engine))
         session_factory = sessionmaker(bind=engine)
         return scoped_session(session_factory)
 
+    def add_state_listener(self, listener: Callable[[int, str], None]):
+        """Registers a function called with task id and state after a task state changed"""
+        self.state_listeners.append(listener)
+
+    def _notify_state_listeners(self, task_id: int, state: str):
+        for listener in self.state_listeners:
+            try:
+                listener(task_id, state)
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("State listener failed for task '%s': '%s'",\
+                                  str(task_id), str(exception))
+
+    def add_job_listener(self, listener: Callable[[int], None]):
+        """Registers a function called with the task id after a slurm job of the task was added
+
+            Jobs stored together with a state change only notify the state listeners
+        """
+        self.job_listeners.append(listener)
+
+    def _notify_job_listeners(self, task_id: int):
+        for listener in self.job_listeners:
+            try:
+                listener(task_id)
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("Job listener failed for task '%s': '%s'",\
+                                  str(task_id), str(exception))
+
     def _add_and_commit(self, obj):
         session = self.session()
         session.add(obj)
@@ -66,6 +259,26 @@ class DB:
         self.session.remove()
         return obj
 
+    @staticmethod
+    def _journal(session, entries: List[Tuple[int, Optional[str], str, Optional[int]]]):
+        """Appends (task id, old state, new state, slurm job id) entries to the journal
+
+            The entries are written in the transaction of session
+        """
+        if not entries:
+            return
+        now = datetime.utcnow()
+        session.execute(inspect(TaskTransition).local_table.insert(),
+                        [{'task_id': task_id, 'old_state': old_state, 'new_state': new_state,
+                          'job_id': job_id, 'created': now}
+                         for task_id, old_state, new_state, job_id in entries])
+
+    @staticmethod
+    def _get_states(session, task_ids: List[int]) -> Dict[int, str]:
+        """Returns the current state of the given tasks within session"""
+        return dict(row for chunk in chunk_list(task_ids, MAX_IN_SIZE)
+                    for row in session.query(Task.id, Task.state).filter(Task.id.in_(chunk)))
+
     def get_task(self, task_id: int):
         """Get a single task by id
 
@@ -73,7 +286,7 @@ class DB:
         such tasks exists in the database
         """
         session = self.session()
-        query = session.query(Task).filter_by(id=task_id)
+        query = session.query(self.task_model).filter_by(id=task_id)
         try:
             res = query.one()
             self.session.remove()
@@ -90,29 +303,440 @@ class DB:
             state: limit query to a state.
             successful_only: Only query jobs which where successfully scheduled
         """
+        task_model = self.task_model
         session = self.session()
-        query = session.query(Task, SlurmJob).\
-                filter(Task.id == SlurmJob.task_id).\
-                filter(Task.state == state)
+        query = session.query(task_model, SlurmJob).\
+                filter(task_model.id == SlurmJob.task_id).\
+                filter(task_model.state == state)
         if successful_only:
             query = query.filter(SlurmJob.job_id != -1)
         res = query.all()
         self.session.remove()
         return res
 
+    def get_poll_jobs(self, phase_job_types: Mapping[str, str],
+                      task_ids: Optional[List[int]] = None) -> List[PollJob]:
+        """Returns the slurm job of the current phase of every active task
+
+            Only the latest successfully submitted job of the job type belonging to the
+            state of the task is returned, e. g. the aggregation job of an aggregating task
+            but not its completed main job. Only the columns needed to query slurm and to
+            submit the next phase are loaded.
+
+            Parameters:
+                phase_job_types: job type checked for each task state
+                task_ids: limits the query to these tasks
+        """
+        if not phase_job_types or task_ids == []:
+            return []
+        session = self.session()
+        table = inspect(Task).local_table
+        latest_job = aliased(SlurmJob)
+        latest_id = session.query(func.max(latest_job.id)).\
+                filter(latest_job.task_id == SlurmJob.task_id).\
+                filter(latest_job.job_type == SlurmJob.job_type).\
+                filter(latest_job.job_id != -1).\
+                correlate(SlurmJob).as_scalar()
+        query = session.query(table.c.id, table.c.state, SlurmJob.job_id, SlurmJob.array_index,
+                              SlurmJob.cluster, *[table.c[field] for field in self.param_fields]).\
+                filter(table.c.id == SlurmJob.task_id).\
+                filter(table.c.state.in_(list(phase_job_types))).\
+                filter(or_(*[and_(table.c.state == state, SlurmJob.job_type == job_type)
+                             for state, job_type in phase_job_types.items()])).\
+                filter(SlurmJob.id == latest_id)
+        if task_ids is None:
+            rows = query.all()
+        else:
+            rows = [row for chunk in chunk_list(task_ids, MAX_IN_SIZE)
+                    for row in query.filter(table.c.id.in_(chunk))]
+        res = [PollJob(task=self.task_params(row[0], *row[5:]), state=row[1], job_id=row[2],
+                       array_index=row[3], cluster=row[4]) for row in rows]
+        self.session.remove()
+        return res
+
     def get_param_from_task(self, task):
         """Default implementation of get_param_from_task"""
         #pylint: disable=no-self-use
         self.logger.warning("get_param_from_task for %s NYI", str(task))
 
+    def create_task(self, payload, debug=False):
+        """Creates a new task object for a payload without storing it
+
+            Parameters:
+                payload: Payload send via JSON in HTTP request
+        """
+        #pylint: disable=unused-argument
+        return Task(debug=debug)
+
     def add_task(self, payload, debug=False):
         """ Add task to database
 
             Parameters:
                 payload: Payload send via JSON in HTTP request
         """
-        task = Task(debug=debug)
-        return self._add_and_commit(task)
+        session = self.session()
+        task = self.create_task(payload, debug=debug)
+        session.add(task)
+        session.flush()
+        self._journal(session, [(task.id, None, task.state, None)])
+        session.commit()
+        session.refresh(task)
+        self.session.remove()
+        return task
+
+    def task_fingerprint(self, payload) -> Optional[str]:
+        """Returns a fingerprint of the parameters of a payload or None if results
+        can not be reused. The default implementation disables caching."""
+        #pylint: disable=unused-argument
+        return None
+
+    def __get_cached_task(self, session, fingerprint: str, ttl):
+        """Returns the cached task of a fingerprint
+
+            Entries of failed tasks, of unfinished tasks without live slurm job and
+            entries older than ttl seconds are evicted. Queued and submitting tasks
+            without any slurm job are waiting for their submission and stay cached.
+        """
+        entry = session.query(TaskCache).filter_by(fingerprint=fingerprint).one_or_none()
+        if entry is None:
+            return None
+        task = session.query(Task).filter_by(id=entry.task_id).one_or_none()
+        expired = ttl and entry.created < datetime.utcnow() - timedelta(seconds=ttl)
+        if task is not None and task.state not in ('finished', 'failed'):
+            jobs = session.query(SlurmJob.job_id).filter(SlurmJob.task_id == task.id).all()
+            live = any(job.job_id != -1 for job in jobs)
+            if not live and (jobs or task.state not in ('queued', 'submitting')):
+                self.logger.warning("Evict cache entry of task '%s' in state '%s' without "
+                                    "live slurm job", str(task.id), task.state)
+                task = None
+        if task is None or task.state == 'failed' or expired:
+            session.delete(entry)
+            session.commit()
+            return None
+        return task
+
+    def add_task_cached(self, payload, ttl=None, bypass=False) -> Tuple[Any, bool]:
+        """Adds a task unless a finished or in-flight task with the same parameters exists
+
+            Parameters:
+                payload: Payload send via JSON in HTTP request
+                ttl: Seconds a cache entry is valid, None keeps entries forever
+                bypass: Always add a new task, which replaces the cache entry
+
+            Returns:
+                (task, True) for a new task or (existing task, False)
+        """
+        # Subclasses override task_fingerprint, only the default returns None
+        fingerprint = self.task_fingerprint(payload) #pylint: disable=assignment-from-none
+        if fingerprint is None:
+            return self.add_task(payload), True
+        session = self.session()
+        try:
+            if bypass:
+                session.query(TaskCache).filter_by(fingerprint=fingerprint).delete()
+            else:
+                cached = self.__get_cached_task(session, fingerprint, ttl)
+                if cached is not None:
+                    return cached, False
+            task = self.create_task(payload)
+            session.add(task)
+            session.flush()
+            self._journal(session, [(task.id, None, task.state, None)])
+            session.add(TaskCache(fingerprint=fingerprint, task_id=task.id))
+            session.commit()
+            session.refresh(task)
+            return task, True
+        except IntegrityError:
+            # An identical task was added concurrently
+            session.rollback()
+            cached = self.__get_cached_task(session, fingerprint, ttl)
+            if cached is None:
+                raise
+            return cached, False
+        finally:
+            self.session.remove()
+
+    def add_task_group(self, kind: str, size: int, params: Optional[str] = None) -> int:
+        """Adds a new empty group of tasks and returns its id
+
+            A group with params is incomplete until its tasks are added with a cursor,
+            see add_tasks and set_group_expansion
+        """
+        return self._add_and_commit(TaskGroup(kind=kind, size=size, params=params,
+                                              complete=params is None)).id
+
+    def add_tasks(self, payloads: List[Mapping], kind='batch', group_id=None,
+                  cursor: Optional[int] = None) -> Tuple[int, list]:
+        """Adds a group of tasks in a single transaction
+
+            Payloads with a 'debug' field are stored as debug tasks.
+
+            Parameters:
+                payloads: Payloads of all tasks of the group
+                kind: Kind of the group
+                group_id: Add the tasks to this existing group instead of a new one
+                cursor: Number of tasks expanded so far, advanced by the payloads in the
+                        same transaction. Raises ExpansionConflictError without adding
+                        the tasks if the group was advanced by someone else.
+
+            Returns:
+                (group id, list of the created tasks)
+        """
+        session = self.session()
+        session.expire_on_commit = False
+        if group_id is None:
+            group = TaskGroup(kind=kind, size=len(payloads), expanded=len(payloads))
+            session.add(group)
+            session.flush()
+            group_id = group.id
+        elif cursor is not None:
+            advanced = session.query(TaskGroup).\
+                    filter(TaskGroup.id == group_id, TaskGroup.expanded == cursor).\
+                    update({TaskGroup.expanded: cursor + len(payloads),
+                            TaskGroup.error: None}, synchronize_session=False)
+            if not advanced:
+                session.rollback()
+                self.session.remove()
+                raise ExpansionConflictError((f"Group {group_id} is not expanded up to "
+                                              f"{cursor} tasks"))
+        tasks = []
+        for payload in payloads:
+            task = self.create_task(payload, debug='debug' in payload)
+            task.group_id = group_id
+            tasks.append(task)
+        session.add_all(tasks)
+        session.flush()
+        self._journal(session, [(task.id, None, task.state, None) for task in tasks])
+        session.commit()
+        self.session.remove()
+        return group_id, tasks
+
+    def set_group_expansion(self, group_id: int, complete: bool = False,
+                            error: Optional[str] = None):
+        """Marks the expansion of a group as complete or stores the error it stopped with"""
+        session = self.session()
+        session.query(TaskGroup).filter(TaskGroup.id == group_id).\
+                update({TaskGroup.complete: complete, TaskGroup.error: error},
+                       synchronize_session=False)
+        session.commit()
+        self.session.remove()
+
+    def get_task_group(self, group_id: int) -> TaskGroup:
+        """Returns a group without its tasks
+
+            Raises NonExistingTaskEntryError if no such group exists
+        """
+        session = self.session()
+        group = session.query(TaskGroup).filter_by(id=group_id).one_or_none()
+        self.session.remove()
+        if group is None:
+            raise NonExistingTaskEntryError(f"error group id {str(group_id)} does not exists")
+        return group
+
+    def get_incomplete_groups(self, kind: str) -> List[int]:
+        """Returns the ids of the groups of kind whose expansion is not complete"""
+        session = self.session()
+        res = [row.id for row in session.query(TaskGroup.id).
+               filter(TaskGroup.kind == kind, TaskGroup.complete.is_(False),
+                      TaskGroup.params.isnot(None)).order_by(TaskGroup.id)]
+        self.session.remove()
+        return res
+
+    def get_group_progress(self, group_id: int) -> Tuple[TaskGroup, Dict[str, int]]:
+        """Returns a group and the number of its tasks per state
+
+            Raises NonExistingTaskEntryError if no such group exists
+        """
+        session = self.session()
+        group = session.query(TaskGroup).filter_by(id=group_id).one_or_none()
+        counts = session.query(Task.state, func.count(Task.id)).\
+                filter(Task.group_id == group_id).\
+                group_by(Task.state).all()
+        self.session.remove()
+        if group is None:
+            raise NonExistingTaskEntryError(f"error group id {str(group_id)} does not exists")
+        return group, dict(counts)
+
+    def get_group_task_ids(self, group_id: int, debug=None) -> List[int]:
+        """Returns the ids of all tasks of a group in the order they were added
+
+            Parameters:
+                group_id: Id of the group
+                debug: If set, limit to debug or non debug tasks
+        """
+        session = self.session()
+        query = session.query(Task.id).filter(Task.group_id == group_id)
+        if debug is not None:
+            query = query.filter(Task.debug == debug)
+        res = [row.id for row in query.order_by(Task.id)]
+        self.session.remove()
+        return res
+
+    def get_task_revision(self, task_id: int) -> int:
+        """Returns the revision of a task without loading the task
+
+            Raises NonExistingTaskEntryError if no such task exists
+        """
+        session = self.session()
+        revision = session.query(Task.revision).filter(Task.id == task_id).scalar()
+        self.session.remove()
+        if revision is None:
+            raise NonExistingTaskEntryError((f"error remote task id {str(task_id)}"
+                                             f" does not exists in database"))
+        return revision
+
+    def get_outbox(self, state: str = 'queued', limit: Optional[int] = None,
+                   exclude_owner: Optional[str] = None,
+                   claimed_before: Optional[float] = None) -> List[Tuple[int, Any]]:
+        """Returns (task id, group id) of the non debug tasks in state without slurm jobs
+
+            Tasks stored by a submit request are 'queued' until they are submitted.
+
+            Parameters:
+                exclude_owner: leave out tasks claimed by this owner
+                claimed_before: only tasks claimed at least this many seconds ago
+        """
+        session = self.session()
+        has_job = session.query(SlurmJob.id).filter(SlurmJob.task_id == Task.id).exists()
+        query = session.query(Task.id, Task.group_id).\
+                filter(Task.state == state).\
+                filter(Task.debug.isnot(True)).\
+                filter(~has_job)
+        if exclude_owner is not None:
+            query = query.filter(or_(Task.claimed_by.is_(None), Task.claimed_by != exclude_owner))
+        if claimed_before is not None:
+            query = query.filter(or_(Task.claimed_at.is_(None), Task.claimed_at <
+                                     datetime.utcnow() - timedelta(seconds=claimed_before)))
+        query = query.order_by(Task.id)
+        if limit is not None:
+            query = query.limit(limit)
+        res = [tuple(row) for row in query]
+        self.session.remove()
+        return res
+
+    def claim_tasks(self, task_ids: List[int], state: str, new_state: str,
+                    owner: Optional[str] = None) -> List[int]:
+        """Moves the tasks still in state to new_state and returns their ids
+
+            Every task is updated by a conditional UPDATE, so concurrent claims of the same
+            task succeed only once. With owner the claiming process and the time are stored.
+        """
+        session = self.session()
+        values = {Task.state: new_state, Task.revision: Task.revision + 1}
+        if owner is not None:
+            values.update({Task.claimed_by: owner, Task.claimed_at: datetime.utcnow()})
+        claimed = []
+        for task_id in task_ids:
+            res = session.query(Task).filter(Task.id == task_id, Task.state == state).\
+                    update(values, synchronize_session=False)
+            if res:
+                claimed.append(task_id)
+        self._journal(session, [(task_id, state, new_state, None) for task_id in claimed])
+        session.commit()
+        self.session.remove()
+        for task_id in claimed:
+            self._notify_state_listeners(task_id, new_state)
+        return claimed
+
+    def get_task_params(self, task_ids: List[int]) -> list:
+        """Returns the id and parameter columns (see param_fields) in the order of task_ids
+
+            The result can be passed to get_param_from_task
+        """
+        session = self.session()
+        table = inspect(Task).local_table
+        columns = [table.c.id] + [table.c[field] for field in self.param_fields]
+        rows = {row[0]: self.task_params(*row) for chunk in chunk_list(task_ids, MAX_IN_SIZE)
+                for row in session.query(*columns).filter(table.c.id.in_(chunk))}
+        self.session.remove()
+        return [rows[task_id] for task_id in task_ids if task_id in rows]
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Acquires or renews the lease name for ttl seconds and returns True on success
+
+            The lease is granted if it is held by owner already, expired or does not exist.
+            The check and the update are done by a single statement, so at most one owner
+            holds an unexpired lease.
+        """
+        session = self.session()
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=ttl)
+        try:
+            res = session.query(Lease).\
+                    filter(Lease.name == name, or_(Lease.owner == owner, Lease.expires < now)).\
+                    update({Lease.owner: owner, Lease.expires: expires},
+                           synchronize_session=False)
+            if not res:
+                session.add(Lease(name=name, owner=owner, expires=expires))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
+        finally:
+            self.session.remove()
+        return True
+
+    def release_lease(self, name: str, owner: str):
+        """Gives up the lease name if it is held by owner"""
+        session = self.session()
+        session.query(Lease).filter(Lease.name == name, Lease.owner == owner).\
+                delete(synchronize_session=False)
+        session.commit()
+        self.session.remove()
+
+    def get_transitions(self, since: int = 0, limit: int = 1000) -> List[TaskTransition]:
+        """Returns at most limit journal entries with a sequence number above since
+
+            Parameters:
+                since: sequence number of the last entry seen, 0 to start at the beginning
+                limit: max. number of entries
+        """
+        session = self.session()
+        res = session.query(TaskTransition).\
+                filter(TaskTransition.seq > since).\
+                order_by(TaskTransition.seq).\
+                limit(limit).all()
+        self.session.remove()
+        return res
+
+    def get_last_transition_seq(self) -> int:
+        """Returns the sequence number of the latest journal entry, 0 if it is empty"""
+        session = self.session()
+        res = session.query(func.max(TaskTransition.seq)).scalar()
+        self.session.remove()
+        return res or 0
+
+    def get_task_group_ids(self, task_ids: List[int]) -> Dict[int, Optional[int]]:
+        """Returns the group id of each existing task, None for tasks without group"""
+        session = self.session()
+        rows = [row for chunk in chunk_list(task_ids, MAX_IN_SIZE)
+                for row in session.query(Task.id, Task.group_id).filter(Task.id.in_(chunk))]
+        self.session.remove()
+        return dict(rows)
+
+    def get_task_states(self, task_ids: Optional[List[int]] = None,
+                        group_id: Optional[int] = None, after: int = 0,
+                        limit: Optional[int] = None) -> Dict[int, str]:
+        """Returns the state of many tasks by id without loading the tasks
+
+            Parameters:
+                task_ids: ids of the tasks, missing tasks are left out
+                group_id: id of a group, all its tasks are returned
+                after: only tasks of the group with a higher id
+                limit: at most limit tasks of the group with the lowest ids
+        """
+        session = self.session()
+        query = session.query(Task.id, Task.state)
+        if group_id is not None:
+            query = query.filter(Task.group_id == group_id, Task.id > after).order_by(Task.id)
+            if limit is not None:
+                query = query.limit(limit)
+            rows = query.all()
+        else:
+            rows = [row for chunk in chunk_list(task_ids or [], MAX_IN_SIZE)
+                    for row in query.filter(Task.id.in_(chunk))]
+        self.session.remove()
+        return dict(rows)
 
     def set_task_state(self, task_id: int, state: str):
         """Set the state of a task
@@ -125,9 +749,68 @@ class DB:
         """
         session = self.session()
         task = session.query(Task).filter_by(id=task_id).one()
+        self._journal(session, [(task_id, task.state, state, None)])
         task.state = state
+        task.revision = Task.revision + 1
         session.commit()
         self.session.remove()
+        self._notify_state_listeners(task_id, state)
+
+    def apply_transitions(self, transitions: List[Transition]) -> List[int]:
+        """Applies the state changes of many tasks in a single transaction
+
+            Tasks changing between the same states are updated by one UPDATE statement. If a
+            task occurs several times, its last transition is kept. Transitions with an
+            expected_state are compare-and-set: they are skipped along with their slurm job
+            if the task is in another state, e. g. because another process moved it on.
+            Every change of a state is added to the journal. Listeners are notified after
+            commit.
+
+            Parameters:
+                transitions: state changes and new slurm jobs of the tasks
+
+            Returns:
+                The ids of the tasks whose transition was applied
+        """
+        if not transitions:
+            return []
+        latest: Dict[int, Transition] = {}
+        for transition in transitions:
+            latest.pop(transition.task_id, None)
+            latest[transition.task_id] = transition
+
+        session = self.session()
+        old_states = self._get_states(session, list(latest))
+        applied = [transition for task_id, transition in latest.items()
+                   if task_id in old_states and transition.expected_state in
+                   (None, old_states[task_id])]
+        skipped = len(latest) - len(applied)
+        if skipped:
+            self.logger.info("Skipped %d transitions of tasks in an unexpected state", skipped)
+        self._journal(session, [(transition.task_id, old_states[transition.task_id],
+                                 transition.state, transition.cause)
+                                for transition in applied
+                                if old_states[transition.task_id] != transition.state])
+        applied_ids = {transition.task_id for transition in applied}
+        session.add_all([transition.slurm_job for transition in transitions
+                         if transition.slurm_job is not None and
+                         transition.task_id in applied_ids])
+        task_ids: Dict[Tuple[str, Optional[str]], List[int]] = {}
+        for transition in applied:
+            task_ids.setdefault((transition.state, transition.expected_state),
+                                []).append(transition.task_id)
+        for (state, expected_state), ids in task_ids.items():
+            for chunk in chunk_list(ids, MAX_IN_SIZE):
+                query = session.query(Task).filter(Task.id.in_(chunk))
+                if expected_state is not None:
+                    query = query.filter(Task.state == expected_state)
+                query.update({Task.state: state, Task.revision: Task.revision + 1},
+                             synchronize_session=False)
+        session.commit()
+        self.session.remove()
+        for transition in applied:
+            self._notify_state_listeners(transition.task_id, transition.state)
+        return [transition.task_id for transition in applied]
 
     def get_slurm_jobs(self, task_id=None):
         """Returns a list of jobs for a given task
@@ -161,4 +844,39 @@ class DB:
                 ssh_stdout: stdout of the ssh command
                 ssh_stderr: stderr of the ssh command
         """
-        return self._add_and_commit(slurm_job)
+        session = self.session()
+        session.add(slurm_job)
+        session.query(Task).filter(Task.id == slurm_job.task_id).\
+                update({Task.revision: Task.revision + 1}, synchronize_session=False)
+        session.commit()
+        session.refresh(slurm_job)
+        self.session.remove()
+        self._notify_job_listeners(slurm_job.task_id)
+        return slurm_job
+
+    def add_array_jobs(self, job_id: int, cluster: str, task_ids: List[int], ssh_rc: int,
+                       ssh_stdout: str, ssh_stderr: str, state: str):
+        """Adds the elements of a slurm job array and sets the state of their tasks
+
+            The task at position i of task_ids is executed by array index i.
+            Everything is stored in a single transaction, the ssh output only once.
+        """
+        #pylint: disable=too-many-arguments
+        session = self.session()
+        session.add_all([SlurmJob(job_id=job_id, cluster=cluster, job_type='main',
+                                  ssh_rc=ssh_rc, task_id=task_id, array_index=index,
+                                  ssh_stdout=ssh_stdout if index == 0 else None,
+                                  ssh_stderr=ssh_stderr if index == 0 else None)
+                         for index, task_id in enumerate(task_ids)])
+        old_states = self._get_states(session, task_ids)
+        self._journal(session, [(task_id, old_states[task_id], state, job_id)
+                                for task_id in task_ids
+                                if task_id in old_states and old_states[task_id] != state])
+        for chunk in chunk_list(task_ids, MAX_IN_SIZE):
+            session.query(Task).filter(Task.id.in_(chunk)).\
+                    update({Task.state: state, Task.revision: Task.revision + 1},
+                           synchronize_session=False)
+        session.commit()
+        self.session.remove()
+        for task_id in task_ids:
+            self._notify_state_listeners(task_id, state)
@@ -0,0 +1,77 @@
+"""Versioned schema migrations for existing sqlite databases
+
+    create_all only creates missing tables. Columns and indexes added to existing tables
+    are applied by the migrations in MIGRATIONS. The schema version of a database file is
+    stored in 'PRAGMA user_version'. Every migration has to be idempotent, as a new
+    database is created by create_all with the latest schema before the migrations run.
+"""
+import logging
+
+logger = logging.getLogger('papi.db.migrations')
+
+def has_column(connection, table: str, column: str) -> bool:
+    """Returns True if table has a column named column"""
+    return any(row[1] == column for row in connection.execute(f"PRAGMA table_info({table})"))
+
+def add_column(connection, table: str, column: str, definition: str):
+    """Adds a column to a table unless it exists already"""
+    if not has_column(connection, table, column):
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migrate_task_groups(connection):
+    """Columns for batch and sweep groups and slurm job arrays"""
+    add_column(connection, 'tasks', 'group_id', 'INTEGER REFERENCES task_groups(id)')
+    add_column(connection, 'slurm_jobs', 'array_index', 'INTEGER')
+
+def migrate_indexes(connection):
+    """Indexes on the columns filtered by the runner and the status requests"""
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_tasks_state ON tasks (state)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_tasks_group_id ON tasks (group_id)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_slurm_jobs_task_id_job_type "
+                       "ON slurm_jobs (task_id, job_type)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_slurm_jobs_cluster_job_id "
+                       "ON slurm_jobs (cluster, job_id)")
+
+def migrate_task_revision(connection):
+    """Revision of the tasks used as ETag of status responses"""
+    add_column(connection, 'tasks', 'revision', 'INTEGER NOT NULL DEFAULT 0')
+
+def migrate_task_claims(connection):
+    """Owner and time of the claim of tasks in state 'submitting'"""
+    add_column(connection, 'tasks', 'claimed_by', 'VARCHAR')
+    add_column(connection, 'tasks', 'claimed_at', 'DATETIME')
+
+def migrate_group_expansion(connection):
+    """Parameters and progress of the expansion of sweeps, existing groups are complete"""
+    add_column(connection, 'task_groups', 'params', 'VARCHAR')
+    add_column(connection, 'task_groups', 'expanded', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(connection, 'task_groups', 'complete', 'BOOLEAN NOT NULL DEFAULT 1')
+    add_column(connection, 'task_groups', 'error', 'VARCHAR')
+    connection.execute("UPDATE task_groups SET expanded = size WHERE params IS NULL")
+
+# (version, migration) in ascending order, append new migrations at the end
+MIGRATIONS = [
+    (1, migrate_task_groups),
+    (2, migrate_indexes),
+    (3, migrate_task_revision),
+    (4, migrate_task_claims),
+    (5, migrate_group_expansion),
+]
+
+def get_version(connection) -> int:
+    """Returns the schema version of the database"""
+    return connection.execute("PRAGMA user_version").scalar()
+
+def migrate(engine) -> int:
+    """Upgrades the database to the latest schema version and returns this version"""
+    with engine.begin() as connection:
+        current = get_version(connection)
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info("Migrate database to version %d: %s", version,
+                        migration.__doc__)
+            migration(connection)
+            connection.execute(f"PRAGMA user_version = {int(version)}")
+            current = version
+    return current
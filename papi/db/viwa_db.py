@@ -1,7 +1,9 @@
 """Viwa use case specific db implementation"""
 import re
+import hashlib
+from typing import Mapping
 from sqlalchemy import Column, Integer, String, Boolean, Float
-from .db import DB, SlurmJob
+from .db import DB
 from .db_init import Base
 
 def normalize_seeding_date(seeding_date):
@@ -13,12 +15,24 @@ def normalize_seeding_date(seeding_date):
             s_date = f"sub{regex.group(1)}days"
             return s_date
     elif seeding_date[0] == '+':
-        regex = re.search(r"^+([\d]+) days", seeding_date)
+        regex = re.search(r"^\+([\d]+) days", seeding_date)
         if regex is not None:
             s_date = f"add{regex.group(1)}days"
             return s_date
     return seeding_date
 
+def task_fingerprint(payload: Mapping) -> str:
+    """Returns a hash identifying the simulation result of a parameter set
+
+        Parameters are normalized first, so e. g. '-15 days' and 'sub15days' or
+        0.5 and 0.50 result in the same fingerprint.
+    """
+    canonical = "|".join([normalize_seeding_date(str(payload['seeding_date'])),
+                          "1" if payload['irrigation'] else "0",
+                          repr(float(payload['nutrition_factor'])),
+                          repr(float(payload['phenology_factor']))])
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
 class Task(Base):
     #pylint: disable=too-few-public-methods
     """Database table with tasks
@@ -39,48 +53,30 @@ class Task(Base):
 
 class ViwaDb(DB):
     """Viwa use case specific db implementation"""
+    param_fields = ('seeding_date', 'irrigation', 'nutrition_factor', 'phenology_factor')
+    task_model = Task
+
     def __init__(self, config):
         DB.__init__(self, config)
 
-    def add_task(self, payload, debug=False):
-        #pylint: disable=arguments-differ
-        """ Add task to database
+    def create_task(self, payload, debug=False):
+        """Creates a new task object for a payload without storing it
 
             Parameters:
                 payload: Payload send via JSON in HTTP request
         """
-        if debug:
-            task = Task(seeding_date=normalize_seeding_date(payload['seeding_date']),
-                    irrigation=payload['irrigation'],
-                    nutrition_factor=payload['nutrition_factor'],
-                    phenology_factor=payload['phenology_factor'],
-                    debug=debug,
-                    state='finished')
-        else:
-            task = Task(seeding_date=normalize_seeding_date(payload['seeding_date']),
+        task = Task(seeding_date=normalize_seeding_date(payload['seeding_date']),
                     irrigation=payload['irrigation'],
                     nutrition_factor=payload['nutrition_factor'],
                     phenology_factor=payload['phenology_factor'],
                     debug=debug)
+        if debug:
+            task.state = 'finished'
+        return task
 
-        return self._add_and_commit(task)
-
-    def get_tasks_by_state(self, state: str, successful_only=False):
-        """Returns a list of task in a given state
-
-            Parameters:
-            state: limit query to a state.
-            successful_only: Only query jobs which where successfully scheduled
-        """
-        session = self.session()
-        query = session.query(Task, SlurmJob).\
-                filter(Task.id == SlurmJob.task_id).\
-                filter(Task.state == state)
-        if successful_only:
-            query = query.filter(SlurmJob.job_id != -1)
-        res = query.all()
-        self.session.remove()
-        return res
+    def task_fingerprint(self, payload):
+        """Returns the normalized parameter fingerprint of a payload"""
+        return task_fingerprint(payload)
 
     def get_param_from_task(self, task):
         """Converts a string or dict of params to ssh params"""
@@ -92,3 +92,27 @@ class TaskAlreadyExistsError(Error):
     def __init__(self, message):
         #pylint: disable=super-init-not-called
         self.message = message
+
+
+class ExpansionConflictError(Error):
+    """Exception raised if another process advanced the expansion of a sweep
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        #pylint: disable=super-init-not-called
+        self.message = message
+
+
+class SubmitQueueFullError(Error):
+    """Exception raised if the submit queue does not accept further submissions
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        #pylint: disable=super-init-not-called
+        self.message = message
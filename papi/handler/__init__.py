@@ -1,3 +1,11 @@
 """This module contains the handler for the corresponding API methods"""
-from .status import Status
+from .status import Status, StatusBatch
+from .status_cache import StatusCache
 from .submit import Submit
+from .logs import Logs
+from .batch import SubmitBatch
+from .sweep import Sweep
+from .events import Events
+from .event_hub import EventHub
+from .changes import Changes
+from .dispatcher import SubmitDispatcher
@@ -0,0 +1,145 @@
+"""This module only contrains the handler class for batch submit requests"""
+
+import logging
+import functools
+from typing import Mapping, List
+from flask import jsonify, request
+from papi.exceptions import (MissingPayloadError, MissingInputParameterError,
+                             InputParameterMalformedError, SubmitQueueFullError)
+from papi.util import parse_slurm_output, slurm_job_key
+from papi.db import DB
+from papi.ssh import Ssh
+from .submit import Submit, validate_payload
+
+class SubmitBatch(Submit):
+    """Class to handle batch submit POST requests
+
+        All tasks of a batch are stored in one transaction and submitted as a single slurm
+        job array. The task at position i of the batch is executed by array index i.
+    """
+
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping, dispatcher=None):
+        """Constructor for API ressource rooted at /submit/batch/
+
+            Parameters:
+                database (DB): Database Object used for communication with sqlite3 db
+                ssh (Ssh): SSH Object used for communication with ssh endpoint
+                dispatcher (SubmitDispatcher): Submits in the background, None submits inline
+        """
+        Submit.__init__(self, database, ssh, config, dispatcher)
+        self.logger = logging.getLogger('papi.handler.SubmitBatch')
+        self.max_batch_size = self.config.get('MAX_BATCH_SIZE', 1000)
+
+    def submit_batch_finished(self, task_ids: List[int], return_value: int, stdout: str,
+                              stderr: str, group_id: int):
+        """Callback for sshRunner, bound to the task ids of the job array with functools.partial
+            This Callback is executed after the sbatch of the job array is executed
+
+            Paramters:
+                task_ids: ids of the tasks in the order of their array index
+                return_value: exit code as reported by ssh (paramiko)
+                stdout: stdout as reported by ssh
+                stderr: stderr as reported by ssh
+                group_id: id of the group with the tasks of the job array
+        """
+        #pylint: disable=too-many-arguments
+        slurm_job_id = -1
+        cluster = ''
+        if return_value != 0:
+            self.logger.error("Error wrapper script returned "
+                              "a non zero exit code: '%s' output: '%s'",\
+                              str(return_value), str(stderr))
+        else:
+            slurm_job_id, cluster = parse_slurm_output(stdout)
+            self.logger.info("Job array of group '%s' with %d tasks is submitted. "
+                             "Running on cluster '%s' with id '%d'",\
+                             str(group_id), len(task_ids), str(cluster), slurm_job_id)
+        if slurm_job_id == -1:
+            state = 'failed'
+        elif self.pipelined:
+            state = 'pipelining'
+        else:
+            state = 'running'
+        self.database.add_array_jobs(slurm_job_id, cluster, task_ids, return_value,
+                                     stdout, stderr, state)
+        if state == 'pipelining':
+            for index, task_id in enumerate(task_ids):
+                self._queue_phase(task_id, self.ssh.collect_task, self.pipeline_collect_finished,
+                                  slurm_job_key(slurm_job_id, index), 'running')
+
+    def __do(self):
+        payloads = None
+        try:
+            payloads = request.json
+        except Exception:
+            raise MissingPayloadError("Missing JSON payload in HTTP request")
+        if not isinstance(payloads, list) or not payloads:
+            raise MissingPayloadError("Expected a non empty JSON list of payloads")
+        if len(payloads) > self.max_batch_size:
+            raise InputParameterMalformedError((f"Batch of {len(payloads)} tasks exceeds the "
+                                                f"limit of {self.max_batch_size}"))
+
+        for index, payload in enumerate(payloads):
+            try:
+                validate_payload(payload, self.fields_required)
+            except (MissingPayloadError, MissingInputParameterError,
+                    InputParameterMalformedError) as exception:
+                raise type(exception)(f"Payload {index}: {exception.message}")
+
+        if self.dispatcher is not None:
+            self.dispatcher.reserve()
+        try:
+            group_id, tasks = self.database.add_tasks(payloads)
+        except Exception:
+            if self.dispatcher is not None:
+                self.dispatcher.cancel()
+            raise
+        try:
+            self.submit_array(group_id, tasks)
+        except Exception as exception:
+            self.logger.error(exception)
+            raise exception
+        return {'batch_id': group_id, 'task_ids': [task.id for task in tasks]}
+
+    def submit_array(self, group_id: int, tasks: list):
+        """Submits all non debug tasks as one job array
+
+            With a dispatcher the array is submitted in the background using a reserved slot
+        """
+        tasks = [task for task in tasks if not task.debug]
+        if self.dispatcher is not None:
+            self.dispatcher.submit_group(group_id, [task.id for task in tasks])
+            return
+        if not tasks:
+            return
+        params = [self.database.get_param_from_task(task) for task in tasks]
+        callback = functools.partial(self.submit_batch_finished, [task.id for task in tasks])
+        self.ssh.submit_array(group_id, params, callback)
+
+    #@jwt_required
+    def post(self):
+        """Executed on HTTP POST send to API Endpoint /submit/batch/
+
+            Expects a JSON list with one submit payload per task
+
+            Returns:
+                json(str): JSON string with the batch id and task ids or an error response
+        """
+        status_message = ''
+        status = 'created'
+        code = self.config['HTTP']['OK_RESP_CODE']
+        try:
+            status_message = self.__do()
+        except SubmitQueueFullError as exception:
+            status = 'error'
+            status_message = str(exception)
+            code = self.config['HTTP'].get('TOO_MANY_REQUESTS_RESP_CODE', 429)
+        except Exception as exception: #pylint: disable=broad-except
+            status = 'error'
+            status_message = str(exception)
+            code = self.config['HTTP']['CLIENT_ERR_RESP_CODE']
+
+        json = jsonify({'status': status,
+                        'message': status_message})
+        json.status_code = code
+        return json
@@ -0,0 +1,77 @@
+"""This module only contrains the handler class for the journal of task state changes"""
+import logging
+from typing import Mapping
+from flask import jsonify, request
+from flask_restful import Resource
+from papi.exceptions import InputParameterMalformedError
+from papi.db import DB
+from papi.ssh import Ssh
+
+class Changes(Resource):
+    """Class to handle requests for the state changes after a cursor
+
+        The journal is paged by sequence number, so a client mirrors the state of all tasks
+        by requesting /changes/?since=<next> with the next value of the previous response.
+    """
+
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping):
+        """Constructor for API ressource rooted at /changes/
+
+            Parameters:
+                database (DB): Database Object used for communication with sqlite3 db
+                ssh (Ssh): SSH Object used for communication with ssh endpoint
+        """
+        self.logger = logging.getLogger('papi.handler.Changes')
+        self.database = database
+        self.ssh = ssh
+        self.config = config
+        self.max_changes = self.config.get('MAX_CHANGES', 1000)
+
+    def __do(self, args: Mapping):
+        try:
+            since = int(args.get('since', 0))
+            limit = int(args.get('limit', self.max_changes))
+        except ValueError:
+            raise InputParameterMalformedError(f"Invalid since or limit: '{dict(args)}'")
+        if since < 0 or limit <= 0:
+            raise InputParameterMalformedError(f"Invalid since or limit: '{dict(args)}'")
+        limit = min(limit, self.max_changes)
+
+        transitions = self.database.get_transitions(since=since, limit=limit + 1)
+        more = len(transitions) > limit
+        transitions = transitions[:limit]
+        return {'changes': [{'seq': transition.seq,
+                             'task_id': transition.task_id,
+                             'old_state': transition.old_state,
+                             'new_state': transition.new_state,
+                             'job_id': transition.job_id,
+                             'time': transition.created.isoformat()}
+                            for transition in transitions],
+                'next': transitions[-1].seq if transitions else since,
+                'more': more}
+
+    #@jwt_required
+    def get(self):
+        """Executed on HTTP GET send to API Endpoint /changes/
+
+            Expects the query parameters since=<seq> (default 0) and limit=<n>
+
+            Returns:
+                json(str): JSON string with the changes after since, the cursor of the next
+                           request and whether more changes are available
+        """
+        status_message = ''
+        status = 'ok'
+        code = self.config['HTTP']['OK_RESP_CODE']
+        try:
+            status_message = self.__do(request.args)
+        except Exception as exception: #pylint: disable=broad-except
+            status = 'error'
+            status_message = str(exception)
+            code = self.config['HTTP']['CLIENT_ERR_RESP_CODE']
+            self.logger.error(status_message)
+
+        json = jsonify({'status': status,
+                        'message': status_message})
+        json.status_code = code
+        return json
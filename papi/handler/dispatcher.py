@@ -0,0 +1,223 @@
+"""This module contains the dispatcher submitting stored tasks in the background
+
+    Submit requests only store their tasks in state 'queued', which acts as durable outbox.
+    The dispatcher hands them to ssh from a pool of worker threads, so the latency of the
+    ssh endpoint does not add to the latency of submit requests.
+"""
+import logging
+import functools
+import os
+import queue
+import socket
+import threading
+import uuid
+from typing import Mapping, List, Optional, Dict, Any
+from papi.exceptions import SubmitQueueFullError
+from papi.db import DB, Transition
+from papi.ssh import Ssh
+from .batch import SubmitBatch
+
+class SubmitDispatcher:
+    """Submits queued tasks with a bounded number of pending submissions
+
+        Every pending submission of a task or a job array holds one of QUEUE_SIZE slots.
+        Requests reserve their slot before the tasks are stored and are rejected with
+        SubmitQueueFullError if none is free. A worker claims the tasks by moving them
+        from 'queued' to 'submitting', so every task is submitted only once even if it is
+        enqueued by a request and by the periodic scan of the outbox.
+
+        An inactive dispatcher leaves the stored tasks to the active dispatcher of the
+        process elected as leader, which picks them up by the next scan. Claims are stored
+        with the owner of the dispatcher. A dispatcher resumed as new leader queues the
+        claims of all other owners again, since only the previous leader could have made
+        them. Otherwise claims of other owners older than CLAIM_TIMEOUT seconds are given up.
+    """
+
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping, owner: Optional[str] = None):
+        """Constructor of the dispatcher
+
+            Parameters:
+                database (DB): Database Object used for communication with sqlite3 db
+                ssh (Ssh): SSH Object used for communication with ssh endpoint
+                config (Mapping): PAPI configuration, the dispatcher reads DISPATCHER
+                owner (str): Identifies the claims of this process, unique if None
+        """
+        self.logger = logging.getLogger('papi.handler.SubmitDispatcher')
+        self.database = database
+        self.ssh = ssh
+        dispatcher_config = config.get('DISPATCHER') or {}
+        self.workers = dispatcher_config.get('WORKERS', 4)
+        self.queue_size = dispatcher_config.get('QUEUE_SIZE', 1000)
+        self.reserve_timeout = dispatcher_config.get('RESERVE_TIMEOUT', 0)
+        self.scan_interval = dispatcher_config.get('SCAN_INTERVAL', 30)
+        self.claim_timeout = dispatcher_config.get('CLAIM_TIMEOUT', 600)
+        self.owner = owner if owner is not None else \
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.scan_limit = config.get('SWEEP_CHUNK_SIZE', 1000)
+        # Callbacks of the ssh commands are the ones of inline submits
+        self.handler = SubmitBatch(database, ssh, config)
+        self.slots = threading.BoundedSemaphore(self.queue_size)
+        self.queue: queue.Queue = queue.Queue()
+        self.pending: set = set()
+        self.mutex = threading.Lock()
+        self.stopped = threading.Event()
+        self.active = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def reserve(self, blocking: bool = False, timeout: Optional[float] = None):
+        """Reserves a slot for one submission
+
+            Without blocking the request waits at most RESERVE_TIMEOUT seconds.
+            Raises SubmitQueueFullError if no slot is free.
+        """
+        if not blocking and self.reserve_timeout:
+            blocking, timeout = True, self.reserve_timeout
+        if not self.slots.acquire(blocking, timeout if blocking else None):
+            raise SubmitQueueFullError((f"Submit queue is full, {self.queue_size} "
+                                        f"submissions are pending"))
+
+    def cancel(self):
+        """Returns a reserved slot which is not used"""
+        self.slots.release()
+
+    def __enqueue(self, key, task_ids: List[int]) -> bool:
+        """Queues the tasks for a worker unless key is pending, the slot has to be reserved"""
+        if not self.active.is_set():
+            return False
+        with self.mutex:
+            if key in self.pending or not task_ids:
+                return False
+            self.pending.add(key)
+        self.queue.put((key, task_ids))
+        return True
+
+    def submit(self, task_id: int):
+        """Submits a stored task in the background using a reserved slot"""
+        if not self.__enqueue(('task', task_id), [task_id]):
+            self.cancel()
+
+    def submit_group(self, group_id: int, task_ids: List[int]):
+        """Submits stored tasks of a group as one job array using a reserved slot"""
+        if not self.__enqueue(('group', group_id, task_ids[0] if task_ids else None),
+                              task_ids):
+            self.cancel()
+
+    def __submit(self, key, task_ids: List[int]):
+        """Claims the tasks and hands them to ssh, failed tasks are queued again"""
+        claimed = self.database.claim_tasks(task_ids, 'queued', 'submitting', self.owner)
+        if not claimed:
+            return
+        try:
+            tasks = self.database.get_task_params(claimed)
+            params = [self.database.get_param_from_task(task) for task in tasks]
+            if key[0] == 'task':
+                self.ssh.submit_task(claimed[0], params[0], self.handler.submit_task_finished)
+            else:
+                callback = functools.partial(self.handler.submit_batch_finished,
+                                             [task.id for task in tasks])
+                self.ssh.submit_array(key[1], params, callback)
+        except Exception as exception: #pylint: disable=broad-except
+            self.logger.error("Submitting tasks %s failed, retry in %s seconds: '%s'",\
+                              str(claimed), str(self.scan_interval), str(exception))
+            self.database.apply_transitions([Transition(task_id, 'queued',
+                                                        expected_state='submitting')
+                                             for task_id in claimed])
+
+    def __worker(self):
+        while True:
+            key, task_ids = self.queue.get()
+            try:
+                if self.active.is_set():
+                    self.__submit(key, task_ids)
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("Dispatching %s failed: '%s'", str(key), str(exception))
+            finally:
+                with self.mutex:
+                    self.pending.discard(key)
+                self.slots.release()
+                self.queue.task_done()
+
+    def scan(self) -> int:
+        """Enqueues the stored tasks not submitted yet and returns the number of submissions
+
+            Picks up tasks of requests which failed to submit or of a previous process.
+            Stops as soon as all slots are taken, the remaining tasks wait for the next scan.
+        """
+        if not self.active.is_set():
+            return 0
+        groups: Dict[Any, List[int]] = {}
+        for task_id, group_id in self.database.get_outbox('queued', limit=self.scan_limit):
+            groups.setdefault(group_id, []).append(task_id)
+        count = 0
+        for group_id, task_ids in groups.items():
+            items = [(('task', task_id), [task_id]) for task_id in task_ids] \
+                    if group_id is None else [(('group', group_id, task_ids[0]), task_ids)]
+            for key, ids in items:
+                if not self.slots.acquire(False):
+                    return count
+                if self.__enqueue(key, ids):
+                    count += 1
+                else:
+                    self.cancel()
+        return count
+
+    def __scanner(self):
+        while not self.stopped.wait(self.scan_interval):
+            try:
+                if self.active.is_set():
+                    self.recover()
+                count = self.scan()
+                if count:
+                    self.logger.info("Enqueued %d submissions from the outbox", count)
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("Scanning the outbox failed: '%s'", str(exception))
+
+    def recover(self, takeover: bool = False) -> int:
+        """Returns stale claims of other dispatchers without slurm job to 'queued'
+
+            These were claimed by a process which stopped before ssh returned. Claims of
+            this dispatcher are kept. On takeover this dispatcher became the lease holder
+            and the claims of all other owners are orphaned, otherwise recent claims of
+            others may still be in flight and are only given up after CLAIM_TIMEOUT.
+        """
+        orphans = [task_id for task_id, _ in
+                   self.database.get_outbox('submitting', exclude_owner=self.owner,
+                                            claimed_before=None if takeover
+                                            else self.claim_timeout)]
+        if not orphans:
+            return 0
+        requeued = self.database.claim_tasks(orphans, 'submitting', 'queued')
+        if requeued:
+            self.logger.warning("Requeue %d tasks left in state 'submitting' by other processes",
+                                len(requeued))
+        return len(requeued)
+
+    def start(self, active: bool = True):
+        """Starts the worker and scanner threads, an inactive dispatcher waits for resume"""
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.__worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self.__scanner, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        if active:
+            self.resume()
+
+    def resume(self, takeover: bool = False):
+        """Requeues orphaned tasks and starts submitting the outbox
+
+            takeover is set when the process acquired the lease of the election,
+            see recover
+        """
+        self.recover(takeover)
+        self.active.set()
+        self.scan()
+
+    def pause(self):
+        """Stops submitting, stored tasks are left to the next active dispatcher"""
+        self.active.clear()
+
+    def stop(self):
+        """Stops scanning the outbox, queued submissions are still processed"""
+        self.stopped.set()
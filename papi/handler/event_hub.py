@@ -0,0 +1,191 @@
+"""In-process publish/subscribe hub of task state changes"""
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Mapping, Optional, List, Dict, Iterable, Callable
+from papi.db import DB
+from .status import map_task_state
+
+class Subscription:
+    """Bounded buffer of the events of a subscriber
+
+        Events which do not fit into the buffer are dropped and counted in dropped, so a
+        slow consumer never blocks the hub. Clients should re-read the status of their
+        tasks after dropped events.
+    """
+    def __init__(self, task_ids: Optional[Iterable[int]], group_id: Optional[int],
+                 size: int):
+        self.task_ids = set(task_ids) if task_ids is not None else None
+        self.group_id = group_id
+        self.events: queue.Queue = queue.Queue(maxsize=size)
+        self.dropped = 0
+
+    def matches(self, event: Mapping) -> bool:
+        """Returns True if the event is about a watched task"""
+        if self.task_ids is not None and event['task_id'] in self.task_ids:
+            return True
+        return self.group_id is not None and event['group_id'] == self.group_id
+
+    def push(self, event: Mapping):
+        """Adds an event without blocking"""
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout: float) -> List[Mapping]:
+        """Waits up to timeout seconds for events and returns all buffered events"""
+        try:
+            events = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+class EventHub:
+    """Distributes the state changes of tasks to subscribers of tasks, batches and sweeps
+
+        publish is registered as state listener of the database and only enqueues the
+        change. If the state is changed by other processes, follow_journal publishes the
+        changes of all processes read from the journal instead and passes them to the
+        journal listeners, e. g. to invalidate caches. A dispatcher thread adds
+        the group id of the tasks, read in batches and cached, and copies every event into
+        the buffers of the matching subscribers.
+
+        Parameters:
+            database: Database to look up the group of a task
+            config: hub config dict (see CONFIG['PAPI']['EVENTS'])
+    """
+    def __init__(self, database: DB, config: Optional[Mapping] = None):
+        config = config if config is not None else {}
+        self.database = database
+        self.logger = logging.getLogger('papi.handler.EventHub')
+        self.buffer_size = config.get('BUFFER_SIZE', 1000)
+        self.max_subscribers = config.get('MAX_SUBSCRIBERS', 1000)
+        self.group_cache_size = config.get('GROUP_CACHE_SIZE', 100000)
+        self.input: queue.Queue = queue.Queue(maxsize=config.get('QUEUE_SIZE', 100000))
+        self.lock = threading.Lock()
+        self.subscribers: List[Subscription] = []
+        self.groups: OrderedDict = OrderedDict()
+        self.sequence = 0
+        self.dropped = 0
+        self.journal_interval = config.get('JOURNAL_INTERVAL', 1)
+        self.journal_seq = 0
+        self.journal_listeners: List[Callable[[int, str], None]] = []
+        self.thread = threading.Thread(target=self.__dispatch, daemon=True,
+                                       name='EventHub')
+        self.thread.start()
+
+    def publish(self, task_id: int, state: str):
+        """Enqueues a state change, usable as state listener of the database"""
+        try:
+            self.input.put_nowait((task_id, state, time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def add_journal_listener(self, callback: Callable[[int, str], None]):
+        """Registers callback(task_id, state) executed for every journal entry read"""
+        self.journal_listeners.append(callback)
+
+    def follow_journal(self):
+        """Publishes the changes journaled after now every JOURNAL_INTERVAL seconds
+
+            Used instead of registering publish as state listener
+        """
+        self.journal_seq = self.database.get_last_transition_seq()
+        thread = threading.Thread(target=self.__follow, daemon=True, name='EventHubJournal')
+        thread.start()
+
+    def read_journal(self, limit: int = 1000) -> int:
+        """Publishes the journal entries after the last one read and returns their number
+
+            Without subscribers and journal listeners the entries are skipped
+        """
+        if not self.subscribers and not self.journal_listeners:
+            self.journal_seq = self.database.get_last_transition_seq()
+            return 0
+        count = 0
+        while True:
+            entries = self.database.get_transitions(since=self.journal_seq, limit=limit)
+            for entry in entries:
+                for callback in self.journal_listeners:
+                    callback(entry.task_id, entry.new_state)
+                self.publish(entry.task_id, entry.new_state)
+                self.journal_seq = entry.seq
+            count += len(entries)
+            if len(entries) < limit:
+                return count
+
+    def __follow(self):
+        while True:
+            time.sleep(self.journal_interval)
+            try:
+                self.read_journal()
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("Reading the journal failed: '%s'", str(exception))
+
+    def subscribe(self, task_ids: Optional[Iterable[int]] = None,
+                  group_id: Optional[int] = None) -> Subscription:
+        """Returns a new subscription for the given tasks and/or group
+
+            Raises RuntimeError if MAX_SUBSCRIBERS is reached
+        """
+        subscription = Subscription(task_ids, group_id, self.buffer_size)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise RuntimeError(f"Limit of {self.max_subscribers} subscribers reached")
+            self.subscribers = self.subscribers + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Removes a subscription"""
+        with self.lock:
+            self.subscribers = [sub for sub in self.subscribers if sub is not subscription]
+
+    def __group_ids(self, task_ids: List[int]) -> Dict[int, Optional[int]]:
+        """Returns the group of every task, unknown tasks are read by one query"""
+        missing = [task_id for task_id in task_ids if task_id not in self.groups]
+        if missing:
+            self.groups.update(self.database.get_task_group_ids(missing))
+        groups = {}
+        for task_id in task_ids:
+            groups[task_id] = self.groups.get(task_id)
+            if task_id in self.groups:
+                self.groups.move_to_end(task_id)
+        while len(self.groups) > self.group_cache_size:
+            self.groups.popitem(last=False)
+        return groups
+
+    def __dispatch(self):
+        while True:
+            changes = [self.input.get()]
+            while len(changes) < 1000:
+                try:
+                    changes.append(self.input.get_nowait())
+                except queue.Empty:
+                    break
+            subscribers = self.subscribers
+            if not subscribers:
+                continue
+            groups: Dict[int, Optional[int]] = {}
+            try:
+                if any(sub.group_id is not None for sub in subscribers):
+                    groups = self.__group_ids([change[0] for change in changes])
+            except Exception as exception: #pylint: disable=broad-except
+                self.logger.error("Reading groups of events failed: '%s'", str(exception))
+            for task_id, state, timestamp in changes:
+                self.sequence += 1
+                event = {'id': self.sequence,
+                         'task_id': task_id,
+                         'group_id': groups.get(task_id),
+                         'state': map_task_state(state),
+                         'phase': state,
+                         'time': timestamp}
+                for subscription in subscribers:
+                    if subscription.matches(event):
+                        subscription.push(event)
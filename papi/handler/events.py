@@ -0,0 +1,141 @@
+"""This module only contrains the handler class for task event streams"""
+import json
+import logging
+import time
+from typing import Mapping, Optional
+from flask import jsonify, request, Response, stream_with_context
+from flask_restful import Resource
+from papi.exceptions import (InvalidTaskIdError, MissingInputParameterError,
+                             InputParameterMalformedError)
+from papi.db import DB
+from papi.ssh import Ssh
+from .event_hub import EventHub, Subscription
+from .status import map_task_state
+
+class Events(Resource):
+    """Class to handle requests for state changes of tasks, batches and sweeps
+
+        Without wait the events are streamed as Server-Sent Events, with wait=<seconds>
+        the request returns as soon as events are available or wait seconds passed.
+        Both start with the current state of the watched tasks, read after subscribing,
+        so no change is missed between two requests.
+    """
+
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping,
+                 event_hub: Optional[EventHub] = None):
+        """Constructor for API ressource rooted at /events/
+
+            Parameters:
+                database (DB): Database Object used for communication with sqlite3 db
+                ssh (Ssh): SSH Object used for communication with ssh endpoint
+                event_hub (EventHub): Hub publishing the state changes of the tasks
+        """
+        self.logger = logging.getLogger('papi.handler.Events')
+        self.database = database
+        self.ssh = ssh
+        self.config = config
+        self.event_hub = event_hub
+        events_config = self.config.get('EVENTS', {})
+        self.keepalive = events_config.get('KEEPALIVE', 15)
+        self.max_wait = events_config.get('MAX_WAIT', 60)
+
+    def __subscribe(self, args: Mapping) -> Subscription:
+        if self.event_hub is None:
+            raise RuntimeError("Events are not enabled")
+        group_id = args.get('batch_id', args.get('sweep_id'))
+        task_ids = None
+        try:
+            if group_id is not None:
+                group_id = int(group_id)
+            if args.get('ids'):
+                task_ids = [int(task_id) for task_id in args['ids'].split(',') if task_id]
+        except ValueError:
+            raise InvalidTaskIdError(f"Invalid task or group ids: '{dict(args)}'")
+        if group_id is None and not task_ids:
+            raise MissingInputParameterError("Expected ids, batch_id or sweep_id")
+        return self.event_hub.subscribe(task_ids=task_ids, group_id=group_id)
+
+    def __unsubscribe(self, subscription: Subscription):
+        if self.event_hub is not None:
+            self.event_hub.unsubscribe(subscription)
+
+    def __snapshot(self, subscription: Subscription) -> Mapping[str, str]:
+        """Returns the current status of every watched task by task id"""
+        states = {}
+        if subscription.task_ids:
+            states.update(self.database.get_task_states(task_ids=list(subscription.task_ids)))
+        if subscription.group_id is not None:
+            states.update(self.database.get_task_states(group_id=subscription.group_id))
+        return {str(task_id): map_task_state(state) for task_id, state in states.items()}
+
+    def __stream(self, subscription: Subscription):
+        """Yields the events of subscription as Server-Sent Events until the client is gone"""
+        try:
+            yield ": subscribed\n\n"
+            tasks = self.__snapshot(subscription)
+            yield f"event: snapshot\ndata: {json.dumps({'tasks': tasks})}\n\n"
+            while True:
+                events = subscription.get(timeout=self.keepalive)
+                if not events:
+                    yield ": keepalive\n\n"
+                for event in events:
+                    yield f"id: {event['id']}\nevent: state\ndata: {json.dumps(event)}\n\n"
+                if subscription.dropped:
+                    yield f"event: dropped\ndata: {subscription.dropped}\n\n"
+                    subscription.dropped = 0
+        finally:
+            self.__unsubscribe(subscription)
+
+    def __poll(self, subscription: Subscription, wait: float):
+        """Returns the current states and the events of subscription within wait seconds"""
+        try:
+            tasks = self.__snapshot(subscription)
+            events = subscription.get(timeout=wait)
+            end = time.monotonic() + 0.01
+            while time.monotonic() < end:
+                more = subscription.get(timeout=0.01)
+                if not more:
+                    break
+                events += more
+            return {'tasks': tasks, 'events': events, 'dropped': subscription.dropped}
+        finally:
+            self.__unsubscribe(subscription)
+
+    #@jwt_required
+    def get(self):
+        """Executed on HTTP GET send to API Endpoint /events/
+
+            Expects the query parameter ids=1,2,3 and/or batch_id or sweep_id.
+            With wait=<seconds> the request is answered like a long poll.
+
+            Returns:
+                An event stream (text/event-stream) or a JSON string with the events
+        """
+        wait = request.args.get('wait')
+        try:
+            if wait is not None:
+                try:
+                    wait = float(wait)
+                except ValueError:
+                    raise InputParameterMalformedError(f"Invalid wait: '{wait}'")
+                if not wait >= 0:
+                    raise InputParameterMalformedError(f"Invalid wait: '{wait}'")
+            subscription = self.__subscribe(request.args)
+            if wait is None:
+                return Response(stream_with_context(self.__stream(subscription)),
+                                mimetype='text/event-stream',
+                                headers={'Cache-Control': 'no-cache',
+                                         'X-Accel-Buffering': 'no'})
+            status_message = self.__poll(subscription, min(wait, self.max_wait))
+            status = 'ok'
+            code = self.config['HTTP']['OK_RESP_CODE']
+        except Exception as exception: #pylint: disable=broad-except
+            status = 'error'
+            status_message = str(exception)
+            code = self.config['HTTP']['CLIENT_ERR_RESP_CODE']
+            self.logger.error(status_message)
+
+        json_response = jsonify({'status': status,
+                                 'message': status_message})
+        json_response.status_code = code
+        return json_response
@@ -0,0 +1,86 @@
+"""This module only contrains the handler class for log requests"""
+import logging
+import os
+from typing import Mapping, List, Any
+from flask import Response, jsonify, request, send_file
+from flask_restful import Resource
+from papi.exceptions import InvalidTaskIdError, NonExistingTaskEntryError
+from papi.db import DB
+from papi.ssh import Ssh
+from papi.ssh.ssh import group_log_name
+
+LOG_STREAMS = ['stdout', 'stderr']
+READ_SIZE = 65536
+
+def concat_files(filenames: List[str]):
+    """Yields the content of the files one after the other"""
+    for filename in filenames:
+        with open(filename, 'rb') as log_file:
+            while True:
+                data = log_file.read(READ_SIZE)
+                if not data:
+                    break
+                yield data
+
+class Logs(Resource):
+    """Class to handle log GET requests
+
+        Streams the ssh output of all commands executed for a task from the log file on disk.
+        Tasks of batches and sweeps are submitted by one command per group, its log is
+        sent before the log of the later phases of the task.
+    """
+
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping):
+        """Constructor for API ressource rooted at /logs/<id>
+
+            Parameters:
+                database (DB): Database Object used for communication with sqlite3 db
+                ssh (Ssh): SSH Object used for communication with ssh endpoint
+        """
+        self.logger = logging.getLogger('papi.handler.Logs')
+        self.database = database
+        self.ssh = ssh
+        self.config = config
+
+    def __do(self, task_id: int, stream: str) -> List[str]:
+        if task_id <= 0:
+            raise InvalidTaskIdError(f'Invalid task id: {task_id}')
+        if stream not in LOG_STREAMS:
+            raise InvalidTaskIdError(f"Invalid stream '{stream}', expected one of {LOG_STREAMS}")
+        task = self.database.get_task(task_id)
+
+        log_names: List[Any] = [task_id]
+        if task.group_id is not None:
+            log_names.insert(0, group_log_name(task.group_id))
+        filenames = []
+        for log_name in log_names:
+            filename = self.ssh.get_log_filename(log_name, stream)
+            if filename is not None and os.path.isfile(filename):
+                filenames.append(filename)
+        if not filenames:
+            raise NonExistingTaskEntryError(f"No {stream} log for task {task_id}")
+        return filenames
+
+    #@jwt_required
+    def get(self, task_id: int):
+        """Executed on HTTP GET send to API Endpoint /logs/<id>
+
+            Parameters:
+                task_id (int): Remote task id.
+                stream (str): Query parameter, either 'stdout' (default) or 'stderr'
+
+            Returns:
+                The log file streamed as text/plain or a JSON error response
+        """
+        try:
+            filenames = self.__do(task_id, request.args.get('stream', 'stdout'))
+        except Exception as exception: #pylint: disable=broad-except
+            self.logger.error(str(exception))
+            json = jsonify({'status': 'error',
+                            'message': str(exception)})
+            json.status_code = self.config['HTTP']['CLIENT_ERR_RESP_CODE']
+            return json
+        if len(filenames) > 1:
+            return Response(concat_files(filenames), mimetype='text/plain')
+        # send_file hands the file to the WSGI file_wrapper, which uses sendfile where available
+        return send_file(filenames[0], mimetype='text/plain', conditional=True)
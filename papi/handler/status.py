@@ -1,35 +1,80 @@
 """This module only contrains the handler class for status requests"""
 import logging
-from typing import Mapping
-from flask import jsonify
+from typing import Mapping, Optional
+from flask import jsonify, request, make_response
 from flask_jwt_extended import jwt_required
 from flask_restful import Resource
-from papi.exceptions import InvalidTaskIdError
+from papi.exceptions import InvalidTaskIdError, MissingInputParameterError
 from papi.db import DB
 from papi.ssh import Ssh
+from .status_cache import StatusCache
+
+RUNNING_STATES = ['running', 'executed', 'archiving', 'archived', 'aggregating', 'pipelining',
+                  'pipelined']
+
+def map_task_state(state: str) -> str:
+    """Maps an internal task state to the state reported by the API
+
+        Returns 'queued', 'running', 'finished' or 'failed'
+    """
+    if state in RUNNING_STATES:
+        return 'running'
+    if state == 'submitting':
+        return 'queued'
+    if state in ['queued', 'finished', 'failed']:
+        return state
+    return 'failed'
 
 class Status(Resource):
     """Class to handle status GET request send to paramiko"""
 
-    def __init__(self, database: DB, ssh: Ssh, config: Mapping):
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping,
+                 status_cache: Optional[StatusCache] = None):
         """Constructor for API ressource rooted at /status/<id>
 
             Parameters:
                 database (DB): Database Object used for communication with sqlite3 db
                 ssh (Ssh): SSH Object used for communication with ssh endpoint
+                status_cache (StatusCache): Cache of rendered responses, None disables caching
         """
         self.logger = logging.getLogger('papi.handler.Submit')
         self.database = database
         self.ssh = ssh
         self.config = config
         self.jwt_enabled = self.config['JWT_REQUIRED']
+        self.status_cache = status_cache
+
+    @staticmethod
+    def etag(task_id: int, revision: int) -> str:
+        """Returns the ETag of the status of a task in the given revision"""
+        return f"{task_id}-{revision}"
+
+    def __revision(self, task_id: int) -> int:
+        """Returns the current revision of a task without rendering its status"""
+        if self.status_cache is not None:
+            cached = self.status_cache.get(task_id)
+            if cached is not None:
+                return cached[2]
+        return self.database.get_task_revision(task_id)
 
     def __do(self, task_id: int):
-        status_message = {'message': ''}
-        status = ''
         if task_id <= 0:
             raise InvalidTaskIdError(f'Invalid task id: {task_id}')
+        if self.status_cache is None:
+            return self.__render(task_id)[1:]
+
+        cached = self.status_cache.get(task_id)
+        if cached is not None:
+            return cached
+        token = self.status_cache.token()
+        state, status, status_message, revision = self.__render(task_id)
+        self.status_cache.put(task_id, state, (status, status_message, revision), token)
+        return status, status_message, revision
 
+    def __render(self, task_id: int):
+        """Returns the internal state, the API status, the message and the revision of a task"""
+        status_message = {'message': ''}
+        status = ''
         try:
             db_entry = self.database.get_task(task_id)
         except Exception as exception:
@@ -37,13 +82,11 @@ class Status(Resource):
             raise exception
 
         task_id = db_entry.id
-        status = db_entry.state
+        status = map_task_state(db_entry.state)
 
-        if status in ['queued']:
+        if status in ['queued', 'running']:
             pass
-        elif status in ['running', 'executed', 'archiving', 'archived', 'aggregating']:
-            status = 'running'
-        elif status == 'failed':
+        elif status == 'failed' and db_entry.state == 'failed':
             slurm_jobs = self.database.get_slurm_jobs(task_id=task_id)
             status_message['message'] = f"Slurm job(s) {slurm_jobs} failed"
         elif status == 'finished':
@@ -55,10 +98,9 @@ class Status(Resource):
                              }
 
         else:
-            status_message['message'] = f"Unknown Task state '{status}'"
+            status_message['message'] = f"Unknown Task state '{db_entry.state}'"
             self.logger.error(status_message)
-            status = 'failed'
-        return status, status_message
+        return db_entry.state, status, status_message, db_entry.revision
 
     #@jwt_required
     def get(self, task_id: int):
@@ -68,17 +110,134 @@ class Status(Resource):
                 task_id (int): Remote task id.
                                Corresponding internal task id is in sqlite3db.
 
+            The response carries an ETag of the task revision. Requests with a matching
+            If-None-Match header are answered with 304 Not Modified and no body.
+
             Returns:
                 json(str): JSON string with Success or Error response returned in HTTP Response
         """
         status_message = ''
+        etag = None
+        try:
+            if request.if_none_match and task_id > 0:
+                etag = self.etag(task_id, self.__revision(task_id))
+                if request.if_none_match.contains(etag):
+                    response = make_response('', 304)
+                    response.set_etag(etag)
+                    return response
+            status, status_message, revision = self.__do(task_id)
+            etag = self.etag(task_id, revision)
+        except Exception as exception: #pylint: disable=broad-except
+            status = 'error'
+            status_message = str(exception)
+            etag = None
+            self.logger.error(status_message)
+
+        json = jsonify({'status': status,
+                        'message': status_message})
+        if etag is not None:
+            json.set_etag(etag)
+        return json
+
+class StatusBatch(Resource):
+    """Class to handle status requests for many tasks at once
+
+        The tasks are given as list of ids or as id of a batch or sweep. All states are
+        read by a single query and mapped like the states of single status requests.
+        The tasks of a group are paged by task id, at most MAX_STATUS_TASKS per request.
+    """
+
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping):
+        """Constructor for API ressource rooted at /status/
+
+            Parameters:
+                database (DB): Database Object used for communication with sqlite3 db
+                ssh (Ssh): SSH Object used for communication with ssh endpoint
+        """
+        self.logger = logging.getLogger('papi.handler.StatusBatch')
+        self.database = database
+        self.ssh = ssh
+        self.config = config
+        self.max_tasks = self.config.get('MAX_STATUS_TASKS', 1000)
+
+    def __parse_ids(self, task_ids) -> list:
+        if isinstance(task_ids, str):
+            task_ids = [task_id for task_id in task_ids.split(',') if task_id.strip()]
+        if not isinstance(task_ids, list) or not task_ids:
+            raise MissingInputParameterError("Expected a non empty list of task ids")
+        if len(task_ids) > self.max_tasks:
+            raise InvalidTaskIdError((f"Request of {len(task_ids)} tasks exceeds the "
+                                      f"limit of {self.max_tasks}"))
+        try:
+            task_ids = [int(task_id) for task_id in task_ids]
+        except (TypeError, ValueError):
+            raise InvalidTaskIdError(f"Invalid task ids: {task_ids}")
+        if min(task_ids) <= 0:
+            raise InvalidTaskIdError(f"Invalid task id: {min(task_ids)}")
+        return task_ids
+
+    def __do(self, args: Mapping):
+        group_id = args.get('batch_id', args.get('sweep_id'))
+        if group_id is not None:
+            try:
+                group_id = int(group_id)
+                after = int(args.get('after', 0))
+            except (TypeError, ValueError):
+                raise InvalidTaskIdError(f"Invalid group id or cursor: {group_id}")
+            states = self.database.get_task_states(group_id=group_id, after=after,
+                                                   limit=self.max_tasks + 1)
+            more = len(states) > self.max_tasks
+            task_ids = sorted(states)[:self.max_tasks]
+            return {'tasks': {str(task_id): map_task_state(states[task_id])
+                              for task_id in task_ids},
+                    'missing': [],
+                    'next': task_ids[-1] if task_ids else after,
+                    'more': more}
+        task_ids = self.__parse_ids(args.get('ids', args.get('task_ids')))
+        states = self.database.get_task_states(task_ids=task_ids)
+        missing = [task_id for task_id in task_ids if task_id not in states]
+        return {'tasks': {str(task_id): map_task_state(state)
+                          for task_id, state in sorted(states.items())},
+                'missing': missing}
+
+    def __respond(self, args: Mapping):
+        status_message = ''
+        status = 'ok'
+        code = self.config['HTTP']['OK_RESP_CODE']
         try:
-            status, status_message = self.__do(task_id)
+            status_message = self.__do(args)
         except Exception as exception: #pylint: disable=broad-except
             status = 'error'
             status_message = str(exception)
+            code = self.config['HTTP']['CLIENT_ERR_RESP_CODE']
             self.logger.error(status_message)
 
         json = jsonify({'status': status,
                         'message': status_message})
+        json.status_code = code
         return json
+
+    #@jwt_required
+    def get(self):
+        """Executed on HTTP GET send to API Endpoint /status/
+
+            Expects the query parameter ids=1,2,3 or batch_id or sweep_id, the tasks of a
+            group after the task id after=<next> of the previous response
+
+            Returns:
+                json(str): JSON string with the status of every task and the missing task ids
+        """
+        return self.__respond(request.args)
+
+    #@jwt_required
+    def post(self):
+        """Executed on HTTP POST send to API Endpoint /status/
+
+            Expects a JSON object {"task_ids": [..]}, {"batch_id": .., "after": ..} or
+            {"sweep_id": .., "after": ..}
+
+            Returns:
+                json(str): JSON string with the status of every task and the missing task ids
+        """
+        payload = request.get_json(silent=True)
+        return self.__respond(payload if isinstance(payload, dict) else {})
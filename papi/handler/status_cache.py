@@ -0,0 +1,78 @@
+"""In-process cache of rendered status responses"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Mapping, Optional, Any, Dict
+
+# Task states which never change again, their status is cached without TTL
+TERMINAL_STATES = ['finished', 'failed']
+
+class StatusCache:
+    """LRU cache of status responses by task id with a TTL for non terminal states
+
+        Entries are invalidated through the state and job listeners of the database.
+        A value read from the database is only stored if its task was not invalidated
+        since the read started, see token.
+
+        Parameters:
+            config: cache config dict (see CONFIG['PAPI']['STATUS_CACHE'])
+    """
+    def __init__(self, config: Optional[Mapping] = None):
+        config = config if config is not None else {}
+        self.max_size = config.get('MAX_SIZE', 10000)
+        self.ttl = config.get('TTL', 5)
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.invalidations: OrderedDict = OrderedDict()
+        self.invalidation_floor = 0
+        self.sequence = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, task_id: int) -> Optional[Any]:
+        """Returns the cached status of a task or None"""
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self.entries.move_to_end(task_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[task_id]
+            self.misses += 1
+            return None
+
+    def token(self) -> int:
+        """Returns the token to pass to put for a database read started now"""
+        with self.lock:
+            return self.sequence
+
+    def put(self, task_id: int, state: str, value: Any, token: int):
+        """Stores the status of a task read in state unless the task changed since token"""
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if self.invalidations.get(task_id, self.invalidation_floor) > token:
+                return
+            expires = None if state in TERMINAL_STATES else time.monotonic() + self.ttl
+            self.entries[task_id] = (expires, value)
+            self.entries.move_to_end(task_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, task_id: int, *args):
+        """Removes a task, usable as state listener and job listener of the database"""
+        #pylint: disable=unused-argument
+        with self.lock:
+            self.sequence += 1
+            self.entries.pop(task_id, None)
+            self.invalidations[task_id] = self.sequence
+            self.invalidations.move_to_end(task_id)
+            while len(self.invalidations) > max(self.max_size, 1):
+                _, sequence = self.invalidations.popitem(last=False)
+                self.invalidation_floor = max(self.invalidation_floor, sequence)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit and miss counters and the number of cached entries"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
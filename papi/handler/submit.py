@@ -1,25 +1,44 @@
 """This module only contrains the handler class for submit requests"""
 
 import logging
-from typing import Mapping
+from typing import Mapping, Optional
 from flask import jsonify, request
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required
 from papi.exceptions import (MissingInputParameterError, MissingPayloadError,
-                             InputParameterMalformedError)
+                             InputParameterMalformedError, SubmitQueueFullError)
 from papi.util import parse_slurm_output
-from papi.db import SlurmJob, DB
+from papi.db import SlurmJob, DB, Transition
 from random import randrange
 from papi.ssh import Ssh
+
+def validate_payload(payload, fields_required: Mapping):
+    """Checks that all required fields are in payload and converts them to their type
+
+        Raises MissingPayloadError, MissingInputParameterError or InputParameterMalformedError
+    """
+    if not isinstance(payload, dict):
+        raise MissingPayloadError(f"Expected a JSON object as payload got: '{payload}'")
+    for param in fields_required:
+        if param not in payload:
+            raise MissingInputParameterError((f"Missing required Parameter: "
+                                              f"{param} got: '{payload}'"))
+        try:
+            payload[param] = fields_required[param](payload[param])
+        except Exception as exception:
+            raise InputParameterMalformedError(f"Parameter {param}: '{exception}'")
+    return payload
+
 class Submit(Resource):
     """Class to handle submit POST request send to paramiko"""
 
-    def __init__(self, database: DB, ssh: Ssh, config: Mapping):
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping, dispatcher=None):
         """Constructor for API ressource rooted at /submit/<id>
 
             Parameters:
                 database (DB): Database Object used for communication with sqlite3 db
                 ssh (Ssh): SSH Object used for communication with ssh endpoint
+                dispatcher (SubmitDispatcher): Submits in the background, None submits inline
         """
         self.config = config
         self.fields_required = self.config['SUBMIT_FIELDS_REQUIRED']
@@ -27,6 +46,9 @@ class Submit(Resource):
         self.database = database
         self.ssh = ssh
         self.jwt_required = self.config['JWT_REQUIRED']
+        self.pipelined = self.config.get('PIPELINED', False)
+        self.cache_config = self.config.get('CACHE', {})
+        self.dispatcher = dispatcher
 
     def submit_task_finished(self, return_value: int, stdout: str, stderr: str, task_id: int):
         """Callback for sshRunner
@@ -50,10 +72,95 @@ class Submit(Resource):
             self.logger.info("Task execution of task '%s' is finished. "
                              "Running on cluster '%s' with id '%d'",\
                              str(task_id), str(cluster), slurm_job_id)
-        self.database.add_slurm_job(SlurmJob(job_id=slurm_job_id, cluster=cluster,\
-                                    job_type='main', ssh_rc=return_value,\
-                                    ssh_stdout=stdout, ssh_stderr=stderr, task_id=task_id))
-        self.database.set_task_state(task_id, 'running')
+        job = SlurmJob(job_id=slurm_job_id, cluster=cluster, job_type='main',
+                       ssh_rc=return_value, ssh_stdout=stdout, ssh_stderr=stderr, task_id=task_id)
+        if slurm_job_id == -1:
+            self.database.apply_transitions([Transition(task_id, 'failed', job)])
+        elif not self.pipelined:
+            self.database.apply_transitions([Transition(task_id, 'running', job)])
+        else:
+            self.database.apply_transitions([Transition(task_id, 'pipelining', job)])
+            self._queue_phase(task_id, self.ssh.collect_task, self.pipeline_collect_finished,
+                              slurm_job_id, 'running')
+
+    def _queue_phase(self, task_id: int, submit, callback, dependency, fallback: str):
+        """Queues the next phase of a pipelined task with a dependency on its previous job
+
+            If the command cannot be executed, the task falls back to the phase fallback of
+            its last queued job, so the runner submits the remaining phases once it completed.
+        """
+        #pylint: disable=too-many-arguments
+        try:
+            submit(self.database.get_task(task_id), callback, dependency=dependency)
+        except Exception as exception: #pylint: disable=broad-except
+            self.logger.error("Queueing the next phase of task '%s' failed, continue in "
+                              "phase '%s': '%s'", str(task_id), fallback, str(exception))
+            self.database.apply_transitions([Transition(task_id, fallback,
+                                                        expected_state='pipelining')])
+
+    def __pipeline_job_finished(self, return_value: int, stdout: str, stderr: str, task_id: int,
+                                job_type: str, state: Optional[str] = None):
+        """Stores the slurm job of a pipelined phase and returns its id or -1 on errors
+
+            The task is set to state along with the job, or to 'failed' on errors, unless it
+            left the state 'pipelining' in the meantime
+        """
+        #pylint: disable=too-many-arguments
+        slurm_job_id = -1
+        cluster = ''
+        if return_value != 0:
+            self.logger.error("Error wrapper script returned "
+                              "a non zero exit code: '%s' output: '%s'",\
+                              str(return_value), str(stderr))
+        else:
+            slurm_job_id, cluster = parse_slurm_output(stdout)
+            self.logger.info("Queued %s job of task '%s' on cluster '%s' with id '%d'",\
+                             job_type, str(task_id), str(cluster), slurm_job_id)
+        job = SlurmJob(job_id=slurm_job_id, cluster=cluster, job_type=job_type,
+                       ssh_rc=return_value, ssh_stdout=stdout, ssh_stderr=stderr, task_id=task_id)
+        if slurm_job_id == -1:
+            state = 'failed'
+        if state is None:
+            self.database.add_slurm_job(job)
+        else:
+            self.database.apply_transitions([Transition(task_id, state, job,
+                                                        expected_state='pipelining')])
+        return slurm_job_id
+
+    def pipeline_collect_finished(self, return_value: int, stdout: str, stderr: str, task_id: int):
+        """Callback for sshRunner in pipelined mode
+
+            Executed after the collect job was queued with a dependency on the main job.
+            Queues the archive job with a dependency on the collect job.
+        """
+        slurm_job_id = self.__pipeline_job_finished(return_value, stdout, stderr, task_id,
+                                                    'aggregation')
+        if slurm_job_id != -1:
+            self._queue_phase(task_id, self.ssh.archive_task, self.pipeline_archive_finished,
+                              slurm_job_id, 'aggregating')
+
+    def pipeline_archive_finished(self, return_value: int, stdout: str, stderr: str, task_id: int):
+        """Callback for sshRunner in pipelined mode
+
+            Executed after the archive job was queued. From now on only the archive job is checked.
+        """
+        self.__pipeline_job_finished(return_value, stdout, stderr, task_id, 'archive', 'pipelined')
+
+    def __add_task(self, payload):
+        """Stores the task of a payload and returns it along with 'created' or 'cached'"""
+        if 'debug' in payload:
+            return self.database.add_task(payload, debug=True), 'created'
+        if self.cache_config.get('ENABLED', False):
+            bypass = str(payload.get('no_cache', False)).lower() in ['1', 'true', 'yes']
+            task, created = self.database.add_task_cached(payload,
+                                                          ttl=self.cache_config.get('TTL'),
+                                                          bypass=bypass)
+            if not created:
+                self.logger.info("Attach submit to task '%s' with identical parameters",\
+                                 str(task.id))
+                return task, 'cached'
+            return task, 'created'
+        return self.database.add_task(payload), 'created'
 
     def __do(self):
         payload = ''
@@ -62,34 +169,41 @@ class Submit(Resource):
         except Exception:
             raise MissingPayloadError("Missing JSON payload in HTTP request")
 
-        for param in self.fields_required:
-            if param not in payload:
-                raise MissingInputParameterError((f"Missing required Parameter: "
-                                                  f"{param} got: '{payload}'"))
-            try:
-                payload[param] = self.fields_required[param](payload[param])
-            except Exception as exception:
-                raise InputParameterMalformedError(f"Parameter {param}: '{exception}'")
+        validate_payload(payload, self.fields_required)
+        self.logger.debug("JSON Payload: '%s'", str(payload))
 
-        if 'debug' in payload:
-            task = self.database.add_task(payload, debug=True)
-        else:
-            task = self.database.add_task(payload)
+        if self.dispatcher is not None and 'debug' not in payload:
+            self.dispatcher.reserve()
+            try:
+                task, status = self.__add_task(payload)
+            except Exception:
+                self.dispatcher.cancel()
+                raise
+            if status == 'created':
+                self.dispatcher.submit(task.id)
+            else:
+                self.dispatcher.cancel()
+            return task.id, status
 
-        try:
-            self.logger.debug("JSON Payload: '%s'", str(payload))
-            params = self.database.get_param_from_task(task)
-            if 'debug' not in payload:
+        task, status = self.__add_task(payload)
+        if status == 'created' and 'debug' not in payload:
+            try:
+                params = self.database.get_param_from_task(task)
                 self.ssh.submit_task(task.id, params, self.submit_task_finished)
-        except Exception as exception:
-            self.logger.error(exception)
-            raise exception
-        return task.id
+            except Exception as exception:
+                self.logger.error(exception)
+                raise exception
+        return task.id, status
 
     #@jwt_required
     def post(self):
         """Executed on HTTP POST send to API Endpoint /submit/
 
+            If a task with identical parameters exists, its id is returned with status
+            'cached' instead of submitting a new task. Set 'no_cache' in the payload to bypass.
+            With a dispatcher the task is submitted in the background and the request is
+            rejected with TOO_MANY_REQUESTS_RESP_CODE if the submit queue is full.
+
             Returns:
                 json(str): JSON string with Success or Error response returned in HTTP Response
         """
@@ -98,7 +212,11 @@ class Submit(Resource):
         status = 'created'
         code = self.config['HTTP']['OK_RESP_CODE']
         try:
-            status_message = self.__do()
+            status_message, status = self.__do()
+        except SubmitQueueFullError as exception:
+            status = 'error'
+            status_message = str(exception)
+            code = self.config['HTTP'].get('TOO_MANY_REQUESTS_RESP_CODE', 429)
         except Exception as exception: #pylint: disable=broad-except
             status = 'error'
             status_message = str(exception)
@@ -0,0 +1,193 @@
+"""This module only contrains the handler class for parameter sweep requests"""
+
+import itertools
+from json import dumps, loads
+import logging
+import threading
+from typing import Mapping, Dict, List
+from flask import jsonify, request
+from papi.exceptions import (MissingPayloadError, MissingInputParameterError,
+                             InputParameterMalformedError, ExpansionConflictError)
+from papi.util import axis_size, expand_axis, grid_size, iter_grid, chunk_list
+from papi.db import DB
+from papi.ssh import Ssh
+from .batch import SubmitBatch
+from .status import map_task_state
+
+class Sweep(SubmitBatch):
+    """Class to handle parameter sweep requests
+
+        A sweep is the cartesian grid over value lists or ranges of every submit field.
+        The grid is expanded lazily in a background thread, stored and submitted in
+        chunks of SWEEP_CHUNK_SIZE tasks, each chunk as one slurm job array. The axes
+        and the number of stored grid points are kept in the group of the sweep, so an
+        expansion stopped by a restart is continued by resume.
+    """
+
+    def __init__(self, database: DB, ssh: Ssh, config: Mapping, dispatcher=None):
+        """Constructor for API ressource rooted at /sweep/ and /sweep/<id>
+
+            Parameters:
+                database (DB): Database Object used for communication with sqlite3 db
+                ssh (Ssh): SSH Object used for communication with ssh endpoint
+                dispatcher (SubmitDispatcher): Submits in the background, None submits inline
+        """
+        SubmitBatch.__init__(self, database, ssh, config, dispatcher)
+        self.logger = logging.getLogger('papi.handler.Sweep')
+        self.max_sweep_size = self.config.get('MAX_SWEEP_SIZE', 100000)
+        self.chunk_size = self.config.get('SWEEP_CHUNK_SIZE', 1000)
+
+    def __check_size(self, payload):
+        """Rejects a sweep with more than MAX_SWEEP_SIZE points before any axis is expanded"""
+        size = 1
+        for param in self.fields_required:
+            if param not in payload:
+                raise MissingInputParameterError((f"Missing required Parameter: "
+                                                  f"{param} got: '{payload}'"))
+            try:
+                count = axis_size(payload[param])
+            except Exception as exception:
+                raise InputParameterMalformedError(f"Parameter {param}: '{exception}'")
+            size *= count
+            if count > self.max_sweep_size or size > self.max_sweep_size:
+                raise InputParameterMalformedError((f"Sweep exceeds the limit of "
+                                                    f"{self.max_sweep_size} tasks"))
+
+    def __parse_axes(self, payload) -> Dict[str, List]:
+        """Expands and converts the values of every axis of the sweep"""
+        if not isinstance(payload, dict):
+            raise MissingPayloadError(f"Expected a JSON object as payload got: '{payload}'")
+        self.__check_size(payload)
+        axes = {}
+        for param in self.fields_required:
+            try:
+                values = expand_axis(payload[param])
+                axes[param] = [self.fields_required[param](value) for value in values]
+            except Exception as exception:
+                raise InputParameterMalformedError(f"Parameter {param}: '{exception}'")
+            if not axes[param]:
+                raise InputParameterMalformedError(f"Parameter {param}: no values")
+        return axes
+
+    def expand(self, group_id: int):
+        """Stores and submits the grid points after the stored ones chunk by chunk
+
+            With a dispatcher every chunk waits for a free slot of the submit queue. Every
+            chunk advances the cursor of the group in its transaction, an expansion which
+            is overtaken by another one stops.
+        """
+        try:
+            group = self.database.get_task_group(group_id)
+            cursor = group.expanded
+            points = itertools.islice(iter_grid(loads(group.params)), cursor, None)
+            for chunk in chunk_list(points, self.chunk_size):
+                if self.dispatcher is not None:
+                    self.dispatcher.reserve(blocking=True)
+                try:
+                    _, tasks = self.database.add_tasks(chunk, group_id=group_id, cursor=cursor)
+                except Exception:
+                    if self.dispatcher is not None:
+                        self.dispatcher.cancel()
+                    raise
+                cursor += len(tasks)
+                self.submit_array(group_id, tasks)
+            self.database.set_group_expansion(group_id, complete=True)
+            self.logger.info("Sweep '%s' is expanded", str(group_id))
+        except ExpansionConflictError:
+            self.logger.info("Sweep '%s' is expanded by another thread", str(group_id))
+        except Exception as exception: #pylint: disable=broad-except
+            self.logger.error("Expanding sweep '%s' failed: '%s'", str(group_id), str(exception))
+            try:
+                self.database.set_group_expansion(group_id, error=str(exception))
+            except Exception as error: #pylint: disable=broad-except
+                self.logger.error("Storing the error of sweep '%s' failed: '%s'",\
+                                  str(group_id), str(error))
+
+    def resume(self) -> int:
+        """Continues the expansion of all incomplete sweeps and returns their number
+
+            Sweeps whose expansion failed are retried. If the process creating a sweep is
+            still expanding it, the expansion which falls behind stops.
+        """
+        group_ids = self.database.get_incomplete_groups('sweep')
+        for group_id in group_ids:
+            self.logger.info("Resume the expansion of sweep '%s'", str(group_id))
+            thread = threading.Thread(target=self.expand, args=(group_id,), daemon=True)
+            thread.start()
+        return len(group_ids)
+
+    def __create(self):
+        payload = None
+        try:
+            payload = request.json
+        except Exception:
+            raise MissingPayloadError("Missing JSON payload in HTTP request")
+        axes = self.__parse_axes(payload)
+        size = grid_size(axes)
+        group_id = self.database.add_task_group('sweep', size, params=dumps(axes))
+        thread = threading.Thread(target=self.expand, args=(group_id,), daemon=True)
+        thread.start()
+        return {'sweep_id': group_id, 'size': size}
+
+    def __progress(self, sweep_id: int):
+        group, counts = self.database.get_group_progress(sweep_id)
+        states: Dict[str, int] = {}
+        for state, count in counts.items():
+            status = map_task_state(state)
+            states[status] = states.get(status, 0) + count
+        return {'sweep_id': group.id,
+                'size': group.size,
+                'expanded': group.expanded,
+                'complete': group.complete,
+                'error': group.error,
+                'states': states}
+
+    #@jwt_required
+    def post(self, sweep_id=None):
+        """Executed on HTTP POST send to API Endpoint /sweep/
+
+            Expects a JSON object with a list, a single value or a range
+            {"start": .., "stop": .., "step": ..} for every submit field
+
+            Returns:
+                json(str): JSON string with sweep id and number of tasks or an error response
+        """
+        #pylint: disable=arguments-differ,unused-argument
+        status_message = ''
+        status = 'created'
+        code = self.config['HTTP']['OK_RESP_CODE']
+        try:
+            status_message = self.__create()
+        except Exception as exception: #pylint: disable=broad-except
+            status = 'error'
+            status_message = str(exception)
+            code = self.config['HTTP']['CLIENT_ERR_RESP_CODE']
+
+        json = jsonify({'status': status,
+                        'message': status_message})
+        json.status_code = code
+        return json
+
+    #@jwt_required
+    def get(self, sweep_id: int = 0):
+        """Executed on HTTP GET send to API Endpoint /sweep/<id>
+
+            Returns:
+                json(str): JSON string with the size of the sweep, the number of
+                           expanded tasks, whether the expansion is complete, the error
+                           it stopped with and the number of tasks per state
+        """
+        status_message = ''
+        status = 'ok'
+        code = self.config['HTTP']['OK_RESP_CODE']
+        try:
+            status_message = self.__progress(sweep_id)
+        except Exception as exception: #pylint: disable=broad-except
+            status = 'error'
+            status_message = str(exception)
+            code = self.config['HTTP']['CLIENT_ERR_RESP_CODE']
+
+        json = jsonify({'status': status,
+                        'message': status_message})
+        json.status_code = code
+        return json
@@ -3,24 +3,30 @@
     It initialises the following objects:
         db: The Database handler
         ssh: The SSH handler
-        runner: An asynchronous runner used to query slurm via ssh
+        worker: Runs the runner and the submit dispatcher (see papi.worker)
                 The runner checks the state of running slurm jobs and keeps the database in sync
+                None in api_only mode, where a separate papi-worker process does this
+        dispatcher: Submits stored tasks in the background, None if submits are inline
 """
 
 import logging
+from typing import Optional
 from werkzeug.datastructures import ImmutableDict
 from flask import Flask
 from flask_restful import Api, Resource
 from flask_jwt_extended import JWTManager
 from .db.viwa_db import ViwaDb
 from .ssh import Ssh
-from .async_runner import AsyncRunner
+from .handler.status_cache import StatusCache
+from .handler.event_hub import EventHub
+from .handler.dispatcher import SubmitDispatcher
+from .worker import Worker
 class Papi:
     """A single instance of the API
 
         Starts necessary parts of the module
     """
-    def __init__(self, config: ImmutableDict):
+    def __init__(self, config: ImmutableDict, api_only: bool = False):
         """Constructor for the API endpoint
 
             Parameters:
@@ -31,17 +37,39 @@ class Papi:
                 debug (bool): Debug Flag makes output more verbose
                 keyfile (str): Filename of the RSA key used for auth
                 dbfile (str): Filename of the sq lite3 db used for storing job id associations
+                api_only (bool): Only serve HTTP and store submitted tasks, which are
+                                 submitted and checked by a separate papi-worker process
         """
         self.config = config['PAPI']
         self.database = ViwaDb(config['DB'])
-        self.ssh = Ssh(config['SSH'], self.database)
+        self.ssh = Ssh(config['SSH'], self.database, config['PAPI']['BASE_DIR'])
+        self.status_cache = StatusCache(self.config.get('STATUS_CACHE'))
+        self.database.add_state_listener(self.status_cache.invalidate)
+        self.database.add_job_listener(self.status_cache.invalidate)
+        self.event_hub = EventHub(self.database, self.config.get('EVENTS'))
+        if api_only or (self.config.get('ELECTION') or {}).get('ENABLED', False):
+            # State changes are made by other processes, follow them in the journal
+            self.event_hub.add_journal_listener(self.status_cache.invalidate)
+            self.event_hub.follow_journal()
+        else:
+            self.database.add_state_listener(self.event_hub.publish)
         self.app = Flask(__name__)
         self.logger = logging.getLogger('papi.Papi')
-        self.runner = AsyncRunner(self.ssh, self.database, self.config['SLEEP_TIMER'])
         self.app.debug = config['DEBUG']['ENABLED']
         self.__jwt()
         self.api = Api(self.app)
-        self.runner.run()
+        self.worker = None
+        self.runner = None
+        if api_only:
+            # Never started, it only reserves slots and leaves the tasks to the worker
+            self.dispatcher: Optional[SubmitDispatcher] = SubmitDispatcher(self.database,
+                                                                           self.ssh, self.config)
+        else:
+            dispatcher = (self.config.get('DISPATCHER') or {}).get('ENABLED', False)
+            self.worker = Worker(config, self.database, self.ssh, dispatcher=dispatcher)
+            self.runner = self.worker.runner
+            self.dispatcher = self.worker.dispatcher
+            self.worker.start()
 
     def __jwt(self):
         self.app.config['JWT_PUBLIC_KEY'] = self.open_pub_key(self.config['BASE_DIR'] + self.config['HTTP']['JWT_SECRET_KEY'])
@@ -65,16 +93,19 @@ class Papi:
             raise
         return content
 
-    def add_resource(self, res: Resource, path: str):
+    def add_resource(self, res: Resource, *paths: str, **kwargs):
         """Wrapper Function to add API Endpoint
 
             Parameters:
                 res (Class(Ressource)): Ressource class which is
                                         inherits from Ressource class
                                         defined in flask_restful.
-                path (str): API path which executes the defined res class
+                paths (str): API paths which execute the defined res class
+                kwargs: Additional keyword arguments of the res constructor
 
             Returns:
                 None
         """
-        self.api.add_resource(res, path, resource_class_args=(self.database, self.ssh, self.config))
+        self.api.add_resource(res, *paths,
+                              resource_class_args=(self.database, self.ssh, self.config),
+                              resource_class_kwargs=kwargs)
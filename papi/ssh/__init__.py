@@ -2,6 +2,8 @@
 
     Classes:
         ssh: Used for standard blocking ssh connections
+        SshPool: Pool of persistent transports shared by all ssh commands
+        SshRouter: Routes the ssh commands over the pools of several login hosts
         sshRunner: Asynchronous fifo based non-blocking ssh connections
                    It is used for long running ssh connections, which are checked periodically
 """
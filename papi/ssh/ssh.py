@@ -2,50 +2,58 @@
 
     Classes:
         ssh: Used for standard blocking ssh connections
+        SshPool: Pool of persistent transports shared by all ssh commands
+        SshRouter: Routes the ssh commands over the pools of several login hosts
         sshRunner: Asynchronous fifo based non-blocking ssh connections
                    It is used for long running ssh connections, which are checked periodically
 """
 import logging
 import os
-from typing import Mapping
-import paramiko
+import socket
+from typing import Mapping, List, Optional
 from papi.db import DB
 from .ssh_reader import SshReader
+from .ssh_router import SshRouter
+
+def group_log_name(group_id: int) -> str:
+    """Returns the name of the log files of the job array submit of a group"""
+    return f"group_{group_id}"
 
 class Ssh:
-    """Main ssh Interface"""
-    def __init__(self, config: Mapping, db: DB):
+    """Main ssh Interface
+
+        Parameters:
+            config: ssh config dict (see CONFIG['SSH'])
+            db: Database used to read the parameters of tasks
+            base_dir: Directory relative paths are resolved against (CONFIG['PAPI']['BASE_DIR'])
+    """
+    def __init__(self, config: Mapping, db: DB, base_dir: str = ''):
         self.config = config
         self.database = db
         self.logger = logging.getLogger('papi.Ssh')
-        self.ssh_reader = SshReader()
+        self.ssh_reader = SshReader(self.config.get('READER'), base_dir)
+        self.pool = SshRouter(self.config)
         self.key_filename = self.config['KEY_FILENAME']
         if os.path.isfile(self.key_filename):
-            self.__key_filename = self.key_filename
-
-    def __get_ssh_client(self, timeout=None):
-        """Returns a default paramiko ssh client"""
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.load_system_host_keys()
-        ssh_client.connect(self.config['HOSTNAME'], self.config['PORT'], self.config['USERNAME'],\
-                           self.config['PASSWORD'], key_filename=self.__key_filename,\
-                           timeout=timeout)
-        return ssh_client
-
-    def __execute(self, command: str, callback, task_id=0) -> int:
+            self.pool.set_key_filename(self.key_filename)
+
+    def __execute(self, command: str, callback, task_id=0, stdin=None, log_name=None) -> int:
         """ Executes an arbitrary command via ssh and returns the stdout output
 
             Parameters:
                 command(str): Command to execute
+                stdin(bytes): Data written to stdin of the command
+                log_name(str): Name of the log files, defaults to task_id
 
             Returns:
                 result: stdout of executed ssh remote cmd
 
         """
+        #pylint: disable=too-many-arguments
         self.logger.debug("Send async ssh cmd: '%s', callback: '%s'", str(command), str(callback))
-        ssh_client = self.__get_ssh_client()
-        self.ssh_reader.add_object(ssh_client, command, callback, task_id)
+        channel = self.pool.open_channel()
+        self.ssh_reader.add_object(channel, command, callback, task_id, self.pool.release,
+                                   stdin=stdin, log_name=log_name)
         return 0
 
     def __execute_blocking(self, command, timeout=None):
@@ -58,32 +66,80 @@ class Ssh:
                 result: stdout of executed ssh remote cmd
         """
         self.logger.debug("Send blocking ssh cmd: '%s'", str(command))
-        ssh_client = self.__get_ssh_client(timeout=timeout)
-        (_, stdout, _) = ssh_client.exec_command(command, timeout=timeout)
-        result = stdout.read()
-        ssh_client.close()
+        channel = self.pool.open_channel(timeout=timeout)
+        try:
+            channel.settimeout(timeout)
+            channel.exec_command(command)
+            result = channel.makefile('rb').read()
+        except socket.timeout as exception:
+            self.pool.report_error(channel, exception)
+            raise
+        finally:
+            self.pool.release(channel)
         return result.decode('utf-8')
 
+    def set_reader(self, reader: SshReader):
+        """Replaces the reader watching the commands executed without blocking"""
+        self.ssh_reader = reader
+
+    def get_log_filename(self, log_name, stream: str = 'stdout') -> Optional[str]:
+        """Returns the file with the full ssh output of a task or None if logging is disabled
+
+            log_name is the task id or group_log_name(group_id) for the submit of a job array
+        """
+        return self.ssh_reader.get_log_filename(log_name, stream)
+
     def submit_task(self, task_id: int, params: str, callback):
         """Executes command defined in config dictionary to submit a task and returns the output"""
         cmd = self.config['SUBMIT_COMMAND'] + " " + params
         return self.__execute(cmd, callback, task_id)
 
+    def submit_array(self, group_id: int, params: List[str], callback):
+        """Executes the command defined in config dictionary to submit a slurm job array
+
+            The parameters of array index i are sent in line i on stdin of the command.
+            The callback is executed with the group id as task id.
+        """
+        stdin = ''.join(f"{line}\n" for line in params).encode('utf-8')
+        return self.__execute(self.config['SUBMIT_ARRAY_COMMAND'], callback, group_id,
+                              stdin=stdin, log_name=group_log_name(group_id))
+
+    def check_command(self, slurm_job_id, cluster_name) -> str:
+        """Returns the command defined in config dictionary to get the status of jobs"""
+        return f"{self.config['CHECK_COMMAND']} {cluster_name} {slurm_job_id}"
+
     def check_task(self, slurm_job_id, cluster_name, timeout=None):
         """Executes command defined in dictionary.
             Used to get the status of a task and returns the output
         """
-        cmd = f"{self.config['CHECK_COMMAND']} {cluster_name} {slurm_job_id}"
-        return self.__execute_blocking(cmd, timeout=timeout)
+        return self.__execute_blocking(self.check_command(slurm_job_id, cluster_name),
+                                       timeout=timeout)
+
+    @staticmethod
+    def __command(command: str, params: str, dependency) -> str:
+        """Returns the command of a phase, with sbatch options chaining it to dependency
+
+            The wrapper passes arguments starting with '--' to sbatch. The job only starts
+            after the slurm job dependency succeeded and is cancelled by slurm if it failed.
+        """
+        if dependency is None:
+            return f"{command} {params}"
+        return f"{command} --dependency=afterok:{dependency} --kill-on-invalid-dep=yes {params}"
 
-    def collect_task(self, task, callback) -> int:
-        """Callback function after collect sbatch call is finished"""
+    def collect_task(self, task, callback, dependency=None) -> int:
+        """Callback function after collect sbatch call is finished
+
+            If dependency is set, the collect job waits for the slurm job with this id to succeed
+        """
         params = self.database.get_param_from_task(task)
-        cmd = f"{self.config['COLLECT_COMMAND']} {params}"
-        return self.__execute(cmd, callback, task.id)
+        return self.__execute(self.__command(self.config['COLLECT_COMMAND'], params, dependency),
+                              callback, task.id)
 
-    def archive_task(self, task, callback) -> int:
-        """Callback function after archive sbatch call is finished"""
+    def archive_task(self, task, callback, dependency=None) -> int:
+        """Callback function after archive sbatch call is finished
+
+            If dependency is set, the archive job waits for the slurm job with this id to succeed
+        """
         params = self.database.get_param_from_task(task)
-        cmd = f"{self.config['ARCHIVE_COMMAND']} {params}"
-        return self.__execute(cmd, callback, task.id)
+        return self.__execute(self.__command(self.config['ARCHIVE_COMMAND'], params, dependency),
+                              callback, task.id)
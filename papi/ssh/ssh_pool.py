@@ -0,0 +1,197 @@
+"""Pool of persistent ssh transports
+
+    Opening a paramiko SSHClient per command costs a full TCP connect, key exchange
+    and authentication. The pool keeps a small number of authenticated transports
+    per host alive and multiplexes commands over them by opening a new channel for
+    every command.
+"""
+import logging
+import threading
+import time
+from typing import Mapping, List, Optional
+import paramiko
+
+class PoolExhaustedError(paramiko.SSHException):
+    """Raised if all channel slots of the pool stay taken for WAIT_TIMEOUT seconds
+
+        The host itself may be healthy, the limit is local to this process.
+    """
+
+class PooledTransport:
+    """A single authenticated transport kept alive by the pool"""
+    def __init__(self, client: paramiko.SSHClient):
+        self.client = client
+        self.transport = client.get_transport()
+        self.channels = 0
+        self.last_used = time.monotonic()
+
+    def is_healthy(self) -> bool:
+        """Returns True if the underlying transport is usable"""
+        return self.transport is not None and self.transport.is_active() \
+            and self.transport.is_authenticated()
+
+    def close(self):
+        """Closes the transport and the owning client"""
+        self.client.close()
+
+class SshPool:
+    """Pool of persistent ssh transports to a single host
+
+        Parameters:
+            config: ssh config dict (see CONFIG['SSH'])
+            hostname: Host to connect to, defaults to CONFIG['SSH']['HOSTNAME']
+    """
+    def __init__(self, config: Mapping, hostname: Optional[str] = None):
+        self.config = config
+        self.hostname = hostname if hostname is not None else config['HOSTNAME']
+        pool_config = config.get('POOL', {})
+        self.max_transports = pool_config.get('MAX_TRANSPORTS', 2)
+        self.max_channels = pool_config.get('MAX_CHANNELS', 8)
+        self.idle_timeout = pool_config.get('IDLE_TIMEOUT', 300)
+        self.keepalive = pool_config.get('KEEPALIVE', 30)
+        self.wait_timeout = pool_config.get('WAIT_TIMEOUT', 60)
+        self.key_filename: Optional[str] = None
+        self.logger = logging.getLogger('papi.ssh.SshPool')
+        self.transports: List[PooledTransport] = []
+        self.connecting = 0
+        self.condition = threading.Condition()
+        self.closed = threading.Event()
+        self.housekeeper: Optional[threading.Thread] = None
+
+    def set_key_filename(self, key_filename: Optional[str]):
+        """Sets the private key used for authentication of new transports"""
+        self.key_filename = key_filename
+
+    def __connect(self, timeout=None) -> PooledTransport:
+        """Opens and authenticates a new transport"""
+        self.logger.info("Open new ssh transport to '%s'", self.hostname)
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.load_system_host_keys()
+        ssh_client.connect(self.hostname, self.config['PORT'], self.config['USERNAME'],\
+                           self.config['PASSWORD'], key_filename=self.key_filename,\
+                           timeout=timeout)
+        if self.keepalive:
+            ssh_client.get_transport().set_keepalive(self.keepalive)
+        return PooledTransport(ssh_client)
+
+    def __evict(self):
+        """Drops dead transports and transports idle for longer than idle_timeout
+
+            Has to be called with self.condition held
+        """
+        now = time.monotonic()
+        for pooled in list(self.transports):
+            healthy = pooled.is_healthy()
+            idle = pooled.channels == 0 and now - pooled.last_used > self.idle_timeout
+            if not healthy or idle:
+                self.logger.info("Evict ssh transport to '%s' (healthy: %s, idle: %s)",\
+                                 self.hostname, healthy, idle)
+                self.transports.remove(pooled)
+                pooled.close()
+
+    def evict_idle(self):
+        """Closes dead transports and transports unused for IDLE_TIMEOUT seconds"""
+        with self.condition:
+            self.__evict()
+            self.condition.notify_all()
+
+    def __housekeeping(self):
+        """Evicts idle transports periodically, also while no command is executed"""
+        interval = max(self.idle_timeout / 2, 1)
+        while not self.closed.wait(interval):
+            self.evict_idle()
+
+    def __start_housekeeping(self):
+        """Starts the housekeeping thread with the first transport
+
+            Has to be called with self.condition held
+        """
+        if self.housekeeper is None and not self.closed.is_set():
+            self.housekeeper = threading.Thread(target=self.__housekeeping, daemon=True,
+                                                name='SshPoolHousekeeping')
+            self.housekeeper.start()
+
+    def __acquire(self, timeout=None) -> PooledTransport:
+        """Reserves a channel slot on a healthy transport, connecting if necessary"""
+        deadline = time.monotonic() + self.wait_timeout
+        with self.condition:
+            while True:
+                self.__evict()
+                candidates = [pooled for pooled in self.transports
+                              if pooled.channels < self.max_channels]
+                if candidates:
+                    pooled = min(candidates, key=lambda pooled: pooled.channels)
+                    pooled.channels += 1
+                    pooled.last_used = time.monotonic()
+                    return pooled
+                if len(self.transports) + self.connecting < self.max_transports:
+                    self.connecting += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedError(f"No free ssh channel to '{self.hostname}'")
+                self.condition.wait(remaining)
+
+        connected: Optional[PooledTransport] = None
+        try:
+            connected = self.__connect(timeout=timeout)
+        finally:
+            # Publish the transport in the same step, so no waiter sees a free connect slot
+            with self.condition:
+                self.connecting -= 1
+                if connected is not None:
+                    connected.channels += 1
+                    self.transports.append(connected)
+                    self.__start_housekeeping()
+                self.condition.notify_all()
+        return connected
+
+    def __discard(self, pooled: PooledTransport):
+        """Removes a broken transport from the pool"""
+        with self.condition:
+            if pooled in self.transports:
+                self.transports.remove(pooled)
+            self.condition.notify_all()
+        pooled.close()
+
+    def open_channel(self, timeout=None) -> paramiko.Channel:
+        """Opens a new session channel on a pooled transport
+
+            A broken transport is discarded and the channel is opened once more
+            on a fresh transport. Every channel returned has to be handed back via release.
+        """
+        for attempt in range(2):
+            pooled = self.__acquire(timeout=timeout)
+            try:
+                channel = pooled.transport.open_session(timeout=timeout)
+                channel.pooled_transport = pooled
+                return channel
+            except (paramiko.SSHException, EOFError, OSError) as exception:
+                self.logger.warning("Opening ssh channel to '%s' failed: '%s'",\
+                                    self.hostname, str(exception))
+                self.__discard(pooled)
+                if attempt > 0:
+                    raise
+        raise paramiko.SSHException(f"Unable to open ssh channel to '{self.hostname}'")
+
+    def release(self, channel: paramiko.Channel):
+        """Closes a channel and frees its slot on the owning transport"""
+        channel.close()
+        pooled = getattr(channel, 'pooled_transport', None)
+        if pooled is None:
+            return
+        channel.pooled_transport = None
+        with self.condition:
+            pooled.channels -= 1
+            pooled.last_used = time.monotonic()
+            self.condition.notify_all()
+
+    def close(self):
+        """Closes all pooled transports"""
+        self.closed.set()
+        with self.condition:
+            transports = self.transports
+            self.transports = []
+        for pooled in transports:
+            pooled.close()
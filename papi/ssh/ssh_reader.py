@@ -1,82 +1,339 @@
 """Asynchronous ssh reader
 
-    This module is used to keep track of a fifo queue of non blocking ssh sessions
-    each ssh session executes a command. When a command is finished executing
-    the stdin, stderr and rc of the executed command is fetched and send to a registered callback
+    This module is used to keep track of non blocking ssh sessions. Each ssh session
+    executes a command. All pending channels are watched by a single selector, which
+    wakes up as soon as any channel has data or has terminated. Output is drained
+    while the command runs, kept in memory up to a limit and appended to per task
+    log files. When a command is finished executing the stdout, stderr and rc of
+    the executed command is send to a registered callback, which runs on a worker pool.
 """
-import time
+import os
 import threading
-import select
+import time
+import selectors
+import socket
+import queue
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Mapping, Optional, BinaryIO
+
+RECV_SIZE = 32768
+
+class OutputCapture:
+    """Captured output stream of a single ssh command
+
+        At most max_size bytes are kept in memory, the complete output is appended to log_filename
+    """
+    def __init__(self, max_size: int, log_filename: Optional[str] = None):
+        self.max_size = max_size
+        self.log_filename = log_filename
+        self.buffer = bytearray()
+        self.truncated = False
+        self.log_file: Optional[BinaryIO] = None
+
+    def write(self, data: bytes):
+        """Appends data to the in memory buffer and the log file"""
+        free = self.max_size - len(self.buffer)
+        if len(data) > free:
+            self.truncated = True
+        if free > 0:
+            self.buffer += data[:free]
+        if self.log_filename is not None:
+            if self.log_file is None:
+                self.log_file = open(self.log_filename, 'ab')
+            self.log_file.write(data)
+
+    def getvalue(self) -> str:
+        """Returns the captured output as string"""
+        return self.buffer.decode('utf-8', errors='replace')
+
+    def close(self):
+        """Closes the log file"""
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
 
 class SshConnection:
     """A single ssh command
 
-    SshConnections are stored in a pool and checked for execution
+    SshConnections are registered at the selector of the SshReader until the command terminated
     """
-    def __init__(self, task_id: int, ssh, stdin: str, stdout: str, stderr: str, callback):
+    def __init__(self, task_id: int, channel, callback, release, stdout: OutputCapture,
+                 stderr: OutputCapture):
         #pylint: disable=too-many-arguments
         self.task_id = task_id
-        self.ssh = ssh
-        self.stdin = stdin
+        self.channel = channel
+        self.callback = callback
+        self.release = release
         self.stdout = stdout
         self.stderr = stderr
-        self.callback = callback
+        self.cancelled = False
         self.logger = logging.getLogger('papi.ssh.SshConnection')
 
     def get_id(self):
         """Returns task id which is relevant to the given ssh connection"""
         return self.task_id
 
+    def drain(self):
+        """Reads all data currently buffered on the channel"""
+        while self.channel.recv_ready():
+            self.stdout.write(self.channel.recv(RECV_SIZE))
+        while self.channel.recv_stderr_ready():
+            self.stderr.write(self.channel.recv_stderr(RECV_SIZE))
+
+    def is_done(self) -> bool:
+        """Returns True once all output was read and the exit status is available"""
+        return self.is_eof() and self.channel.exit_status_ready() \
+            and not self.channel.recv_ready() and not self.channel.recv_stderr_ready()
+
+    def is_eof(self) -> bool:
+        """Returns True if the remote side will not send any more data"""
+        return self.channel.eof_received or self.channel.closed
+
     def finalize(self):
-        """Finalizer executed after the ssh command is terminated"""
-        self.ssh.close()
+        """Finalizer executed after the ssh command is terminated
+
+            Closes the log files and hands the channel back to the connection pool
+        """
+        self.stdout.close()
+        self.stderr.close()
+        self.release(self.channel)
 
 class SshReader:
-    """The asynchronous thread used for observation of a pool of SshConnection objects"""
-    def __init__(self):
-        self.queue = []
+    """The asynchronous thread used for observation of a pool of SshConnection objects
+
+        Parameters:
+            config: reader config dict (see CONFIG['SSH']['READER'])
+            base_dir: Directory a relative LOG_DIR is resolved against (CONFIG['PAPI']['BASE_DIR'])
+    """
+    def __init__(self, config: Optional[Mapping] = None, base_dir: str = ''):
+        config = config if config is not None else {}
         self.logger = logging.getLogger('papi.ssh.SshReader')
-        self.thread = threading.Thread(target=self.main_loop)
-        self.thread.start()
+        self.queue: queue.Queue = queue.Queue(maxsize=config.get('QUEUE_SIZE', 1024))
+        self.queue_timeout = config.get('QUEUE_TIMEOUT', 10)
+        self.max_output = config.get('MAX_OUTPUT', 65536)
+        self.log_dir = config.get('LOG_DIR')
+        if self.log_dir is not None:
+            self.log_dir = os.path.abspath(os.path.join(base_dir, self.log_dir))
+            try:
+                os.makedirs(self.log_dir, exist_ok=True)
+            except OSError as exception:
+                self.logger.error("Disabled ssh output logs, creating '%s' failed: '%s'",\
+                                  self.log_dir, str(exception))
+                self.log_dir = None
+        self.log_retention = config.get('LOG_RETENTION')
+        self.pruned = time.monotonic()
+        self.prune_lock = threading.Lock()
+        self.prune_logs()
+        self.executor = ThreadPoolExecutor(max_workers=config.get('CALLBACK_WORKERS', 4),
+                                           thread_name_prefix='SshCallback')
+        self.selector = selectors.DefaultSelector()
+        self.closing: list = []
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self.main_loop, daemon=True)
+        self.thread_lock = threading.Lock()
+
+    def __start(self):
+        """Starts the reader thread with the first command, idle processes need none"""
+        with self.thread_lock:
+            if self.thread.ident is None:
+                self.thread.start()
+
+    def __wakeup(self):
+        """Interrupts the select call of the reader thread"""
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def get_log_filename(self, log_name, stream: str = 'stdout') -> Optional[str]:
+        """Returns the log file name of a stream ('stdout' or 'stderr') of a task
 
-    def __remove(self, ssh_connection):
-        """Remove object from queue"""
+            Parameters:
+                log_name: Task id or other name of the log, e. g. 'group_<id>'
+                stream: 'stdout' or 'stderr'
+
+            Returns None if spilling output to disk is disabled
+        """
+        if self.log_dir is None:
+            return None
+        return os.path.join(self.log_dir, f"{os.path.basename(str(log_name))}.{stream}.log")
+
+    def prune_logs(self) -> int:
+        """Removes log files not written for LOG_RETENTION seconds and returns their number"""
+        if self.log_dir is None or self.log_retention is None:
+            return 0
+        expired = time.time() - self.log_retention
+        removed = 0
+        for entry in os.scandir(self.log_dir):
+            try:
+                if entry.name.endswith('.log') and entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError as exception:
+                self.logger.warning("Removing log file '%s' failed: '%s'",\
+                                    entry.path, str(exception))
+        if removed:
+            self.logger.info("Removed %d log files older than %s seconds",\
+                             removed, str(self.log_retention))
+        return removed
+
+    def __prune_due(self) -> bool:
+        """True once per hour, at most once per LOG_RETENTION"""
+        if self.log_dir is None or self.log_retention is None:
+            return False
+        with self.prune_lock:
+            if time.monotonic() - self.pruned < min(self.log_retention, 3600):
+                return False
+            self.pruned = time.monotonic()
+        return True
+
+    def _new_connection(self, channel, callback, task_id, release,
+                        log_name=None) -> SshConnection:
+        """Returns the SshConnection capturing the output of a command on channel
+
+            Expired log files are pruned on the callback workers from time to time.
+        """
+        #pylint: disable=too-many-arguments
+        if self.__prune_due():
+            self.executor.submit(self.prune_logs)
+        log_name = task_id if log_name is None else log_name
+        return SshConnection(task_id, channel, callback, release,
+                             OutputCapture(self.max_output,
+                                           self.get_log_filename(log_name, 'stdout')),
+                             OutputCapture(self.max_output,
+                                           self.get_log_filename(log_name, 'stderr')))
+
+    def add_object(self, channel, command, callback, task_id, release, stdin=None,
+                   log_name=None):
+        """Executes command on channel and hands it to the reader thread
+
+            Raises queue.Full if the reader does not accept new commands in time.
+
+            Parameters:
+                channel: Open session channel used for the command
+                command: Command to execute
+                callback: Callback executed with rc, stdout, stderr and task_id
+                task_id: Task id of the task relevant for the command
+                release: Function used to give the channel back once the command is done
+                stdin: Optional bytes send to the command before stdin is closed
+                log_name: Name of the log files, defaults to the task id
+        """
+        #pylint: disable=too-many-arguments
+        self.__start()
+        ssh_connection = self._new_connection(channel, callback, task_id, release, log_name)
+        try:
+            self.queue.put(ssh_connection, timeout=self.queue_timeout)
+        except queue.Full:
+            self.logger.error("SSH Reader queue is full, rejecting command for task '%s'",\
+                              str(task_id))
+            release(channel)
+            raise
+        try:
+            channel.exec_command(command)
+            if stdin is not None:
+                channel.sendall(stdin)
+                channel.shutdown_write()
+        except Exception:
+            ssh_connection.cancelled = True
+            channel.close()
+            raise
+        finally:
+            self.__wakeup()
+
+    def __register_new(self):
+        """Registers all connections handed over by add_object at the selector"""
+        while True:
+            try:
+                ssh_connection = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.selector.register(ssh_connection.channel, selectors.EVENT_READ, ssh_connection)
+
+    def _finish(self, ssh_connection):
+        """Releases the channel and schedules the callback on the worker pool"""
+        channel = ssh_connection.channel
+        exit_status = channel.recv_exit_status()
         ssh_connection.finalize()
-        self.queue.remove(ssh_connection)
-
-    def add_object(self, ssh, command, callback, task_id):
-        """Creates a new SshConnection object and add it to the queue"""
-        (stdin, stdout, stderr) = ssh.exec_command(command)
-        self.queue.append(SshConnection(task_id, ssh, stdin, stdout, stderr, callback))
-
-    def __work(self):
-        if len(self.queue) > 0:
-            for i in self.queue:
-                if i.stdout.channel.exit_status_ready():
-                    exit_status = i.stdout.channel.recv_exit_status()
-                    self.logger.info("SSH Reader got exit code: '%s'", str(exit_status))
-                    stdout = ''
-                    stderr = ''
-                    if i.stdout.channel.recv_ready():
-                        read_list, _, _ = select.select([i.stdout.channel], [], [], 0.0)
-                        if len(read_list) > 0:
-                            stdout = i.stdout.channel.recv(1024).decode('utf-8')
-                    if i.stdout.channel.recv_stderr_ready():
-                        read_list, _, _ = select.select([i.stdout.channel], [], [], 0.0)
-                        if len(read_list) > 0:
-                            stderr = i.stdout.channel.recv_stderr(1024).decode('utf-8')
-                            self.logger.error(stderr)
-                    i.callback(exit_status, stdout, stderr, i.task_id)
-                    self.__remove(i)
+        if ssh_connection.cancelled:
+            return
+        self.logger.info("SSH Reader got exit code: '%s'", str(exit_status))
+        stdout = ssh_connection.stdout.getvalue()
+        stderr = ssh_connection.stderr.getvalue()
+        if ssh_connection.stdout.truncated or ssh_connection.stderr.truncated:
+            self.logger.warning("Output of task '%s' exceeds %d bytes and was truncated",\
+                                str(ssh_connection.task_id), self.max_output)
+        if stderr:
+            self.logger.error(stderr)
+        self.executor.submit(self._run_callback, ssh_connection, exit_status, stdout, stderr)
+
+    def _run_callback(self, ssh_connection, exit_status, stdout, stderr):
+        """Executes a registered callback and logs its errors"""
+        try:
+            ssh_connection.callback(exit_status, stdout, stderr, ssh_connection.task_id)
+        except Exception as exception: #pylint: disable=broad-except
+            self.logger.exception("Callback for task '%s' failed: '%s'",\
+                                  str(ssh_connection.task_id), str(exception))
+
+    def __work(self, ssh_connection):
+        """Handles a readable channel"""
+        ssh_connection.drain()
+        if ssh_connection.is_done():
+            self.selector.unregister(ssh_connection.channel)
+            self._finish(ssh_connection)
+        elif ssh_connection.is_eof():
+            # The channel stays readable after eof, wait for the exit status without selecting it
+            self.selector.unregister(ssh_connection.channel)
+            self.closing.append(ssh_connection)
+
+    def __work_closing(self):
+        """Checks channels which reached eof but did not report an exit status yet"""
+        for ssh_connection in list(self.closing):
+            if ssh_connection.channel.exit_status_ready():
+                self.closing.remove(ssh_connection)
+                try:
+                    ssh_connection.drain()
+                    self._finish(ssh_connection)
+                except Exception as exception: #pylint: disable=broad-except
+                    self.__fail(ssh_connection, exception)
+
+    def __fail(self, ssh_connection, exception: Exception):
+        """Releases the channel of a command which could not be read and reports exit code -1"""
+        message = f"Reading ssh channel failed: '{exception}'"
+        self.logger.error("Command of task '%s': %s", str(ssh_connection.task_id), message)
+        try:
+            ssh_connection.finalize()
+        except Exception as error: #pylint: disable=broad-except
+            self.logger.error("Releasing ssh channel failed: '%s'", str(error))
+        if not ssh_connection.cancelled:
+            self.executor.submit(self._run_callback, ssh_connection, -1,
+                                 ssh_connection.stdout.getvalue(), message)
 
     def main_loop(self):
-        """Loops over the queue and checks for terminated ssh commands
+        """Waits for readable channels and checks for terminated ssh commands
 
             When a ssh command is terminated the stdout, stderr and rc is fetched.
             Afterwards the registered callback is executed
         """
         self.logger.info("start ssh read thread")
         while True:
-            self.__work()
-            time.sleep(1)
+            timeout = 0.05 if self.closing else None
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self.wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    self.__work(key.data)
+                except Exception as exception: #pylint: disable=broad-except
+                    if key.fileobj in self.selector.get_map():
+                        self.selector.unregister(key.fileobj)
+                    self.__fail(key.data, exception)
+            self.__work_closing()
+            self.__register_new()
@@ -0,0 +1,235 @@
+"""Routing of ssh commands over several equivalent login hosts
+
+    CONFIG['SSH']['HOSTNAME'] may name a list of login hosts sharing the same slurm
+    clusters and file systems. Every host gets its own SshPool, every command is
+    routed to the host with the fewest commands in flight. Hosts which fail or time
+    out repeatedly are ejected and probed in the background until they answer again.
+"""
+import logging
+import statistics
+import threading
+import time
+from typing import Mapping, List, Optional
+import paramiko
+from .ssh_pool import SshPool, PoolExhaustedError
+
+class SshHost:
+    """State of one login host as seen by the router"""
+    def __init__(self, pool: SshPool):
+        self.pool = pool
+        self.hostname = pool.hostname
+        self.outstanding = 0
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until: Optional[float] = None
+
+    @property
+    def ejected(self) -> bool:
+        """True while the host is out of rotation"""
+        return self.ejected_until is not None
+
+class SshRouter:
+    """Pool of ssh channels over several login hosts with the interface of SshPool
+
+        The host of a command is chosen by POLICY:
+            least_outstanding: fewest commands in flight, ties broken by latency
+            latency: lowest latency of opening a channel, weighted by the commands in flight
+        A host is ejected after MAX_FAILURES consecutive failures or timeouts. It is probed
+        by PROBE_COMMAND after EJECT_TIME seconds, which double with every failed probe up
+        to MAX_EJECT_TIME, and readmitted once a probe succeeds. If all hosts are ejected,
+        commands are still routed to them, so a single host behaves like a plain SshPool.
+
+        Parameters:
+            config: ssh config dict (see CONFIG['SSH'])
+    """
+    def __init__(self, config: Mapping):
+        hostnames = config['HOSTNAME']
+        if isinstance(hostnames, str):
+            hostnames = [hostnames]
+        router_config = config.get('ROUTER') or {}
+        self.policy = router_config.get('POLICY', 'least_outstanding')
+        if self.policy not in ('least_outstanding', 'latency'):
+            raise ValueError(f"Unknown ssh routing policy '{self.policy}'")
+        self.max_failures = router_config.get('MAX_FAILURES', 3)
+        self.eject_time = router_config.get('EJECT_TIME', 30)
+        self.max_eject_time = router_config.get('MAX_EJECT_TIME', 300)
+        self.probe_command = router_config.get('PROBE_COMMAND', 'true')
+        self.probe_timeout = router_config.get('PROBE_TIMEOUT', 10)
+        self.latency_decay = router_config.get('LATENCY_DECAY', 0.3)
+        self.hosts: List[SshHost] = [SshHost(SshPool(config, hostname)) for hostname in hostnames]
+        self.logger = logging.getLogger('papi.ssh.SshRouter')
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.next_host = 0
+        self.prober: Optional[threading.Thread] = None
+
+    def set_key_filename(self, key_filename: Optional[str]):
+        """Sets the private key used for authentication of new transports to every host"""
+        for host in self.hosts:
+            host.pool.set_key_filename(key_filename)
+
+    def __score(self, host: SshHost):
+        """Sort key of a host, the lowest one is chosen
+
+            Hosts without measured latency, i. e. before their first channel, score 0 and
+            are measured first.
+        """
+        latency = host.latency if host.latency is not None else 0.0
+        if self.policy == 'latency':
+            return ((host.outstanding + 1) * latency, host.outstanding)
+        return (host.outstanding, latency)
+
+    def __pick(self, tried: List[SshHost]) -> Optional[SshHost]:
+        """Chooses the host of the next command among the hosts not tried yet
+
+            Has to be called with self.lock held
+        """
+        untried = [host for host in self.hosts if host not in tried]
+        candidates = [host for host in untried if not host.ejected]
+        if not candidates:
+            # Fail open, a host which might be back is better than no host at all
+            candidates = sorted(untried, key=lambda host: host.ejected_until or 0.0)[:1]
+        if not candidates:
+            return None
+        # Rotate the start, so hosts with equal scores take turns
+        self.next_host = (self.next_host + 1) % len(self.hosts)
+        rotated = self.hosts[self.next_host:] + self.hosts[:self.next_host]
+        return min((host for host in rotated if host in candidates), key=self.__score)
+
+    def __record_latency(self, host: SshHost, seconds: float):
+        """Updates the moving average of the latency of a host
+
+            Has to be called with self.lock held
+        """
+        if host.latency is None:
+            host.latency = seconds
+        else:
+            host.latency += self.latency_decay * (seconds - host.latency)
+
+    def __eject(self, host: SshHost):
+        """Takes a host out of rotation until a probe succeeds
+
+            Has to be called with self.lock held
+        """
+        delay = min(self.eject_time * 2 ** host.ejections, self.max_eject_time)
+        host.ejections += 1
+        host.ejected_until = time.monotonic() + delay
+        self.logger.warning("Ejected ssh host '%s' for %s seconds after %d failures",\
+                            host.hostname, str(delay), host.failures)
+        if self.prober is None:
+            self.prober = threading.Thread(target=self.__probe_loop, daemon=True,
+                                           name='SshProbe')
+            self.prober.start()
+        self.wakeup.notify_all()
+
+    def __failed(self, host: SshHost, exception: Exception):
+        """Counts a failure of host and ejects it after max_failures in a row"""
+        with self.lock:
+            host.failures += 1
+            self.logger.warning("ssh host '%s' failed %d times in a row: '%s'",\
+                                host.hostname, host.failures, str(exception))
+            if host.failures >= self.max_failures and not host.ejected:
+                self.__eject(host)
+
+    def open_channel(self, timeout=None) -> paramiko.Channel:
+        """Opens a new session channel on the best host
+
+            If a host fails or all channels to it are taken, the channel is opened on the
+            next one. Taken channels are a local limit and do not count as failure of the
+            host. Every channel returned has to be handed back via release.
+        """
+        tried: List[SshHost] = []
+        error: Optional[Exception] = None
+        while True:
+            with self.lock:
+                host = self.__pick(tried)
+                if host is None:
+                    break
+                host.outstanding += 1
+            tried.append(host)
+            started = time.monotonic()
+            try:
+                channel = host.pool.open_channel(timeout=timeout)
+            except (paramiko.SSHException, EOFError, OSError) as exception:
+                with self.lock:
+                    host.outstanding -= 1
+                if not isinstance(exception, PoolExhaustedError):
+                    self.__failed(host, exception)
+                error = exception
+                continue
+            with self.lock:
+                self.__record_latency(host, time.monotonic() - started)
+            channel.ssh_host = host
+            return channel
+        raise error if error is not None else paramiko.SSHException("No ssh host configured")
+
+    def report_error(self, channel: paramiko.Channel, exception: Exception):
+        """Counts a command which timed out or failed on the host of channel"""
+        host = getattr(channel, 'ssh_host', None)
+        if host is None:
+            return
+        channel.ssh_failed = True
+        self.__failed(host, exception)
+
+    def release(self, channel: paramiko.Channel):
+        """Closes a channel and frees its slot on the owning host"""
+        host = getattr(channel, 'ssh_host', None)
+        if host is None:
+            channel.close()
+            return
+        channel.ssh_host = None
+        with self.lock:
+            host.outstanding -= 1
+            if not getattr(channel, 'ssh_failed', False):
+                host.failures = 0
+        host.pool.release(channel)
+
+    def probe(self, host: SshHost) -> bool:
+        """Runs the probe command on host and readmits it if the command succeeded"""
+        try:
+            channel = host.pool.open_channel(timeout=self.probe_timeout)
+            try:
+                channel.settimeout(self.probe_timeout)
+                channel.exec_command(self.probe_command)
+                channel.makefile('rb').read()
+                exit_status = channel.recv_exit_status()
+            finally:
+                host.pool.release(channel)
+            if exit_status != 0:
+                raise paramiko.SSHException(f"Probe exited with {exit_status}")
+        except (paramiko.SSHException, EOFError, OSError) as exception:
+            self.logger.warning("Probe of ssh host '%s' failed: '%s'",\
+                                host.hostname, str(exception))
+            with self.lock:
+                self.__eject(host)
+            return False
+        with self.lock:
+            host.ejected_until = None
+            host.ejections = 0
+            host.failures = 0
+            # Start from the median of the healthy hosts, a fresh host would take all commands
+            latencies = [other.latency for other in self.hosts
+                         if not other.ejected and other.latency is not None and other is not host]
+            host.latency = statistics.median(latencies) if latencies else None
+        self.logger.info("Readmitted ssh host '%s'", host.hostname)
+        return True
+
+    def __probe_loop(self):
+        """Probes every ejected host once its ejection time passed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                due = [host for host in self.hosts
+                       if host.ejected and host.ejected_until <= now]
+                if not due:
+                    waits = [host.ejected_until - now for host in self.hosts if host.ejected]
+                    self.wakeup.wait(min(waits) if waits else None)
+                    continue
+            for host in due:
+                self.probe(host)
+
+    def close(self):
+        """Closes the transports of all hosts"""
+        for host in self.hosts:
+            host.pool.close()
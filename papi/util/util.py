@@ -1,5 +1,8 @@
 """Utility module for common not state dependent functions"""
 import re
+import itertools
+import math
+from typing import Iterable, Iterator, List, Mapping, Dict, Any, Tuple
 
 def parse_slurm_output(string):
     """Parses the output of slurm sbatch command into slurm job id and cluster name"""
@@ -34,3 +37,95 @@ def parse_sacct_output(string):
         result[str(split_line[1])] = data
 
     return result
+
+def slurm_job_key(job_id, array_index=None) -> str:
+    """Returns the JobID used by sacct for a job or an element of a job array"""
+    if array_index is None:
+        return str(job_id)
+    return f"{job_id}_{array_index}"
+
+def expand_array_job_ids(result):
+    """Expands collapsed job array entries of parsed sacct output
+
+        sacct reports pending array elements in one line like '123_[0-3,7%2]'.
+        The entry is copied for every array index, e. g. '123_0' to '123_3' and '123_7'.
+    """
+    expanded = {}
+    for job_id, data in result.items():
+        regex = re.match(r'^(\d+)_\[([-,\d]+)(?:%\d+)?\]$', job_id)
+        if regex is None:
+            expanded[job_id] = data
+            continue
+        for index_range in regex.group(2).split(','):
+            if not index_range:
+                continue
+            first, _, last = index_range.partition('-')
+            for index in range(int(first), int(last or first) + 1):
+                expanded[slurm_job_key(regex.group(1), index)] = data
+    return expanded
+
+def chunk_list(items: Iterable, size: int) -> Iterator[List]:
+    """Splits items into lists of at most size elements"""
+    chunk: List = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def parse_slurm_duration(string):
+    """Parses a slurm duration like the Elapsed field of sacct into seconds
+
+        Accepted formats are [D-]HH:MM:SS, MM:SS and SS with optional fractions of seconds.
+        Returns None if the string can not be parsed.
+    """
+    regex = re.match(r'^\s*(?:(\d+)-)?(?:(\d+):)??(?:(\d+):)?(\d+(?:\.\d+)?)\s*$', str(string))
+    if regex is None:
+        return None
+    days, hours, minutes, seconds = regex.groups()
+    return (int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60
+            + float(seconds))
+
+def _parse_range(spec) -> Tuple[float, float, int]:
+    """Returns start, step and number of values of an inclusive numeric range"""
+    start, stop, step = float(spec['start']), float(spec['stop']), float(spec.get('step', 1))
+    if not step > 0 or not stop >= start or math.isinf(stop - start):
+        raise ValueError(f"Invalid range {spec}")
+    return start, step, int((stop - start) / step + 1e-9) + 1
+
+def axis_size(spec) -> int:
+    """Returns the number of values of a sweep axis without expanding it, see expand_axis"""
+    if isinstance(spec, list):
+        return len(spec)
+    if not isinstance(spec, dict):
+        return 1
+    return _parse_range(spec)[2]
+
+def expand_axis(spec) -> List:
+    """Expands the values of a single parameter sweep axis
+
+        spec can be a list of values, a single value or a dict with an inclusive
+        numeric range {'start': 0.25, 'stop': 1.0, 'step': 0.25}. Check the number
+        of values of a range from a request by axis_size before expanding it.
+    """
+    if isinstance(spec, list):
+        return spec
+    if not isinstance(spec, dict):
+        return [spec]
+    start, step, count = _parse_range(spec)
+    return [round(start + index * step, 12) for index in range(count)]
+
+def grid_size(axes: Mapping[str, List]) -> int:
+    """Returns the number of points of the cartesian grid of axes"""
+    size = 1
+    for values in axes.values():
+        size *= len(values)
+    return size
+
+def iter_grid(axes: Mapping[str, List]) -> Iterator[Dict[str, Any]]:
+    """Lazily yields every point of the cartesian grid of axes as dict"""
+    names = list(axes)
+    for values in itertools.product(*(axes[name] for name in names)):
+        yield dict(zip(names, values))
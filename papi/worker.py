@@ -0,0 +1,131 @@
+"""This module models the background worker of papi
+
+    The worker runs the parts of papi which talk to the cluster:
+        runner: An asynchronous runner used to query slurm via ssh, with ENGINE 'asyncio'
+                an AioRunner on an event loop (see papi.async_runner.aio)
+        dispatcher: Submits the tasks stored by the API via ssh
+        election: Elects the process running runner and dispatcher, None if it is the only one
+        sweeps: Continues the expansion of sweeps once the process runs the dispatcher
+
+    It is embedded in Papi or started as separate process by the papi-worker command,
+    in which case it communicates with API processes started with api_only only through
+    the database.
+"""
+
+import argparse
+import importlib
+import logging
+import os
+import signal
+import sys
+import threading
+from typing import Mapping, Optional, List
+from .db import DB
+from .db.viwa_db import ViwaDb
+from .ssh import Ssh
+from .async_runner import AsyncRunner, LeaderElection
+from .async_runner.aio import AioRunner, AioReader
+from .handler.dispatcher import SubmitDispatcher
+from .handler.sweep import Sweep
+
+class Worker:
+    """Runner and dispatcher of a papi instance
+
+        Parameters:
+            config: complete papi configuration (see config.py)
+            database: Database handler to share, a new one is created if None
+            ssh: SSH handler to share, a new one is created if None
+            dispatcher: Submit stored tasks, otherwise the API submits inline
+    """
+    def __init__(self, config: Mapping, database: Optional[DB] = None,
+                 ssh: Optional[Ssh] = None, dispatcher: bool = True):
+        self.config = config['PAPI']
+        self.logger = logging.getLogger('papi.Worker')
+        self.database = database if database is not None else ViwaDb(config['DB'])
+        base_dir = self.config.get('BASE_DIR', '')
+        self.ssh = ssh if ssh is not None else Ssh(config['SSH'], self.database, base_dir)
+        if self.config.get('ENGINE', 'thread') == 'asyncio':
+            aio_config = self.config.get('AIO')
+            self.ssh.set_reader(AioReader(config['SSH'].get('READER'), aio_config,
+                                          base_dir=base_dir))
+            self.runner: AsyncRunner = AioRunner(self.ssh, self.database,
+                                                 self.config['SLEEP_TIMER'],
+                                                 self.config.get('RUNNER'), aio_config)
+        else:
+            self.runner = AsyncRunner(self.ssh, self.database, self.config['SLEEP_TIMER'],
+                                      self.config.get('RUNNER'))
+        self.election = None
+        if (self.config.get('ELECTION') or {}).get('ENABLED', False):
+            self.election = LeaderElection(self.database, self.config['ELECTION'])
+            self.election.add_listener(self.__leadership_changed)
+        self.dispatcher = None
+        if dispatcher:
+            owner = self.election.owner if self.election is not None else None
+            self.dispatcher = SubmitDispatcher(self.database, self.ssh, self.config, owner)
+        # Continues the expansion of sweeps interrupted by a restart
+        self.sweeps = Sweep(self.database, self.ssh, self.config, self.dispatcher)
+        self.stopped = threading.Event()
+
+    def __resume_sweeps(self):
+        try:
+            count = self.sweeps.resume()
+            if count:
+                self.logger.info("Resumed the expansion of %d sweeps", count)
+        except Exception as exception: #pylint: disable=broad-except
+            self.logger.error("Resuming sweeps failed: '%s'", str(exception))
+
+    def __leadership_changed(self, leader: bool):
+        """Runs the runner and the dispatcher only while this process is the leader"""
+        if leader:
+            self.runner.resume()
+            if self.dispatcher is not None:
+                self.dispatcher.resume(takeover=True)
+            self.__resume_sweeps()
+        else:
+            self.runner.pause()
+            if self.dispatcher is not None:
+                self.dispatcher.pause()
+
+    def start(self):
+        """Starts runner and dispatcher, with an election once this process is the leader"""
+        self.runner.run(active=self.election is None)
+        if self.dispatcher is not None:
+            self.dispatcher.start(active=self.election is None)
+        if self.election is not None:
+            self.election.start()
+        else:
+            self.__resume_sweeps()
+
+    def stop(self):
+        """Stops scanning for new work and releases the lease of the election"""
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        if self.election is not None:
+            self.election.stop()
+        self.stopped.set()
+
+    def run(self):
+        """Starts the worker and blocks until SIGTERM or SIGINT is received"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self.stopped.set())
+        self.start()
+        self.logger.info("Worker started, pid %d", os.getpid())
+        while not self.stopped.wait(1):
+            pass
+        self.stop()
+        self.logger.info("Worker stopped")
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point of the papi-worker command"""
+    parser = argparse.ArgumentParser(description="Runs runner and submit dispatcher of papi")
+    parser.add_argument('--config', default='config',
+                        help="Module with the CONFIG dict, looked up in the current directory")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, os.getcwd())
+    config = importlib.import_module(args.config).CONFIG
+    Worker(config).run()
+    # The runner thread does not stop by itself
+    os._exit(0) #pylint: disable=protected-access
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from setuptools import setup
+from setuptools import setup, find_packages
 
 req = ['Flask-RESTful', 'flask-jwt-extended', 'paramiko', 'SQLAlchemy', 'requests']
 
@@ -8,6 +8,9 @@ setup(
    description='',
    author='Robin Loesch',
    author_email='robin@chilio.net',
-   packages=['papi'],
+   packages=find_packages(exclude=['test', 'test.*', 'benchmarks']),
    install_requires=req,
+   entry_points={
+       'console_scripts': ['papi-worker=papi.worker:main'],
+   },
 )
@@ -0,0 +1,388 @@
+"""Unittest for papi.async_runner helper classes"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from collections import namedtuple
+from papi.async_runner.scheduler import PollScheduler
+from papi.async_runner.index import ActiveJobIndex
+from papi.async_runner.leader import LeaderElection
+from papi.async_runner.aio import AioRunner, EventLoopThread
+from papi.async_runner.runner import AsyncRunner
+from papi.db import PollJob, SlurmJob
+from papi.db.viwa_db import ViwaDb
+
+TaskParams = namedtuple('TaskParams', ['id'])
+
+def poll_job(task_id, state, job_id, array_index=None, cluster='mpp2'):
+    """Returns a PollJob of a task without parameters"""
+    return PollJob(TaskParams(task_id), state, job_id, array_index, cluster)
+
+class TestPollScheduler(unittest.TestCase):
+    """Unittest for papi.async_runner.PollScheduler"""
+    def setUp(self):
+        self.scheduler = PollScheduler({'MIN_INTERVAL': 2, 'MAX_INTERVAL': 60, 'BACKOFF': 2.0})
+        self.joblist = {'mpp2': {'1': None, '2': None}}
+
+    def test_new_jobs_are_due(self):
+        """Jobs seen for the first time are checked immediately"""
+        self.assertEqual(self.scheduler.due(self.joblist), self.joblist)
+        self.scheduler.update(('mpp2', '1'), 'running', {'State': 'PENDING'})
+        self.assertEqual(self.scheduler.due(self.joblist), {'mpp2': {'2': None}})
+
+    def test_backoff(self):
+        """The interval of a pending job grows up to MAX_INTERVAL"""
+        intervals = []
+        for _ in range(7):
+            self.scheduler.update(('mpp2', '1'), 'running', {'State': 'PENDING'})
+            intervals.append(self.scheduler.intervals[('mpp2', '1')])
+        self.assertEqual(intervals, [2, 4, 8, 16, 32, 60, 60])
+
+    def test_expected_duration(self):
+        """Running jobs are checked around the learned finish time of their phase"""
+        self.scheduler.complete(('mpp2', '1'), 'running',
+                                {'State': 'COMPLETED', 'Elapsed': '00:00:20'})
+        for _ in range(5):
+            self.scheduler.update(('mpp2', '2'), 'running', {'State': 'PENDING'})
+        self.scheduler.update(('mpp2', '2'), 'running',
+                              {'State': 'RUNNING', 'Elapsed': '00:00:15'})
+        self.assertEqual(self.scheduler.intervals[('mpp2', '2')], 5)
+        self.assertNotIn(('mpp2', '1'), self.scheduler.next_check)
+
+    def test_notify_not_lost(self):
+        """A notify after the due jobs were read wakes up the next wait"""
+        self.scheduler.due(self.joblist)
+        self.scheduler.notify()
+        started = time.monotonic()
+        self.scheduler.wait(5)
+        self.assertLess(time.monotonic() - started, 1)
+        self.scheduler.due(self.joblist)
+        started = time.monotonic()
+        self.scheduler.wait(0.1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    def test_forget_inactive(self):
+        """Jobs no longer active are dropped"""
+        self.scheduler.retry(('mpp2', '3'))
+        self.scheduler.due(self.joblist)
+        self.assertNotIn(('mpp2', '3'), self.scheduler.next_check)
+
+
+class TestActiveJobIndex(unittest.TestCase):
+    """Unittest for papi.async_runner.index.ActiveJobIndex"""
+    def setUp(self):
+        self.index = ActiveJobIndex(['running', 'aggregating'])
+        self.index.apply([poll_job(1, 'running', 10), poll_job(2, 'running', 11, 0, 'mpp3')],
+                         self.index.begin())
+
+    def test_seed(self):
+        """Jobs are keyed by cluster and slurm job key"""
+        self.assertEqual(sorted((cluster, key) for cluster, jobs in self.index.snapshot().items()
+                                for key in jobs), [('mpp2', '10'), ('mpp3', '11_0')])
+
+    def test_changes(self):
+        """Finished tasks are removed at once, tasks of a new phase are read again"""
+        self.index.state_changed(1, 'finished')
+        self.index.state_changed(2, 'aggregating')
+        self.index.state_changed(3, 'running')
+        self.assertEqual(list(self.index.snapshot()), ['mpp3'])
+        task_ids = self.index.changed_tasks()
+        self.assertEqual(sorted(task_ids), [2, 3])
+        sequence = self.index.begin()
+        self.index.apply([poll_job(2, 'aggregating', 12), poll_job(3, 'running', 13)],
+                         sequence, task_ids)
+        self.assertEqual(self.index.snapshot(), {'mpp2': {'12': poll_job(2, 'aggregating', 12),
+                                                          '13': poll_job(3, 'running', 13)}})
+        self.assertEqual(self.index.changed_tasks(), [])
+
+    def test_outdated_read(self):
+        """A read started before a change does not restore the job of the task"""
+        self.index.state_changed(3, 'running')
+        sequence = self.index.begin()
+        self.index.state_changed(3, 'failed')
+        self.index.apply([poll_job(3, 'running', 13)], sequence, [3])
+        self.index.apply([poll_job(1, 'running', 10), poll_job(3, 'running', 13)], sequence)
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.snapshot(), {'mpp2': {'10': poll_job(1, 'running', 10)}})
+
+
+class TestLeaderElection(unittest.TestCase):
+    """Unittest for papi.async_runner.LeaderElection"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+
+    def test_single_leader(self):
+        """Only one process leads, another one takes over once the lease is released"""
+        first = LeaderElection(self.database, {'LEASE': 30})
+        second = LeaderElection(self.database, {'LEASE': 30})
+        changes = []
+        second.add_listener(changes.append)
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+        self.assertTrue(first.try_acquire())
+        first.stop()
+        self.assertFalse(first.is_leader)
+        self.assertTrue(second.try_acquire())
+        self.assertEqual(changes, [True])
+
+    def test_step_down(self):
+        """The leader steps down if it cannot renew the lease"""
+        election = LeaderElection(self.database, {'LEASE': 0.2})
+        changes = []
+        election.add_listener(changes.append)
+        self.assertTrue(election.try_acquire())
+        self.database.acquire_lease = lambda *args: False
+        self.assertTrue(election.try_acquire())
+        election.valid_until = 0.0
+        self.assertFalse(election.try_acquire())
+        self.assertEqual(changes, [True, False])
+
+
+class TestAsyncRunner(unittest.TestCase):
+    """Unittest for papi.async_runner.AsyncRunner"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+
+    def add_active(self, job_id, cluster, state='running', job_type='main'):
+        """Adds a task in state with a submitted job of job_type and returns its id"""
+        task = self.database.add_task({'seeding_date': 'sub15days', 'irrigation': True,
+                                       'nutrition_factor': 0.25, 'phenology_factor': 1.0})
+        self.database.add_slurm_job(SlurmJob(job_id=job_id, cluster=cluster,
+                                             job_type=job_type, ssh_rc=0, task_id=task.id))
+        self.database.set_task_state(task.id, state)
+        return task.id
+
+    def test_sweep_per_cluster(self):
+        """All phases are checked by one sacct call per cluster and chunk"""
+        tasks = {1: self.add_active(1, 'mpp2'),
+                 2: self.add_active(2, 'mpp2', 'aggregating', 'aggregation'),
+                 3: self.add_active(3, 'mpp2', 'archived', 'archive'),
+                 4: self.add_active(4, 'mpp3'),
+                 5: self.add_active(5, 'mpp3', 'aggregating', 'aggregation')}
+        slurm_states = {1: 'COMPLETED', 2: 'FAILED', 3: 'COMPLETED', 4: 'RUNNING',
+                        5: 'COMPLETED'}
+        calls = []
+
+        def check_task(job_ids, cluster, timeout=None):
+            calls.append((cluster, sorted(int(job_id) for job_id in job_ids.split(','))))
+            return 'User|JobID|State|Elapsed\n' + ''.join(
+                f"u|{job_id}|{slurm_states[int(job_id)]}|00:00:01\n"
+                for job_id in job_ids.split(','))
+        ssh = mock.Mock()
+        ssh.check_task.side_effect = check_task
+        runner = AsyncRunner(ssh, self.database, 10, {'CHECK_CHUNK_SIZE': 2})
+        runner.active.set()
+        runner.work()
+        self.assertEqual(sorted(cluster for cluster, _ in calls), ['mpp2', 'mpp2', 'mpp3'])
+        self.assertEqual(sorted(job for _, jobs in calls for job in jobs), [1, 2, 3, 4, 5])
+        self.assertTrue(all(len(jobs) <= 2 for _, jobs in calls))
+        self.assertEqual(self.database.get_task_states(list(tasks.values())),
+                         {tasks[1]: 'executed', tasks[2]: 'failed', tasks[3]: 'finished',
+                          tasks[4]: 'running', tasks[5]: 'archiving'})
+        self.assertEqual(ssh.collect_task.call_args[0][0].id, tasks[1])
+        self.assertEqual(ssh.archive_task.call_args[0][0].id, tasks[5])
+
+    def test_failing_cluster(self):
+        """A cluster whose check fails neither blocks nor changes the tasks of others"""
+        healthy = self.add_active(1, 'mpp2')
+        broken = self.add_active(2, 'mpp3')
+
+        def check_task(job_ids, cluster, timeout=None):
+            if cluster == 'mpp3':
+                raise OSError('unreachable')
+            return f'User|JobID|State|Elapsed\nu|{job_ids}|COMPLETED|00:00:01\n'
+        ssh = mock.Mock()
+        ssh.check_task.side_effect = check_task
+        runner = AsyncRunner(ssh, self.database, 10)
+        runner.active.set()
+        runner.work()
+        self.assertEqual(runner.check_errors, {'mpp2': 0, 'mpp3': 1})
+        self.assertEqual(self.database.get_task_states([healthy, broken]),
+                         {healthy: 'executed', broken: 'running'})
+
+    def test_concurrent_chunks(self):
+        """The chunks of all clusters are checked at the same time"""
+        tasks = [self.add_active(job_id, cluster) for job_id, cluster in
+                 [(1, 'mpp2'), (2, 'mpp2'), (3, 'mpp3')]]
+        # Every check waits until all of them are running, sequential checks time out
+        barrier = threading.Barrier(3, timeout=5)
+
+        def check_task(job_ids, cluster, timeout=None):
+            barrier.wait()
+            return f'User|JobID|State|Elapsed\nu|{job_ids}|COMPLETED|00:00:01\n'
+        ssh = mock.Mock()
+        ssh.check_task.side_effect = check_task
+        runner = AsyncRunner(ssh, self.database, 10, {'CHECK_CHUNK_SIZE': 1})
+        runner.active.set()
+        runner.work()
+        self.assertEqual(ssh.check_task.call_count, 3)
+        self.assertEqual(set(self.database.get_task_states(tasks).values()), {'executed'})
+
+    def test_next_phase_fails(self):
+        """A task whose collect job cannot be submitted is checked again and resubmitted"""
+        _, tasks = self.database.add_tasks([{'seeding_date': 'sub15days', 'irrigation': True,
+                                             'nutrition_factor': 0.25, 'phenology_factor': 1.0}
+                                            for _ in range(2)])
+        for task in tasks:
+            self.database.add_slurm_job(SlurmJob(job_id=task.id, cluster='mpp2',
+                                                 job_type='main', ssh_rc=0, task_id=task.id))
+            self.database.set_task_state(task.id, 'running')
+        ssh = mock.Mock()
+        ssh.check_task.side_effect = lambda job_ids, cluster, timeout=None: \
+            'User|JobID|State|Elapsed\n' + ''.join(f"u|{job_id}|COMPLETED|00:00:01\n"
+                                                   for job_id in job_ids.split(','))
+        ssh.collect_task.side_effect = [OSError('No free ssh channel'), 0, 0]
+        runner = AsyncRunner(ssh, self.database, 10)
+        runner.active.set()
+        runner.work()
+        states = self.database.get_task_states([task.id for task in tasks])
+        self.assertEqual(sorted(states.values()), ['executed', 'running'])
+        runner.work()
+        self.assertEqual(ssh.collect_task.call_count, 3)
+        states = self.database.get_task_states([task.id for task in tasks])
+        self.assertEqual(set(states.values()), {'executed'})
+
+
+    def test_journal(self):
+        """Jobs submitted by other processes are checked by the next iteration"""
+        ssh = mock.Mock()
+        ssh.check_task.side_effect = lambda job_ids, cluster, timeout=None: \
+            'User|JobID|State|Elapsed\n' + ''.join(f"u|{job_id}|RUNNING|00:00:01\n"
+                                                   for job_id in job_ids.split(','))
+        runner = AsyncRunner(ssh, self.database, 10, {'JOURNAL_LIMIT': 1})
+        runner.active.set()
+        runner.work()
+        self.assertFalse(ssh.check_task.called)
+        other = ViwaDb(self.database.config)
+        for job_id in [7, 8]:
+            task = other.add_task({'seeding_date': 'sub15days', 'irrigation': True,
+                                   'nutrition_factor': 0.25, 'phenology_factor': 1.0})
+            other.add_slurm_job(SlurmJob(job_id=job_id, cluster='mpp2', job_type='main',
+                                         ssh_rc=0, task_id=task.id))
+            other.set_task_state(task.id, 'running')
+        runner.work()
+        self.assertEqual(sorted(ssh.check_task.call_args[0][0].split(',')), ['7', '8'])
+
+    def test_stale_transition(self):
+        """A task moved on by another process during the check is not collected again"""
+        _, tasks = self.database.add_tasks([{'seeding_date': 'sub15days', 'irrigation': True,
+                                             'nutrition_factor': 0.25, 'phenology_factor': 1.0}])
+        task_id = tasks[0].id
+        self.database.add_slurm_job(SlurmJob(job_id=7, cluster='mpp2', job_type='main',
+                                             ssh_rc=0, task_id=task_id))
+        self.database.set_task_state(task_id, 'running')
+
+        def check_task(job_ids, cluster, timeout=None):
+            self.database.set_task_state(task_id, 'aggregating')
+            return 'User|JobID|State|Elapsed\nu|7|COMPLETED|00:00:01\n'
+        ssh = mock.Mock()
+        ssh.check_task.side_effect = check_task
+        runner = AsyncRunner(ssh, self.database, 10)
+        runner.active.set()
+        runner.work()
+        self.assertEqual(ssh.check_task.call_count, 1)
+        self.assertFalse(ssh.collect_task.called)
+        self.assertEqual(self.database.get_task_states([task_id]), {task_id: 'aggregating'})
+
+    def test_pipelined(self):
+        """Pipelined tasks are finished or failed by their archive job alone"""
+        _, tasks = self.database.add_tasks([{'seeding_date': 'sub15days', 'irrigation': True,
+                                             'nutrition_factor': 0.25, 'phenology_factor': 1.0}
+                                            for _ in range(3)])
+        for task in tasks:
+            for offset, job_type in enumerate(['main', 'aggregation', 'archive']):
+                self.database.add_slurm_job(SlurmJob(job_id=task.id * 10 + offset,
+                                                     cluster='mpp2', job_type=job_type,
+                                                     ssh_rc=0, task_id=task.id))
+            self.database.set_task_state(task.id, 'pipelined')
+        slurm_states = {tasks[0].id * 10 + 2: 'COMPLETED', tasks[1].id * 10 + 2: 'CANCELLED',
+                        tasks[2].id * 10 + 2: 'PENDING'}
+        ssh = mock.Mock()
+        ssh.check_task.side_effect = lambda job_ids, cluster, timeout=None: \
+            'User|JobID|State|Elapsed\n' + ''.join(
+                f"u|{job_id}|{slurm_states[int(job_id)]}|00:00:01\n"
+                for job_id in job_ids.split(','))
+        runner = AsyncRunner(ssh, self.database, 10)
+        runner.active.set()
+        runner.work()
+        checked = sorted(int(job_id) for call in ssh.check_task.call_args_list
+                         for job_id in call[0][0].split(','))
+        self.assertEqual(checked, sorted(slurm_states))
+        self.assertEqual(self.database.get_task_states([task.id for task in tasks]),
+                         {tasks[0].id: 'finished', tasks[1].id: 'failed',
+                          tasks[2].id: 'pipelined'})
+        self.assertFalse(ssh.collect_task.called or ssh.archive_task.called)
+
+
+class FakeSsh:
+    """Ssh building check commands without connection"""
+    def check_command(self, slurm_job_id, cluster_name):
+        """Returns the job ids as command"""
+        return f"{cluster_name} {slurm_job_id}"
+
+class FakeAioRunner(AioRunner):
+    """AioRunner answering check commands without ssh, cluster mpp3 is unreachable"""
+    async def execute(self, command):
+        cluster, job_ids = command.split(' ')
+        if cluster == 'mpp3':
+            raise OSError("unreachable")
+        return 0, 'User|JobID|State|Elapsed\n' + ''.join(f"u|{job_id}|RUNNING|00:00:01\n"
+                                                         for job_id in job_ids.split(',')), ''
+
+class TestAioRunner(unittest.TestCase):
+    """Unittest for papi.async_runner.aio.AioRunner"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        _, tasks = self.database.add_tasks([{'seeding_date': 'sub15days', 'irrigation': True,
+                                             'nutrition_factor': 0.25, 'phenology_factor': 1.0}
+                                            for _ in range(5)])
+        for task in tasks:
+            cluster = 'mpp3' if task.id == tasks[-1].id else 'mpp2'
+            self.database.add_slurm_job(SlurmJob(job_id=task.id, cluster=cluster,
+                                                 job_type='main', ssh_rc=0, task_id=task.id))
+            self.database.set_task_state(task.id, 'running')
+        self.tasks = tasks
+
+    def test_work(self):
+        """All chunks are checked concurrently, a failed cluster is counted"""
+        runner = FakeAioRunner(FakeSsh(), self.database, 10, {'CHECK_CHUNK_SIZE': 2},
+                               {'MAX_CHECKS': 2}, EventLoopThread('test-aio'))
+        runner.work()
+        checked = {job for cluster, job in runner.scheduler.intervals if cluster == 'mpp2'}
+        self.assertEqual(checked, {str(task.id) for task in self.tasks[:-1]})
+        self.assertEqual(runner.check_errors, {'mpp2': 0, 'mpp3': 1})
+        self.assertEqual(set(self.database.get_task_states([task.id for task in self.tasks])
+                             .values()), {'running'})
+
+    def test_resume_without_threads(self):
+        """An inactive runner waits on the event loop and starts with resume"""
+        loop_thread = EventLoopThread('test-aio-resume')
+        runner = FakeAioRunner(FakeSsh(), self.database, 3600, {'CHECK_CHUNK_SIZE': 2},
+                               {'MAX_CHECKS': 2}, loop_thread)
+        runner.run(active=False)
+        time.sleep(0.1)
+        self.assertEqual(runner.scheduler.intervals, {})
+        runner.resume()
+        deadline = time.monotonic() + 5
+        while not runner.scheduler.intervals and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(runner.scheduler.intervals)
+        self.assertFalse([thread.name for thread in threading.enumerate()
+                          if thread.name.startswith('asyncio_')])
+        runner.pause()
+        runner.future.cancel()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,299 @@
 """Unittest for papi.db.DB class"""
+import os
+import sqlite3
+import tempfile
+import threading
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from sqlalchemy import event
+from papi.db import SlurmJob, Transition
+from papi.db.db import TaskCache
+from papi.db.viwa_db import ViwaDb, task_fingerprint
+from papi.db.migrations import MIGRATIONS
+
+PAYLOAD = {'seeding_date': 'sub15days', 'irrigation': True,
+           'nutrition_factor': 0.25, 'phenology_factor': 1.0}
 
 class TestDB(unittest.TestCase):
+    """Unittest for papi.db.DB"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+
+    def add_task(self, state, job_id, cluster='mpp2', job_type='main'):
+        """Adds a task with a single slurm job in the given state"""
+        task = self.database.add_task(dict(PAYLOAD))
+        self.database.add_slurm_job(SlurmJob(job_id=job_id, cluster=cluster, job_type=job_type,
+                                             ssh_rc=0, task_id=task.id))
+        self.database.set_task_state(task.id, state)
+        return task.id
+
+    def test_get_tasks_by_state(self):
+        """Tasks of a state are returned with their jobs, optionally submitted ones only"""
+        running = self.add_task('running', 1)
+        self.add_task('archived', 2)
+        self.add_task('running', -1)
+        rows = self.database.get_tasks_by_state('running', successful_only=True)
+        self.assertEqual([row.Task.id for row in rows], [running])
+        rows = self.database.get_tasks_by_state('running')
+        self.assertEqual(len(rows), 2)
+
+    def test_get_poll_jobs(self):
+        """Only the latest job of the current phase of each task is returned"""
+        running = self.add_task('running', 1)
+        aggregating = self.add_task('aggregating', 2)
+        self.database.add_slurm_job(SlurmJob(job_id=3, cluster='mpp3', job_type='aggregation',
+                                             ssh_rc=0, task_id=aggregating))
+        self.database.add_slurm_job(SlurmJob(job_id=-1, cluster='', job_type='aggregation',
+                                             ssh_rc=1, task_id=aggregating))
+        self.add_task('finished', 4)
+        jobs = self.database.get_poll_jobs({'running': 'main', 'aggregating': 'aggregation'})
+        self.assertEqual(sorted((job.task.id, job.state, job.job_id, job.cluster) for job in jobs),
+                         [(running, 'running', 1, 'mpp2'),
+                          (aggregating, 'aggregating', 3, 'mpp3')])
+        self.assertEqual(self.database.get_param_from_task(jobs[0].task),
+                         f"1.0 0.25 1 sub15days {jobs[0].task.id}")
+
+    def test_apply_transitions(self):
+        """All transitions are applied in one commit, the last state of a task wins"""
+        _, tasks = self.database.add_tasks([dict(PAYLOAD) for _ in range(3)])
+        notified = []
+        self.database.add_state_listener(lambda task_id, state: notified.append((task_id, state)))
+        commits = []
+        engine = self.database.session().get_bind()
+        self.database.session.remove()
+        event.listen(engine, 'commit', lambda connection: commits.append(connection))
+        job = SlurmJob(job_id=5, cluster='mpp2', job_type='aggregation', ssh_rc=0,
+                       task_id=tasks[2].id)
+        self.database.apply_transitions([Transition(tasks[0].id, 'executed'),
+                                         Transition(tasks[1].id, 'executed'),
+                                         Transition(tasks[0].id, 'failed'),
+                                         Transition(tasks[2].id, 'aggregating', job)])
+        self.assertEqual(len(commits), 1)
+        self.assertEqual([self.database.get_task(task.id).state for task in tasks],
+                         ['failed', 'executed', 'aggregating'])
+        self.assertEqual(sorted(notified), sorted([(tasks[0].id, 'failed'),
+                                                   (tasks[1].id, 'executed'),
+                                                   (tasks[2].id, 'aggregating')]))
+        jobs = self.database.get_poll_jobs({'aggregating': 'aggregation'})
+        self.assertEqual([(job.task.id, job.job_id) for job in jobs], [(tasks[2].id, 5)])
+
+    def test_compare_and_set(self):
+        """Transitions of tasks in another than the expected state are skipped"""
+        running = self.add_task('running', 1)
+        moved = self.add_task('aggregating', 2)
+        notified = []
+        self.database.add_state_listener(lambda task_id, state: notified.append((task_id, state)))
+        job = SlurmJob(job_id=3, cluster='mpp2', job_type='aggregation', ssh_rc=0, task_id=moved)
+        applied = self.database.apply_transitions([
+            Transition(running, 'executed', job_id=1, expected_state='running'),
+            Transition(moved, 'aggregating', job, expected_state='executed')])
+        self.assertEqual(applied, [running])
+        self.assertEqual(notified, [(running, 'executed')])
+        self.assertEqual(self.database.get_task_states([running, moved]),
+                         {running: 'executed', moved: 'aggregating'})
+        self.assertEqual([row.SlurmJob.job_id for row in self.database.get_slurm_jobs(moved)],
+                         [2])
+        self.assertEqual([(row.task_id, row.old_state, row.new_state)
+                          for row in self.database.get_transitions(0, 10)][-1:],
+                         [(running, 'running', 'executed')])
+
+    def test_lease(self):
+        """A lease is granted to one owner until it expires or is released"""
+        self.assertTrue(self.database.acquire_lease('poller', 'a', 30))
+        self.assertFalse(self.database.acquire_lease('poller', 'b', 30))
+        self.assertTrue(self.database.acquire_lease('poller', 'a', -1))
+        self.assertTrue(self.database.acquire_lease('poller', 'b', 30))
+        self.database.release_lease('poller', 'a')
+        self.assertFalse(self.database.acquire_lease('poller', 'a', 30))
+        self.database.release_lease('poller', 'b')
+        self.assertTrue(self.database.acquire_lease('poller', 'a', 30))
+
+    def test_journal(self):
+        """Every state change is journaled in order and paged by sequence number"""
+        task = self.database.add_task(dict(PAYLOAD))
+        self.database.set_task_state(task.id, 'running')
+        self.database.apply_transitions([Transition(task.id, 'executed', job_id=7),
+                                         Transition(task.id + 1, 'failed')])
+        self.database.apply_transitions([Transition(task.id, 'executed')])
+        transitions = self.database.get_transitions()
+        self.assertEqual([(entry.task_id, entry.old_state, entry.new_state, entry.job_id)
+                          for entry in transitions],
+                         [(task.id, None, 'queued', None), (task.id, 'queued', 'running', None),
+                          (task.id, 'running', 'executed', 7)])
+        self.assertEqual([entry.seq for entry in transitions], sorted(entry.seq
+                                                                      for entry in transitions))
+        page = self.database.get_transitions(since=transitions[0].seq, limit=1)
+        self.assertEqual([entry.seq for entry in page], [transitions[1].seq])
+
+    def test_add_tasks(self):
+        """A batch is stored as group and its array jobs are mapped by index"""
+        group_id, tasks = self.database.add_tasks([dict(PAYLOAD), dict(PAYLOAD, debug=1),
+                                                   dict(PAYLOAD)])
+        self.assertEqual([task.state for task in tasks], ['queued', 'finished', 'queued'])
+        task_ids = self.database.get_group_task_ids(group_id, debug=False)
+        self.assertEqual(task_ids, [tasks[0].id, tasks[2].id])
+        self.database.add_array_jobs(7, 'mpp2', task_ids, 0, 'out', '', 'running')
+        rows = self.database.get_tasks_by_state('running')
+        self.assertEqual(sorted((row.Task.id, row.SlurmJob.array_index) for row in rows),
+                         [(tasks[0].id, 0), (tasks[2].id, 1)])
+
+    def test_claim_tasks(self):
+        """Queued tasks are claimed once and leave the outbox with their first job"""
+        group_id, tasks = self.database.add_tasks([dict(PAYLOAD), dict(PAYLOAD, debug=1)])
+        other = self.database.add_task(dict(PAYLOAD))
+        self.assertEqual(self.database.get_outbox(), [(tasks[0].id, group_id), (other.id, None)])
+        self.assertEqual(self.database.claim_tasks([tasks[0].id, other.id], 'queued',
+                                                   'submitting'), [tasks[0].id, other.id])
+        self.assertEqual(self.database.claim_tasks([other.id], 'queued', 'submitting'), [])
+        self.assertEqual(self.database.get_task_revision(other.id), 1)
+        self.assertEqual(self.database.get_outbox('submitting'),
+                         [(tasks[0].id, group_id), (other.id, None)])
+        self.database.apply_transitions([Transition(other.id, 'running',
+                                                    SlurmJob(job_id=1, job_type='main'))])
+        self.assertEqual(self.database.get_outbox('submitting'), [(tasks[0].id, group_id)])
+        params = self.database.get_task_params([other.id, tasks[0].id])
+        self.assertEqual([task.id for task in params], [other.id, tasks[0].id])
+        self.assertEqual(self.database.get_param_from_task(params[0]),
+                         self.database.get_param_from_task(other))
+
+    def test_get_task_states(self):
+        """States are returned by task ids or by group"""
+        group_id, tasks = self.database.add_tasks([dict(PAYLOAD), dict(PAYLOAD, debug=1)])
+        other = self.database.add_task(dict(PAYLOAD))
+        self.assertEqual(self.database.get_task_states(group_id=group_id),
+                         {tasks[0].id: 'queued', tasks[1].id: 'finished'})
+        self.assertEqual(self.database.get_task_states(task_ids=[other.id, tasks[1].id, 999]),
+                         {other.id: 'queued', tasks[1].id: 'finished'})
+        self.assertEqual(self.database.get_task_states(task_ids=[]), {})
+
+    def test_task_fingerprint(self):
+        """Equivalent parameter sets share a fingerprint"""
+        self.assertEqual(task_fingerprint(PAYLOAD),
+                         task_fingerprint(dict(PAYLOAD, seeding_date='-15 days',
+                                               nutrition_factor='0.250')))
+        self.assertNotEqual(task_fingerprint(PAYLOAD),
+                            task_fingerprint(dict(PAYLOAD, irrigation=False)))
+
+    def test_add_task_cached(self):
+        """Identical submits attach to the existing task until it failed"""
+        task, created = self.database.add_task_cached(dict(PAYLOAD))
+        self.assertTrue(created)
+        cached, created = self.database.add_task_cached(dict(PAYLOAD))
+        self.assertFalse(created)
+        self.assertEqual(cached.id, task.id)
+        bypassed, created = self.database.add_task_cached(dict(PAYLOAD), bypass=True)
+        self.assertTrue(created)
+        self.database.set_task_state(bypassed.id, 'failed')
+        retried, created = self.database.add_task_cached(dict(PAYLOAD))
+        self.assertTrue(created)
+        self.assertNotIn(retried.id, [task.id, bypassed.id])
+
+    def test_cached_task_without_job(self):
+        """Unfinished tasks without live slurm job are not reused"""
+        task, _ = self.database.add_task_cached(dict(PAYLOAD))
+        self.database.add_slurm_job(SlurmJob(job_id=-1, cluster='', job_type='main',
+                                             ssh_rc=1, task_id=task.id))
+        self.database.set_task_state(task.id, 'running')
+        retried, created = self.database.add_task_cached(dict(PAYLOAD))
+        self.assertTrue(created)
+        self.assertNotEqual(retried.id, task.id)
+        self.assertEqual(self.database.add_task_cached(dict(PAYLOAD))[0].id, retried.id)
+
+    def test_expired_running_task(self):
+        """An expired entry is replaced although its task is still running"""
+        task, _ = self.database.add_task_cached(dict(PAYLOAD), ttl=60)
+        self.database.add_slurm_job(SlurmJob(job_id=42, cluster='mpp2', job_type='main',
+                                             ssh_rc=0, task_id=task.id))
+        self.database.set_task_state(task.id, 'running')
+        self.assertEqual(self.database.add_task_cached(dict(PAYLOAD), ttl=60)[0].id, task.id)
+        session = self.database.session()
+        session.query(TaskCache).update({TaskCache.created: datetime.utcnow() -
+                                                            timedelta(seconds=120)})
+        session.commit()
+        self.database.session.remove()
+        retried, created = self.database.add_task_cached(dict(PAYLOAD), ttl=60)
+        self.assertTrue(created)
+        self.assertNotEqual(retried.id, task.id)
+        self.assertEqual(self.database.get_task(task.id).state, 'running')
+        self.assertEqual(self.database.add_task_cached(dict(PAYLOAD), ttl=60)[0].id, retried.id)
+
+    def test_add_task_cached_race(self):
+        """A task added concurrently with the same fingerprint is returned instead"""
+        task, _ = self.database.add_task_cached(dict(PAYLOAD))
+        lookup = getattr(self.database, '_DB__get_cached_task')
+        calls = []
+
+        def get_cached_task(*args):
+            # The first lookup misses the entry of the concurrent request
+            calls.append(args)
+            return None if len(calls) == 1 else lookup(*args)
+
+        with mock.patch.object(self.database, '_DB__get_cached_task', get_cached_task):
+            cached, created = self.database.add_task_cached(dict(PAYLOAD))
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(created)
+        self.assertEqual(cached.id, task.id)
+        self.assertEqual(self.database.get_task_states(task_ids=[task.id + 1]), {})
+
+    def test_migrate(self):
+        """A database of the initial schema is upgraded to the latest version"""
+        filename = os.path.join(self.tmp_dir.name, 'legacy.sqlite3')
+        connection = sqlite3.connect(filename)
+        connection.execute("CREATE TABLE tasks (id INTEGER PRIMARY KEY, state VARCHAR, "
+                           "debug BOOLEAN, seeding_date VARCHAR, irrigation BOOLEAN, "
+                           "nutrition_factor FLOAT, phenology_factor FLOAT)")
+        connection.execute("CREATE TABLE slurm_jobs (id INTEGER PRIMARY KEY, job_id INTEGER, "
+                           "cluster VARCHAR, job_type VARCHAR, ssh_rc INTEGER, "
+                           "ssh_stdout VARCHAR, ssh_stderr VARCHAR, "
+                           "task_id INTEGER REFERENCES tasks(id))")
+        connection.execute("INSERT INTO tasks VALUES (1, 'running', 0, 'sub15days', 1, 0.5, 1.0)")
+        connection.execute("INSERT INTO slurm_jobs VALUES (1, 7, 'mpp2', 'main', 0, '', '', 1)")
+        connection.commit()
+        connection.close()
+
+        database = ViwaDb({'BASE_DIR': '', 'FILENAME': filename[1:]})
+        rows = database.get_tasks_by_state('running', successful_only=True)
+        self.assertEqual([(row.Task.id, row.SlurmJob.array_index) for row in rows], [(1, None)])
+        connection = sqlite3.connect(filename)
+        self.assertEqual(connection.execute("PRAGMA user_version").fetchone()[0],
+                         MIGRATIONS[-1][0])
+        indexes = {row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        connection.close()
+        self.assertIn('ix_tasks_state', indexes)
+        self.assertIn('ix_slurm_jobs_task_id_job_type', indexes)
+
+    def test_wal_pool(self):
+        """Pooled connections use WAL and are shared by concurrent threads"""
+        filename = os.path.join(self.tmp_dir.name, 'wal.sqlite3')
+        database = ViwaDb({'BASE_DIR': '', 'FILENAME': filename[1:], 'JOURNAL_MODE': 'WAL',
+                           'SYNCHRONOUS': 'NORMAL', 'POOL_SIZE': 2, 'MAX_OVERFLOW': 2})
+        _, tasks = database.add_tasks([dict(PAYLOAD) for _ in range(4)])
+        errors = []
+
+        def update(task_id):
+            try:
+                for state in ['running', 'aggregating', 'archived']:
+                    database.set_task_state(task_id, state)
+                    database.get_task(task_id)
+            except Exception as exception: #pylint: disable=broad-except
+                errors.append(exception)
 
-    def test_noop(self):
-        self.assertEqual(True, True)
+        threads = [threading.Thread(target=update, args=(task.id,)) for task in tasks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual({database.get_task(task.id).state for task in tasks}, {'archived'})
+        connection = sqlite3.connect(filename)
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        connection.close()
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
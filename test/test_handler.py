@@ -0,0 +1,641 @@
+"""Unittest for papi.handler helper classes"""
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from flask import Flask
+from flask_restful import Api
+from papi.db.viwa_db import ViwaDb
+from papi.handler import (Status, StatusBatch, Submit, SubmitBatch, Sweep, Events, Logs,
+                          Changes)
+from papi.handler.status_cache import StatusCache
+from papi.handler.event_hub import EventHub
+from papi.handler.dispatcher import SubmitDispatcher
+from papi.worker import Worker
+from papi.exceptions import SubmitQueueFullError, ExpansionConflictError
+
+CONFIG = {'JWT_REQUIRED': False,
+          'HTTP': {'OK_RESP_CODE': 200, 'CLIENT_ERR_RESP_CODE': 400}}
+PAYLOAD = {'seeding_date': 'sub15days', 'irrigation': True,
+           'nutrition_factor': 0.25, 'phenology_factor': 1.0}
+
+class TestStatusCache(unittest.TestCase):
+    """Unittest for papi.handler.StatusCache"""
+    def setUp(self):
+        self.cache = StatusCache({'MAX_SIZE': 2, 'TTL': 5})
+
+    def test_hit_and_miss(self):
+        """Stored responses are returned and counted"""
+        self.assertIsNone(self.cache.get(1))
+        self.cache.put(1, 'running', ('running', {}), self.cache.token())
+        self.assertEqual(self.cache.get(1), ('running', {}))
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_ttl(self):
+        """Non terminal states expire, terminal states are kept"""
+        self.cache.put(1, 'running', 'a', self.cache.token())
+        self.cache.put(2, 'finished', 'b', self.cache.token())
+        with mock.patch('time.monotonic', return_value=10**9):
+            self.assertIsNone(self.cache.get(1))
+            self.assertEqual(self.cache.get(2), 'b')
+
+    def test_lru(self):
+        """The least recently used entry is evicted first"""
+        for task_id in [1, 2]:
+            self.cache.put(task_id, 'finished', task_id, self.cache.token())
+        self.cache.get(1)
+        self.cache.put(3, 'finished', 3, self.cache.token())
+        self.assertEqual([self.cache.get(task_id) for task_id in [1, 2, 3]], [1, None, 3])
+
+    def test_invalidate(self):
+        """Invalidated entries are removed and reads started before are not stored"""
+        self.cache.put(1, 'finished', 'a', self.cache.token())
+        token = self.cache.token()
+        self.cache.invalidate(1, 'failed')
+        self.assertIsNone(self.cache.get(1))
+        self.cache.put(1, 'running', 'stale', token)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.put(1, 'failed', 'b', self.cache.token())
+        self.assertEqual(self.cache.get(1), 'b')
+
+
+class TestStatus(unittest.TestCase):
+    """Unittest for papi.handler.Status"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.cache = StatusCache()
+        self.database.add_state_listener(self.cache.invalidate)
+        app = Flask(__name__)
+        api = Api(app)
+        api.add_resource(Status, '/status/<int:task_id>',
+                         resource_class_args=(self.database, None, CONFIG),
+                         resource_class_kwargs={'status_cache': self.cache})
+        self.client = app.test_client()
+
+    def test_etag(self):
+        """Unchanged tasks are answered with 304, changed tasks with a new ETag"""
+        task = self.database.add_task(dict(PAYLOAD))
+        response = self.client.get(f'/status/{task.id}')
+        etag = response.headers['ETag']
+        self.assertEqual(response.get_json()['status'], 'queued')
+        response = self.client.get(f'/status/{task.id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.database.set_task_state(task.id, 'running')
+        response = self.client.get(f'/status/{task.id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_json()['status'], 'running')
+
+    def test_journal_invalidation(self):
+        """Changes of other processes invalidate the cache once read from the journal"""
+        task = self.database.add_task(dict(PAYLOAD))
+        hub = EventHub(self.database, {'JOURNAL_INTERVAL': 3600})
+        hub.add_journal_listener(self.cache.invalidate)
+        hub.follow_journal()
+        self.assertEqual(self.client.get(f'/status/{task.id}').get_json()['status'], 'queued')
+        ViwaDb(self.database.config).set_task_state(task.id, 'running')
+        self.assertEqual(self.client.get(f'/status/{task.id}').get_json()['status'], 'queued')
+        self.assertEqual(hub.read_journal(), 1)
+        self.assertEqual(self.client.get(f'/status/{task.id}').get_json()['status'], 'running')
+
+
+class TestStatusBatch(unittest.TestCase):
+    """Unittest for papi.handler.StatusBatch"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        app = Flask(__name__)
+        api = Api(app)
+        api.add_resource(StatusBatch, '/status/',
+                         resource_class_args=(self.database, None,
+                                              dict(CONFIG, MAX_STATUS_TASKS=2)))
+        self.client = app.test_client()
+
+    def test_ids(self):
+        """Ids are read from the query or the payload, unknown ids are reported missing"""
+        first = self.database.add_task(dict(PAYLOAD))
+        second = self.database.add_task(dict(PAYLOAD))
+        self.database.set_task_state(second.id, 'archived')
+        response = self.client.get(f'/status/?ids={first.id}, 99,')
+        self.assertEqual(response.get_json()['message'],
+                         {'tasks': {str(first.id): 'queued'}, 'missing': [99]})
+        response = self.client.post('/status/', json={'task_ids': [second.id, first.id]})
+        self.assertEqual(response.get_json()['message']['tasks'],
+                         {str(first.id): 'queued', str(second.id): 'running'})
+
+    def test_invalid_ids(self):
+        """Malformed, empty, non positive and too many ids are rejected"""
+        for query in ['ids=a', 'ids=0', 'ids=,', 'ids=1,2,3', 'batch_id=x', '']:
+            response = self.client.get(f'/status/?{query}')
+            self.assertEqual(response.status_code, 400, query)
+            self.assertEqual(response.get_json()['status'], 'error')
+        self.assertEqual(self.client.post('/status/', json=[1]).status_code, 400)
+
+    def test_group_pages(self):
+        """The tasks of a batch or sweep are paged by MAX_STATUS_TASKS"""
+        group_id, tasks = self.database.add_tasks([dict(PAYLOAD) for _ in range(3)])
+        self.database.add_task(dict(PAYLOAD))
+        page = self.client.get(f'/status/?batch_id={group_id}').get_json()['message']
+        self.assertEqual(list(page['tasks']), [str(task.id) for task in tasks[:2]])
+        self.assertEqual((page['next'], page['more']), (tasks[1].id, True))
+        page = self.client.post('/status/', json={'sweep_id': group_id,
+                                                  'after': page['next']}).get_json()['message']
+        self.assertEqual(list(page['tasks']), [str(tasks[2].id)])
+        self.assertEqual((page['next'], page['more']), (tasks[2].id, False))
+        page = self.client.get('/status/?sweep_id=99').get_json()['message']
+        self.assertEqual((page['tasks'], page['more']), ({}, False))
+
+
+class TestChanges(unittest.TestCase):
+    """Unittest for papi.handler.Changes"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        app = Flask(__name__)
+        api = Api(app)
+        api.add_resource(Changes, '/changes/',
+                         resource_class_args=(self.database, None, dict(CONFIG, MAX_CHANGES=3)))
+        self.client = app.test_client()
+
+    def test_paging(self):
+        """The journal is paged after since, limit is capped by MAX_CHANGES"""
+        task = self.database.add_task(dict(PAYLOAD))
+        for state in ['running', 'executed', 'aggregating', 'archiving']:
+            self.database.set_task_state(task.id, state)
+        page = self.client.get('/changes/?limit=10').get_json()['message']
+        self.assertEqual([(change['old_state'], change['new_state'])
+                          for change in page['changes']],
+                         [(None, 'queued'), ('queued', 'running'), ('running', 'executed')])
+        self.assertTrue(page['more'])
+        page = self.client.get(f"/changes/?since={page['next']}&limit=1").get_json()['message']
+        self.assertEqual([change['new_state'] for change in page['changes']], ['aggregating'])
+        self.assertTrue(page['more'])
+        page = self.client.get(f"/changes/?since={page['next']}").get_json()['message']
+        self.assertEqual([change['new_state'] for change in page['changes']], ['archiving'])
+        self.assertFalse(page['more'])
+        last = self.client.get(f"/changes/?since={page['next']}").get_json()['message']
+        self.assertEqual((last['changes'], last['next'], last['more']),
+                         ([], page['next'], False))
+
+    def test_invalid_arguments(self):
+        """Malformed or negative cursors and non positive limits are rejected"""
+        for query in ['since=a', 'since=-1', 'limit=0', 'limit=x']:
+            response = self.client.get(f'/changes/?{query}')
+            self.assertEqual(response.status_code, 400, query)
+            self.assertEqual(response.get_json()['status'], 'error')
+
+
+class TestSubmit(unittest.TestCase):
+    """Unittest for papi.handler.Submit"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.submit = Submit(self.database, mock.Mock(), dict(CONFIG, SUBMIT_FIELDS_REQUIRED={}))
+
+    def test_failed_sbatch(self):
+        """A task whose sbatch failed is failed and not reused by identical submits"""
+        task, _ = self.database.add_task_cached(dict(PAYLOAD))
+        self.submit.submit_task_finished(1, '', 'sbatch: error', task.id)
+        self.assertEqual(self.database.get_task(task.id).state, 'failed')
+        retried, created = self.database.add_task_cached(dict(PAYLOAD))
+        self.assertTrue(created)
+        self.submit.submit_task_finished(0, 'Submitted batch job 42 on cluster mpp2\n', '',
+                                         retried.id)
+        self.assertEqual(self.database.get_task(retried.id).state, 'running')
+        cached, created = self.database.add_task_cached(dict(PAYLOAD))
+        self.assertEqual((cached.id, created), (retried.id, False))
+
+
+class TestSubmitBatch(unittest.TestCase):
+    """Unittest for papi.handler.SubmitBatch"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.ssh = mock.Mock()
+        self.config = dict(CONFIG, MAX_BATCH_SIZE=3,
+                           SUBMIT_FIELDS_REQUIRED={'seeding_date': str, 'irrigation': bool,
+                                                   'nutrition_factor': float,
+                                                   'phenology_factor': float})
+        app = Flask(__name__)
+        api = Api(app)
+        api.add_resource(SubmitBatch, '/submit/batch/',
+                         resource_class_args=(self.database, self.ssh, self.config))
+        self.client = app.test_client()
+
+    def test_submit(self):
+        """A batch is stored as one group and submitted as one job array in order"""
+        payloads = [dict(PAYLOAD, nutrition_factor=value) for value in [0.25, 0.5]]
+        payloads.append(dict(PAYLOAD, debug=True))
+        response = self.client.post('/submit/batch/', json=payloads)
+        self.assertEqual(response.status_code, 200)
+        message = response.get_json()['message']
+        self.assertEqual(self.database.get_group_task_ids(message['batch_id']),
+                         message['task_ids'])
+        group_id, params, callback = self.ssh.submit_array.call_args[0]
+        self.assertEqual(group_id, message['batch_id'])
+        self.assertEqual(params, [f"1.0 {value} 1 sub15days {task_id}" for value, task_id
+                                  in zip([0.25, 0.5], message['task_ids'])])
+        callback(0, 'Submitted batch job 42 on cluster mpp2\n', '', group_id)
+        jobs = self.database.get_poll_jobs({'running': 'main'})
+        self.assertEqual(sorted((job.task.id, job.job_id, job.array_index) for job in jobs),
+                         [(message['task_ids'][0], 42, 0), (message['task_ids'][1], 42, 1)])
+
+    def test_failed_sbatch(self):
+        """All tasks of a job array which could not be submitted are failed"""
+        self.client.post('/submit/batch/', json=[dict(PAYLOAD), dict(PAYLOAD)])
+        group_id, _, callback = self.ssh.submit_array.call_args[0]
+        callback(1, '', 'sbatch: error', group_id)
+        task_ids = self.database.get_group_task_ids(group_id)
+        self.assertEqual(set(self.database.get_task_states(task_ids).values()), {'failed'})
+
+    def test_invalid_batch(self):
+        """Empty, oversized and invalid batches are rejected without storing tasks"""
+        invalid = dict(PAYLOAD, nutrition_factor='high')
+        for payloads in [[], {'tasks': []}, [dict(PAYLOAD)] * 4, [dict(PAYLOAD), invalid]]:
+            response = self.client.post('/submit/batch/', json=payloads)
+            self.assertEqual(response.status_code, 400, payloads)
+        self.assertIn('Payload 1', response.get_json()['message'])
+        self.assertEqual(self.database.get_task_states(task_ids=[1]), {})
+        self.assertFalse(self.ssh.submit_array.called)
+
+    def test_queue_full(self):
+        """Batches are answered with 429 while the submit queue is full"""
+        dispatcher = mock.Mock()
+        dispatcher.reserve.side_effect = SubmitQueueFullError('Submit queue is full')
+        api = Api(Flask(__name__))
+        api.add_resource(SubmitBatch, '/submit/batch/',
+                         resource_class_args=(self.database, self.ssh, self.config),
+                         resource_class_kwargs={'dispatcher': dispatcher})
+        response = api.app.test_client().post('/submit/batch/', json=[dict(PAYLOAD)])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.database.get_task_states(task_ids=[1]), {})
+
+
+class TestPipelined(unittest.TestCase):
+    """Unittest for the pipelined mode of papi.handler.Submit and SubmitBatch"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.ssh = mock.Mock()
+        config = dict(CONFIG, SUBMIT_FIELDS_REQUIRED={}, PIPELINED=True)
+        self.submit = Submit(self.database, self.ssh, config)
+        self.batch = SubmitBatch(self.database, self.ssh, config)
+
+    def state(self, task_id):
+        return self.database.get_task(task_id).state
+
+    def test_chain(self):
+        """Every phase is queued with a dependency on the job of the previous phase"""
+        task = self.database.add_task(dict(PAYLOAD))
+        self.submit.submit_task_finished(0, 'Submitted batch job 42 on cluster mpp2\n', '',
+                                         task.id)
+        self.assertEqual(self.state(task.id), 'pipelining')
+        args, kwargs = self.ssh.collect_task.call_args
+        self.assertEqual((args[0].id, args[1], kwargs), (task.id,
+                                                         self.submit.pipeline_collect_finished,
+                                                         {'dependency': 42}))
+        self.submit.pipeline_collect_finished(0, 'Submitted batch job 43 on cluster mpp2\n', '',
+                                              task.id)
+        self.assertEqual(self.ssh.archive_task.call_args[1], {'dependency': 43})
+        self.assertEqual(self.state(task.id), 'pipelining')
+        self.submit.pipeline_archive_finished(0, 'Submitted batch job 44 on cluster mpp2\n', '',
+                                              task.id)
+        self.assertEqual(self.state(task.id), 'pipelined')
+        self.assertEqual(sorted((row.SlurmJob.job_type, row.SlurmJob.job_id) for row in
+                                self.database.get_slurm_jobs(task_id=task.id)),
+                         [('aggregation', 43), ('archive', 44), ('main', 42)])
+
+    def test_queue_fails(self):
+        """A phase which cannot be queued falls back to the phase of the last queued job"""
+        first = self.database.add_task(dict(PAYLOAD))
+        second = self.database.add_task(dict(PAYLOAD))
+        self.ssh.collect_task.side_effect = OSError('No free ssh channel')
+        self.ssh.archive_task.side_effect = OSError('No free ssh channel')
+        self.submit.submit_task_finished(0, 'Submitted batch job 42 on cluster mpp2\n', '',
+                                         first.id)
+        self.assertEqual(self.state(first.id), 'running')
+        self.database.set_task_state(second.id, 'pipelining')
+        self.submit.pipeline_collect_finished(0, 'Submitted batch job 43 on cluster mpp2\n', '',
+                                              second.id)
+        self.assertEqual(self.state(second.id), 'aggregating')
+
+    def test_sbatch_fails(self):
+        """A phase whose sbatch failed fails the task"""
+        task = self.database.add_task(dict(PAYLOAD))
+        self.database.set_task_state(task.id, 'pipelining')
+        self.submit.pipeline_collect_finished(1, '', 'sbatch: error', task.id)
+        self.assertEqual(self.state(task.id), 'failed')
+        self.assertFalse(self.ssh.archive_task.called)
+        task = self.database.add_task(dict(PAYLOAD))
+        self.database.set_task_state(task.id, 'pipelining')
+        self.submit.pipeline_archive_finished(1, '', 'sbatch: error', task.id)
+        self.assertEqual(self.state(task.id), 'failed')
+
+    def test_array(self):
+        """Collect jobs of a job array depend on their array element"""
+        group_id, tasks = self.database.add_tasks([dict(PAYLOAD), dict(PAYLOAD)])
+        self.ssh.collect_task.side_effect = [OSError('No free ssh channel'), 0]
+        self.batch.submit_batch_finished([task.id for task in tasks], 0,
+                                         'Submitted batch job 7 on cluster mpp2\n', '', group_id)
+        self.assertEqual([call[1] for call in self.ssh.collect_task.call_args_list],
+                         [{'dependency': '7_0'}, {'dependency': '7_1'}])
+        self.assertEqual([self.state(task.id) for task in tasks], ['running', 'pipelining'])
+
+
+class TestLogs(unittest.TestCase):
+    """Unittest for papi.handler.Logs"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        ssh = mock.Mock()
+        ssh.get_log_filename.side_effect = lambda log_name, stream: \
+            os.path.join(self.tmp_dir.name, f'{log_name}.{stream}.log')
+        app = Flask(__name__)
+        api = Api(app)
+        api.add_resource(Logs, '/logs/<int:task_id>',
+                         resource_class_args=(self.database, ssh, CONFIG))
+        self.client = app.test_client()
+
+    def write_log(self, log_name, data):
+        with open(os.path.join(self.tmp_dir.name, f'{log_name}.stdout.log'), 'w') as log_file:
+            log_file.write(data)
+
+    def test_group_log(self):
+        """Tasks of a batch get the log of the array submit before their own log"""
+        group_id, tasks = self.database.add_tasks([dict(PAYLOAD), dict(PAYLOAD)])
+        single = self.database.add_task(dict(PAYLOAD))
+        self.assertEqual(self.client.get(f'/logs/{single.id}').status_code, 400)
+        self.write_log(single.id, 'collect\n')
+        self.assertEqual(self.client.get(f'/logs/{single.id}').data, b'collect\n')
+        self.write_log(f'group_{group_id}', 'Submitted batch job 7\n')
+        self.assertEqual(self.client.get(f'/logs/{tasks[1].id}').data,
+                         b'Submitted batch job 7\n')
+        self.write_log(tasks[1].id, 'archive\n')
+        self.assertEqual(self.client.get(f'/logs/{tasks[1].id}').data,
+                         b'Submitted batch job 7\narchive\n')
+
+
+class TestSweep(unittest.TestCase):
+    """Unittest for papi.handler.Sweep"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.config = dict(CONFIG, MAX_SWEEP_SIZE=100, SWEEP_CHUNK_SIZE=2,
+                           SUBMIT_FIELDS_REQUIRED={'seeding_date': str, 'irrigation': bool,
+                                                   'nutrition_factor': float,
+                                                   'phenology_factor': float})
+        app = Flask(__name__)
+        api = Api(app)
+        api.add_resource(Sweep, '/sweep/', '/sweep/<int:sweep_id>',
+                         resource_class_args=(self.database, mock.Mock(), self.config))
+        self.client = app.test_client()
+
+    def add_sweep(self, expanded):
+        """Adds a sweep of 5 tasks of which the first expanded are stored"""
+        factors = [0.1, 0.2, 0.3, 0.4, 0.5]
+        axes = {name: [value] for name, value in PAYLOAD.items()}
+        group_id = self.database.add_task_group('sweep', 5, params=json.dumps(
+            dict(axes, nutrition_factor=factors)))
+        if expanded:
+            self.database.add_tasks([dict(PAYLOAD, nutrition_factor=value)
+                                     for value in factors[:expanded]],
+                                    group_id=group_id, cursor=0)
+        return group_id
+
+    def progress(self, sweep_id):
+        """Returns the progress of a sweep as reported by GET /sweep/<id>"""
+        return self.client.get(f'/sweep/{sweep_id}').get_json()['message']
+
+    def test_resume(self):
+        """An interrupted expansion continues after the stored grid points"""
+        sweep_id = self.add_sweep(2)
+        progress = self.progress(sweep_id)
+        self.assertEqual((progress['expanded'], progress['complete']), (2, False))
+        sweep = Sweep(self.database, mock.Mock(), self.config)
+        self.assertEqual(sweep.resume(), 1)
+        deadline = time.monotonic() + 5
+        while not self.progress(sweep_id)['complete'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        progress = self.progress(sweep_id)
+        self.assertEqual((progress['expanded'], progress['complete'], progress['error']),
+                         (5, True, None))
+        factors = [task.nutrition_factor for task in
+                   map(self.database.get_task, self.database.get_group_task_ids(sweep_id))]
+        self.assertEqual(factors, [0.1, 0.2, 0.3, 0.4, 0.5])
+        self.assertEqual(sweep.resume(), 0)
+
+    def test_expansion_conflict(self):
+        """An expansion overtaken by another one stops without storing tasks twice"""
+        sweep_id = self.add_sweep(2)
+        with self.assertRaises(ExpansionConflictError):
+            self.database.add_tasks([dict(PAYLOAD)], group_id=sweep_id, cursor=0)
+        sweep = Sweep(self.database, mock.Mock(), self.config)
+        original = self.database.add_tasks
+
+        def overtaken(payloads, kind='batch', group_id=None, cursor=None):
+            if cursor == 2:
+                original(payloads, kind, group_id, cursor)
+            return original(payloads, kind, group_id, cursor)
+        with mock.patch.object(self.database, 'add_tasks', side_effect=overtaken):
+            sweep.expand(sweep_id)
+        self.assertEqual(len(self.database.get_group_task_ids(sweep_id)), 4)
+        self.assertEqual(self.progress(sweep_id)['complete'], False)
+
+    def test_expansion_error(self):
+        """A failed expansion is reported and retried by resume"""
+        sweep_id = self.add_sweep(0)
+        sweep = Sweep(self.database, mock.Mock(), self.config)
+        with mock.patch.object(self.database, 'add_tasks', side_effect=OSError('disk full')):
+            sweep.expand(sweep_id)
+        progress = self.progress(sweep_id)
+        self.assertEqual((progress['expanded'], progress['complete'], progress['error']),
+                         (0, False, 'disk full'))
+        sweep.expand(sweep_id)
+        progress = self.progress(sweep_id)
+        self.assertEqual((progress['expanded'], progress['complete'], progress['error']),
+                         (5, True, None))
+
+    def test_size_limit(self):
+        """Oversized ranges are rejected before they are expanded"""
+        payload = dict(PAYLOAD, nutrition_factor={'start': 0, 'stop': 1e12, 'step': 1})
+        with mock.patch('papi.handler.sweep.expand_axis') as expand_axis:
+            response = self.client.post('/sweep/', json=payload)
+            self.assertFalse(expand_axis.called)
+        self.assertEqual(response.status_code, 400)
+        payload = dict(PAYLOAD, nutrition_factor=[0.25] * 20, phenology_factor=[1.0] * 20)
+        self.assertEqual(self.client.post('/sweep/', json=payload).status_code, 400)
+
+
+class TestEventHub(unittest.TestCase):
+    """Unittest for papi.handler.EventHub"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.hub = EventHub(self.database, {'BUFFER_SIZE': 2})
+        self.database.add_state_listener(self.hub.publish)
+
+    def test_group_subscription(self):
+        """Subscribers of a group receive the events of all its tasks"""
+        group_id, tasks = self.database.add_tasks([dict(PAYLOAD), dict(PAYLOAD)])
+        other = self.database.add_task(dict(PAYLOAD))
+        subscription = self.hub.subscribe(group_id=group_id)
+        single = self.hub.subscribe(task_ids=[other.id])
+        self.database.set_task_state(other.id, 'running')
+        self.database.set_task_state(tasks[1].id, 'finished')
+        events = subscription.get(timeout=5)
+        self.assertEqual([(event['task_id'], event['group_id'], event['state'])
+                          for event in events], [(tasks[1].id, group_id, 'finished')])
+        self.assertEqual([event['state'] for event in single.get(timeout=5)], ['running'])
+
+    def test_bounded_buffer(self):
+        """Events beyond the buffer of a slow subscriber are dropped"""
+        task = self.database.add_task(dict(PAYLOAD))
+        subscription = self.hub.subscribe(task_ids=[task.id])
+        for state in ['running', 'executed', 'aggregating', 'archived']:
+            self.hub.publish(task.id, state)
+        marker = self.hub.subscribe(task_ids=[task.id])
+        self.hub.publish(task.id, 'finished')
+        marker.get(timeout=5)
+        self.assertEqual([event['phase'] for event in subscription.get(timeout=1)],
+                         ['running', 'executed'])
+        self.assertEqual(subscription.dropped, 3)
+        self.hub.unsubscribe(subscription)
+        self.assertEqual(self.hub.subscribers, [marker])
+
+    def test_read_journal(self):
+        """Changes journaled by other processes are published in order"""
+        task = self.database.add_task(dict(PAYLOAD))
+        hub = EventHub(self.database, {'JOURNAL_INTERVAL': 3600})
+        hub.follow_journal()
+        subscription = hub.subscribe(task_ids=[task.id])
+        other = ViwaDb(self.database.config)
+        other.set_task_state(task.id, 'running')
+        other.set_task_state(task.id, 'finished')
+        self.assertEqual(hub.read_journal(limit=1), 2)
+        self.assertEqual([event['phase'] for event in subscription.get(timeout=5)],
+                         ['running', 'finished'])
+        self.assertEqual(hub.read_journal(), 0)
+
+
+class TestEvents(unittest.TestCase):
+    """Unittest for papi.handler.Events"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.hub = EventHub(self.database, {'MAX_SUBSCRIBERS': 2})
+        app = Flask(__name__)
+        api = Api(app)
+        api.add_resource(Events, '/events/', resource_class_args=(self.database, None, CONFIG),
+                         resource_class_kwargs={'event_hub': self.hub})
+        self.client = app.test_client()
+
+    def test_invalid_wait(self):
+        """Requests with an invalid wait are rejected without subscribing"""
+        for _ in range(3):
+            response = self.client.get('/events/?ids=1&wait=soon')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.hub.subscribers, [])
+
+    def test_poll_snapshot(self):
+        """A long poll returns the current state of changes made before it started"""
+        task = self.database.add_task(dict(PAYLOAD))
+        self.database.set_task_state(task.id, 'finished')
+        message = self.client.get(f'/events/?ids={task.id}&wait=0').get_json()['message']
+        self.assertEqual(message['tasks'], {str(task.id): 'finished'})
+        self.assertEqual(message['events'], [])
+        self.assertEqual(self.hub.subscribers, [])
+
+
+class TestSubmitDispatcher(unittest.TestCase):
+    """Unittest for papi.handler.SubmitDispatcher"""
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.database = ViwaDb({'BASE_DIR': '',
+                                'FILENAME': os.path.join(self.tmp_dir.name, 'db.sqlite3')[1:]})
+        self.ssh = mock.Mock()
+        config = dict(CONFIG, SUBMIT_FIELDS_REQUIRED={},
+                      DISPATCHER={'WORKERS': 1, 'QUEUE_SIZE': 1, 'SCAN_INTERVAL': 3600})
+        self.dispatcher = SubmitDispatcher(self.database, self.ssh, config)
+
+    def test_backpressure(self):
+        """Requests are rejected while all slots are reserved"""
+        self.dispatcher.reserve()
+        with self.assertRaises(SubmitQueueFullError):
+            self.dispatcher.reserve()
+        self.dispatcher.cancel()
+        self.dispatcher.reserve()
+
+    def test_submit(self):
+        """Tasks are claimed and submitted once, failed submissions are queued again"""
+        self.ssh.submit_task.side_effect = [OSError('connection refused'), 0]
+        task = self.database.add_task(dict(PAYLOAD))
+        self.dispatcher.start()
+        for _ in range(2):
+            self.dispatcher.queue.join()
+            self.dispatcher.scan()
+        self.dispatcher.queue.join()
+        self.assertEqual(self.ssh.submit_task.call_count, 2)
+        self.assertEqual(self.ssh.submit_task.call_args[0][0], task.id)
+        self.assertEqual(self.database.get_task(task.id).state, 'submitting')
+        self.assertEqual(self.dispatcher.scan(), 0)
+        self.dispatcher.stop()
+
+    def test_recover(self):
+        """Only claims of other dispatchers older than CLAIM_TIMEOUT are queued again"""
+        own = self.database.add_task(dict(PAYLOAD))
+        other = self.database.add_task(dict(PAYLOAD))
+        self.database.claim_tasks([own.id], 'queued', 'submitting', self.dispatcher.owner)
+        self.database.claim_tasks([other.id], 'queued', 'submitting', 'other:1:0')
+        self.assertEqual(self.dispatcher.recover(), 0)
+        self.dispatcher.claim_timeout = 0
+        self.assertEqual(self.dispatcher.recover(), 1)
+        self.assertEqual(self.database.get_task(own.id).state, 'submitting')
+        self.assertEqual(self.database.get_task(other.id).state, 'queued')
+
+    def test_failover(self):
+        """The new leader queues the claims of the previous leader again without timeout"""
+        config = {'PAPI': dict(CONFIG, SLEEP_TIMER=3600, SUBMIT_FIELDS_REQUIRED={},
+                               ELECTION={'ENABLED': True, 'LEASE': 30},
+                               DISPATCHER={'WORKERS': 1, 'QUEUE_SIZE': 1,
+                                           'SCAN_INTERVAL': 3600, 'CLAIM_TIMEOUT': 600})}
+        leader = Worker(config, self.database, self.ssh)
+        follower = Worker(config, self.database, self.ssh)
+        self.assertTrue(leader.election.try_acquire())
+        task = self.database.add_task(dict(PAYLOAD))
+        self.database.claim_tasks([task.id], 'queued', 'submitting', leader.election.owner)
+        self.assertFalse(follower.election.try_acquire())
+        self.assertEqual(follower.dispatcher.recover(), 0)
+        leader.stop()
+        self.assertTrue(follower.election.try_acquire())
+        self.assertTrue(follower.dispatcher.active.is_set())
+        self.assertEqual(self.database.get_task(task.id).state, 'queued')
+        self.assertEqual(follower.dispatcher.queue.get_nowait()[1], [task.id])
+
+
+if __name__ == '__main__':
+    unittest.main()
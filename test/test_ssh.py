@@ -1,11 +1,349 @@
 """Unittest for papi.ssh.Ssh class"""
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from papi.ssh.ssh_pool import SshPool, PoolExhaustedError
+from papi.ssh.ssh_router import SshRouter
+from papi.ssh.ssh_reader import SshReader, OutputCapture
+from papi.ssh import Ssh
+
+class FakeTransport:
+    """Minimal stand-in for paramiko.Transport"""
+    def __init__(self):
+        self.active = True
+        self.sessions = 0
+
+    def is_active(self):
+        return self.active
+
+    def is_authenticated(self):
+        return True
+
+    def set_keepalive(self, interval):
+        pass
+
+    def open_session(self, timeout=None):
+        self.sessions += 1
+        return mock.MagicMock()
+
+class FakeClient:
+    """Minimal stand-in for paramiko.SSHClient"""
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def load_system_host_keys(self):
+        pass
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+
+CONFIG = {'HOSTNAME': 'login', 'PORT': 22, 'USERNAME': 'user', 'PASSWORD': None,
+          'POOL': {'MAX_TRANSPORTS': 2, 'MAX_CHANNELS': 2, 'IDLE_TIMEOUT': 300,
+                   'WAIT_TIMEOUT': 0}}
+
+class TestSshPool(unittest.TestCase):
+    """Unittest for papi.ssh.SshPool"""
+    def setUp(self):
+        patcher = mock.patch('papi.ssh.ssh_pool.paramiko.SSHClient', FakeClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = SshPool(CONFIG)
+
+    def test_channels_share_transport(self):
+        """Channels are multiplexed before a new transport is opened"""
+        channels = [self.pool.open_channel() for _ in range(4)]
+        self.assertEqual(len(self.pool.transports), 2)
+        self.assertTrue(all(pooled.channels == 2 for pooled in self.pool.transports))
+        for channel in channels:
+            self.pool.release(channel)
+        self.assertTrue(all(pooled.channels == 0 for pooled in self.pool.transports))
+
+    def test_channel_limit(self):
+        """Opening more channels than configured raises once the wait timed out"""
+        for _ in range(4):
+            self.pool.open_channel()
+        with self.assertRaises(Exception):
+            self.pool.open_channel()
+
+    def test_dead_transport_reconnects(self):
+        """A dead transport is evicted and replaced by a new one"""
+        channel = self.pool.open_channel()
+        pooled = channel.pooled_transport
+        self.pool.release(channel)
+        pooled.transport.active = False
+        channel = self.pool.open_channel()
+        self.assertIsNot(channel.pooled_transport, pooled)
+        self.assertTrue(pooled.client.closed)
+
+    def test_idle_eviction(self):
+        """Unused transports are closed after the idle timeout"""
+        channel = self.pool.open_channel()
+        pooled = channel.pooled_transport
+        self.pool.release(channel)
+        self.pool.idle_timeout = -1
+        channel = self.pool.open_channel()
+        self.assertTrue(pooled.client.closed)
+        self.assertEqual(len(self.pool.transports), 1)
+
+    def test_idle_eviction_without_commands(self):
+        """Idle transports are closed by the housekeeping thread without further commands"""
+        self.addCleanup(self.pool.close)
+        self.pool.release(self.pool.open_channel())
+        self.assertTrue(self.pool.housekeeper.is_alive())
+        pooled = self.pool.transports[0]
+        self.pool.idle_timeout = -1
+        self.pool.evict_idle()
+        self.assertTrue(pooled.client.closed)
+        self.assertEqual(self.pool.transports, [])
+
+class FakeChannel:
+    """Channel stand-in which becomes readable once the command was executed"""
+    def __init__(self, stdout=b'', stderr=b'', exit_status=0):
+        self.read_sock, self.write_sock = socket.socketpair()
+        self.result = (stdout, stderr, exit_status)
+        self.out = bytearray()
+        self.err = bytearray()
+        self.exit_status = None
+        self.eof_received = False
+        self.closed = False
+
+    def fileno(self):
+        return self.read_sock.fileno()
+
+    def exec_command(self, command):
+        self.out += self.result[0]
+        self.err += self.result[1]
+        self.exit_status = self.result[2]
+        self.eof_received = True
+        self.write_sock.send(b'x')
+
+    def recv_ready(self):
+        return len(self.out) > 0
+
+    def recv_stderr_ready(self):
+        return len(self.err) > 0
+
+    def recv(self, size):
+        data = bytes(self.out[:size])
+        del self.out[:size]
+        return data
+
+    def recv_stderr(self, size):
+        data = bytes(self.err[:size])
+        del self.err[:size]
+        return data
+
+    def exit_status_ready(self):
+        return self.exit_status is not None
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+class TestSshReader(unittest.TestCase):
+    """Unittest for papi.ssh.SshReader"""
+    def test_callbacks(self):
+        """Every command is reported with its full output and released"""
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        reader = SshReader({'CALLBACK_WORKERS': 2, 'MAX_OUTPUT': 1024, 'LOG_DIR': log_dir.name})
+        results = {}
+        done = threading.Event()
+        released = []
+
+        def callback(exit_status, stdout, stderr, task_id):
+            results[task_id] = (exit_status, stdout, stderr)
+            if len(results) == 20:
+                done.set()
+
+        for task_id in range(20):
+            channel = FakeChannel(b'Submitted batch job %d\n' % task_id * 2000, b'', task_id % 2)
+            reader.add_object(channel, 'submit', callback, task_id, released.append)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(len(released), 20)
+        self.assertEqual(results[3][0], 1)
+        self.assertEqual(len(results[3][1]), 1024)
+        self.assertEqual(os.path.getsize(reader.get_log_filename(3)),
+                         len('Submitted batch job 3\n') * 2000)
+
+    def test_read_error(self):
+        """A command whose output cannot be logged is reported with exit code -1"""
+        base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(base_dir.cleanup)
+        reader = SshReader({'LOG_DIR': 'logs'}, base_dir.name)
+        self.assertEqual(reader.log_dir, os.path.join(base_dir.name, 'logs'))
+        os.rmdir(reader.log_dir)
+        results = []
+        done = threading.Event()
+        released = []
+
+        def callback(exit_status, stdout, stderr, task_id):
+            results.append((exit_status, task_id))
+            done.set()
+
+        reader.add_object(FakeChannel(b'output'), 'submit', callback, 7, released.append)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [(-1, 7)])
+        self.assertEqual(len(released), 1)
+
+    def test_prune_logs(self):
+        """Log files older than LOG_RETENTION are removed"""
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        reader = SshReader({'LOG_DIR': log_dir.name, 'LOG_RETENTION': 3600})
+        for log_name in (1, 2):
+            with open(reader.get_log_filename(log_name), 'w') as log_file:
+                log_file.write('output')
+        expired = time.time() - 7200
+        os.utime(reader.get_log_filename(1), (expired, expired))
+        self.assertEqual(reader.prune_logs(), 1)
+        self.assertFalse(os.path.exists(reader.get_log_filename(1)))
+        self.assertTrue(os.path.exists(reader.get_log_filename(2)))
+
+    def test_output_capture(self):
+        """Output above the limit is dropped from memory but kept in the log file"""
+        with tempfile.NamedTemporaryFile() as log_file:
+            capture = OutputCapture(4, log_file.name)
+            capture.write(b'abc')
+            capture.write(b'def')
+            capture.close()
+            self.assertEqual(capture.getvalue(), 'abcd')
+            self.assertTrue(capture.truncated)
+            self.assertEqual(log_file.read(), b'abcdef')
 
 class TestSsh(unittest.TestCase):
+    """Unittest for papi.ssh.Ssh"""
+    def test_dependency(self):
+        """Pipelined phases pass their dependency to sbatch through the wrapper"""
+        database = mock.Mock()
+        database.get_param_from_task.return_value = 'sub15days true 0.25 1.0'
+        ssh = Ssh(dict(CONFIG, KEY_FILENAME='', COLLECT_COMMAND='collect',
+                       ARCHIVE_COMMAND='archive'), database)
+        task = mock.Mock(id=3)
+        with mock.patch.object(ssh, '_Ssh__execute') as execute:
+            ssh.collect_task(task, None)
+            ssh.collect_task(task, None, dependency='7_1')
+            ssh.archive_task(task, None, dependency=8)
+        self.assertEqual([call[0][0] for call in execute.call_args_list],
+                         ['collect sub15days true 0.25 1.0',
+                          'collect --dependency=afterok:7_1 --kill-on-invalid-dep=yes '
+                          'sub15days true 0.25 1.0',
+                          'archive --dependency=afterok:8 --kill-on-invalid-dep=yes '
+                          'sub15days true 0.25 1.0'])
+
+class FakePool:
+    """SshPool stand-in of a host which can be taken down"""
+    def __init__(self, config, hostname):
+        self.hostname = hostname
+        self.down = False
+        self.attempts = 0
+
+    def set_key_filename(self, key_filename):
+        pass
+
+    def open_channel(self, timeout=None):
+        self.attempts += 1
+        if self.down:
+            raise OSError(f"{self.hostname} is down")
+        channel = mock.MagicMock()
+        channel.recv_exit_status.return_value = 0
+        return channel
+
+    def release(self, channel):
+        channel.close()
+
+class TestSshRouter(unittest.TestCase):
+    """Unittest for papi.ssh.SshRouter"""
+    def setUp(self):
+        patcher = mock.patch('papi.ssh.ssh_router.SshPool', FakePool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = SshRouter(dict(CONFIG, HOSTNAME=['login1', 'login2'],
+                                     ROUTER={'MAX_FAILURES': 2, 'EJECT_TIME': 3600}))
+        self.first, self.second = self.router.hosts
+
+    def test_least_outstanding(self):
+        """Commands go to the host with the fewest commands in flight"""
+        channels = [self.router.open_channel() for _ in range(4)]
+        self.assertEqual([self.first.outstanding, self.second.outstanding], [2, 2])
+        for channel in channels:
+            if channel.ssh_host is self.first:
+                self.router.release(channel)
+        self.assertIs(self.router.open_channel().ssh_host, self.first)
+        self.assertIs(self.router.open_channel().ssh_host, self.first)
+
+    def test_eject_and_readmit(self):
+        """A failing host is ejected, commands fail over and a probe readmits it"""
+        self.first.pool.down = True
+        for _ in range(6):
+            self.assertIs(self.router.open_channel().ssh_host, self.second)
+        self.assertTrue(self.first.ejected)
+        self.assertEqual(self.first.pool.attempts, 2)
+        self.assertFalse(self.router.probe(self.first))
+        self.first.pool.down = False
+        self.second.latency = 0.5
+        self.assertTrue(self.router.probe(self.first))
+        self.assertEqual(self.first.latency, 0.5)
+        self.assertIs(self.router.open_channel().ssh_host, self.first)
+
+    def test_latency_policy(self):
+        """With policy 'latency' a readmitted host does not take all commands"""
+        self.router.policy = 'latency'
+        self.second.latency = 0.2
+        self.first.ejected_until = 0.0
+        self.router.probe(self.first)
+        self.assertEqual(self.first.latency, 0.2)
+        hosts = [self.router.open_channel().ssh_host for _ in range(4)]
+        self.assertEqual(hosts.count(self.first), 2)
+
+    def test_pool_exhausted(self):
+        """A host without free channel is skipped but not ejected"""
+        with mock.patch.object(FakePool, 'open_channel',
+                               side_effect=PoolExhaustedError("No free ssh channel")):
+            for _ in range(3):
+                with self.assertRaises(PoolExhaustedError):
+                    self.router.open_channel()
+        self.assertEqual([self.first.failures, self.second.failures], [0, 0])
+        self.assertFalse(self.first.ejected or self.second.ejected)
+
+    def test_timeouts_eject(self):
+        """Commands which time out count as failures of their host"""
+        self.second.latency = 1.0
+        for _ in range(2):
+            channel = self.router.open_channel()
+            self.assertIs(channel.ssh_host, self.first)
+            self.router.report_error(channel, socket.timeout())
+            self.router.release(channel)
+        self.assertTrue(self.first.ejected)
+        self.assertIs(self.router.open_channel().ssh_host, self.second)
 
-    def test_noop(self):
-        self.assertEqual(True, True)
+    def test_all_hosts_down(self):
+        """Ejected hosts are still tried if no other host is left"""
+        self.first.pool.down = True
+        self.second.pool.down = True
+        for _ in range(3):
+            with self.assertRaises(OSError):
+                self.router.open_channel()
+        self.assertTrue(self.first.ejected and self.second.ejected)
+        self.second.pool.down = False
+        self.assertIs(self.router.open_channel().ssh_host, self.second)
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
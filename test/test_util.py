@@ -1,6 +1,8 @@
 """Unittest for papi.util helper Methods"""
 import unittest
-from papi.util import parse_slurm_output, parse_sacct_output 
+from papi.util import (parse_slurm_output, parse_sacct_output, chunk_list,
+                        parse_slurm_duration, slurm_job_key, expand_array_job_ids,
+                        axis_size, expand_axis, grid_size, iter_grid)
 
 class TestUtil(unittest.TestCase):
     """Unittest for papi.util helper Methods"""
@@ -38,6 +40,48 @@ class TestUtil(unittest.TestCase):
         self.assertEqual(parse_sacct_output(str_empty), {})
         self.assertEqual(parse_sacct_output(str_none), {})
 
+    def test_chunk_list(self):
+        """Unit test for chunk_list"""
+        self.assertEqual(list(chunk_list(['1', '2', '3'], 2)), [['1', '2'], ['3']])
+        self.assertEqual(list(chunk_list(iter(range(4)), 2)), [[0, 1], [2, 3]])
+        self.assertEqual(list(chunk_list([], 2)), [])
+
+    def test_parse_slurm_duration(self):
+        """Unit test for parse_slurm_duration"""
+        self.assertEqual(parse_slurm_duration('00:07:14'), 434)
+        self.assertEqual(parse_slurm_duration('1-02:03:04'), 93784)
+        self.assertEqual(parse_slurm_duration('07:14'), 434)
+        self.assertEqual(parse_slurm_duration('00:00:16.5'), 16.5)
+        self.assertEqual(parse_slurm_duration(''), None)
+        self.assertEqual(parse_slurm_duration('UNLIMITED'), None)
+
+    def test_expand_array_job_ids(self):
+        """Unit test for slurm_job_key and expand_array_job_ids"""
+        self.assertEqual(slurm_job_key(100), '100')
+        self.assertEqual(slurm_job_key(100, 0), '100_0')
+        expanded = expand_array_job_ids({'100_[0-2,5%2]': {'State': 'PENDING'},
+                                         '100_3': {'State': 'RUNNING'},
+                                         '101': {'State': 'COMPLETED'}})
+        self.assertEqual(sorted(expanded), ['100_0', '100_1', '100_2', '100_3', '100_5', '101'])
+        self.assertEqual(expanded['100_1'], {'State': 'PENDING'})
+
+    def test_sweep_grid(self):
+        """Unit test for expand_axis, grid_size and iter_grid"""
+        self.assertEqual(expand_axis({'start': 0.25, 'stop': 1.0, 'step': 0.25}),
+                         [0.25, 0.5, 0.75, 1.0])
+        self.assertEqual(expand_axis({'start': 0.1, 'stop': 0.3, 'step': 0.1}), [0.1, 0.2, 0.3])
+        self.assertEqual(expand_axis(['a', 'b']), ['a', 'b'])
+        self.assertEqual(expand_axis(1), [1])
+        self.assertRaises(ValueError, expand_axis, {'start': 1, 'stop': 0})
+        self.assertEqual(axis_size({'start': 0, 'stop': 1e12, 'step': 1}), 10**12 + 1)
+        self.assertEqual(axis_size(['a', 'b']), 2)
+        self.assertRaises(ValueError, axis_size, {'start': 0, 'stop': 'inf'})
+        axes = {'irrigation': [True, False], 'nutrition_factor': [0.5, 1.0, 1.5]}
+        self.assertEqual(grid_size(axes), 6)
+        grid = iter_grid(axes)
+        self.assertEqual(next(grid), {'irrigation': True, 'nutrition_factor': 0.5})
+        self.assertEqual(len(list(grid)), 5)
+
 
 if __name__ == '__main__':
     unittest.main()